@@ -1,9 +1,9 @@
 import time
-from PCA9685 import PCA9685
+import devices
 class Motor:
-    def __init__(self):
-        self.pwm = PCA9685(0x40, debug=True)
-        self.pwm.setPWMFreq(50)
+    # @param pwm -- the PCA9685 driving the wheels; the car's shared one by default.
+    def __init__(self, pwm=None):
+        self.pwm = pwm if pwm is not None else devices.pwm()
     def duty_range(self,duty1,duty2,duty3,duty4):
         if duty1>4095:
             duty1=4095
@@ -70,14 +70,16 @@ class Motor:
  
     def setMotorModel(self,duty1,duty2,duty3,duty4):
         duty1,duty2,duty3,duty4=self.duty_range(duty1,duty2,duty3,duty4)
-        self.left_Upper_Wheel(duty1)
-        self.left_Lower_Wheel(duty2)
-        self.right_Upper_Wheel(duty3)
-        self.right_Lower_Wheel(duty4)
+        # All 8 motor channels go out in one I2C write, and only if they changed.
+        with self.pwm.batch():
+            self.left_Upper_Wheel(duty1)
+            self.left_Lower_Wheel(duty2)
+            self.right_Upper_Wheel(duty3)
+            self.right_Lower_Wheel(duty4)
             
             
-PWM=Motor()          
 def loop(): 
+    PWM=devices.motor()
     PWM.setMotorModel(2000,2000,2000,2000)       #Forward
     time.sleep(3)
     PWM.setMotorModel(-2000,-2000,-2000,-2000)   #Back
@@ -89,7 +91,7 @@ def loop():
     PWM.setMotorModel(0,0,0,0)                   #Stop
     
 def destroy():
-    PWM.setMotorModel(0,0,0,0)                   
+    devices.motor().setMotorModel(0,0,0,0)                   
 if __name__=='__main__':
     try:
         loop()
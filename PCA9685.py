@@ -2,12 +2,21 @@
 
 import time
 import math
-import smbus
+import contextlib
 
 # ============================================================================
 # Raspi PCA9685 16-Channel PWM Servo Driver
 # ============================================================================
 
+# In batched mode (the default) the chip's register auto-increment is turned
+# on, so a channel's four registers, or several neighbouring channels, are
+# written in one I2C block write instead of one transaction per byte. A shadow
+# copy of every channel's (on, off) is kept so writes that wouldn't change
+# anything are skipped, and setPWM calls made inside `with pwm.batch():` are
+# sent together when the block ends.
+
+MAX_BLOCK = 32 # Most data bytes in one SMBus block write, i.e. 8 channels
+
 class PCA9685:
 
   # Registers/etc.
@@ -24,12 +33,19 @@ class PCA9685:
   __ALLLED_ON_H        = 0xFB
   __ALLLED_OFF_L       = 0xFC
   __ALLLED_OFF_H       = 0xFD
+  __MODE1_AI           = 0x20
 
-  def __init__(self, address=0x40, debug=False):
-    self.bus = smbus.SMBus(1)
+  def __init__(self, address=0x40, debug=False, bus=None, batched=True):
+    if bus is None:
+      import smbus
+      bus = smbus.SMBus(1)
+    self.bus = bus
     self.address = address
     self.debug = debug
-    self.write(self.__MODE1, 0x00)
+    self.batched = batched
+    self.shadow = [None] * 16 # (on, off) last written to each channel
+    self.pending = None # {channel: (on, off)} while in a batch()
+    self.write(self.__MODE1, self.__MODE1_AI if batched else 0x00)
     
   def write(self, reg, value):
     "Writes an 8-bit value to the specified register/address"
@@ -59,10 +75,51 @@ class PCA9685:
 
   def setPWM(self, channel, on, off):
     "Sets a single PWM channel"
-    self.write(self.__LED0_ON_L+4*channel, on & 0xFF)
-    self.write(self.__LED0_ON_H+4*channel, on >> 8)
-    self.write(self.__LED0_OFF_L+4*channel, off & 0xFF)
-    self.write(self.__LED0_OFF_H+4*channel, off >> 8)
+    if not self.batched:
+      self.write(self.__LED0_ON_L+4*channel, on & 0xFF)
+      self.write(self.__LED0_ON_H+4*channel, on >> 8)
+      self.write(self.__LED0_OFF_L+4*channel, off & 0xFF)
+      self.write(self.__LED0_OFF_H+4*channel, off >> 8)
+      return
+    if self.pending is not None:
+      self.pending[channel] = (on, off)
+    else:
+      self.setPWMs({channel: (on, off)})
+
+  def setPWMs(self, channels):
+    "Sets several PWM channels from {channel: (on, off)}, in as few block writes as possible"
+    changed = sorted(c for c, value in channels.items() if self.shadow[c] != value)
+    i = 0
+    while i < len(changed):
+      # Write a run of neighbouring channels at once.
+      start = changed[i]
+      data = []
+      while i < len(changed) and changed[i] == start + len(data) // 4 and len(data) < MAX_BLOCK:
+        (on, off) = channels[changed[i]]
+        data += [on & 0xFF, on >> 8, off & 0xFF, off >> 8]
+        i += 1
+      self.bus.write_i2c_block_data(self.address, self.__LED0_ON_L+4*start, data)
+      for c in range(start, start + len(data) // 4):
+        self.shadow[c] = channels[c]
+
+  @contextlib.contextmanager
+  def batch(self):
+    "Holds back setPWM calls until the end of the `with` block, then sends them together"
+    if not self.batched or self.pending is not None:
+      yield # Nothing to batch, or already inside a batch
+      return
+    self.pending = {}
+    try:
+      yield
+    finally:
+      pending = self.pending
+      self.pending = None
+      self.setPWMs(pending)
+
+  def invalidate(self):
+    "Forgets the shadow registers, e.g. after something else reset the chip"
+    self.shadow = [None] * 16
+
   def setMotorPwm(self,channel,duty):
     self.setPWM(channel,0,duty)
   def setServoPulse(self, channel, pulse):
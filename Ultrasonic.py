@@ -1,38 +1,36 @@
 import time
 from Motor import *
-import RPi.GPIO as GPIO
 from servo import *
-from PCA9685 import PCA9685
+from ranging import *
+import devices
 class Ultrasonic:
-    def __init__(self):
-        GPIO.setwarnings(False)
+    # @param backend -- 'edge' to time echoes with GPIO edge events, or
+    # 'polling' for the original busy-wait (see ranging.py).
+    # @param gpio -- the GPIO module to use (RPi.GPIO, or see devices.configure).
+    def __init__(self, backend='edge', gpio=None):
+        if gpio is None:
+            gpio = devices.gpio()
+        self.gpio = gpio
+        self.backend = backend
+        gpio.setwarnings(False)
         self.trigger_pin = 27
         self.echo_pin = 22
-        GPIO.setmode(GPIO.BCM)
-        GPIO.setup(self.trigger_pin,GPIO.OUT)
-        GPIO.setup(self.echo_pin,GPIO.IN)
-    def send_trigger_pulse(self):
-        GPIO.output(self.trigger_pin,True)
-        time.sleep(0.00015)
-        GPIO.output(self.trigger_pin,False)
+        gpio.setmode(gpio.BCM)
+        gpio.setup(self.trigger_pin,gpio.OUT)
+        gpio.setup(self.echo_pin,gpio.IN)
+        # Created on the first ping, since only one ranger can watch the echo pin.
+        self.ranger = None
 
-    def wait_for_echo(self,value,timeout):
-        count = timeout
-        while GPIO.input(self.echo_pin) != value and count>0:
-            count = count-1
-     
+    # Returns the distance of one ping in cm, or None if nothing echoed.
+    def ping(self):
+        if self.ranger is None:
+            self.ranger = makeRanger(self.gpio, self.trigger_pin, self.echo_pin, self.backend)
+        return self.ranger.ping()
+
+    # Median of 3 pings, in whole cm; a missed echo counts as MAX_RANGE_CM.
     def get_distance(self):
-        distance_cm=[0,0,0,0,0]
-        for i in range(3):
-            self.send_trigger_pulse()
-            self.wait_for_echo(True,10000)
-            start = time.time()
-            self.wait_for_echo(False,10000)
-            finish = time.time()
-            pulse_len = finish-start
-            distance_cm[i] = pulse_len/0.000058
-        distance_cm=sorted(distance_cm)
-        return int(distance_cm[2])
+        distance_cm=sorted(MAX_RANGE_CM if d is None else d for d in (self.ping() for i in range(3)))
+        return int(distance_cm[1])
     def run_motor(self,L,M,R):
         if (L < 30 and M < 30 and R <30) or M < 30 :
             self.PWM.setMotorModel(-1450,-1450,-1450,-1450) 
@@ -42,23 +40,23 @@ class Ultrasonic:
             else :
                 self.PWM.setMotorModel(-1450,-1450,1450,1450)
         elif L < 30 and M < 30:
-            PWM.setMotorModel(1500,1500,-1500,-1500)
+            self.PWM.setMotorModel(1500,1500,-1500,-1500)
         elif R < 30 and M < 30:
-            PWM.setMotorModel(-1500,-1500,1500,1500)
+            self.PWM.setMotorModel(-1500,-1500,1500,1500)
         elif L < 20 :
-            PWM.setMotorModel(2000,2000,-500,-500)
+            self.PWM.setMotorModel(2000,2000,-500,-500)
             if L < 10 :
-                PWM.setMotorModel(1500,1500,-1000,-1000)
+                self.PWM.setMotorModel(1500,1500,-1000,-1000)
         elif R < 20 :
-            PWM.setMotorModel(-500,-500,2000,2000)
+            self.PWM.setMotorModel(-500,-500,2000,2000)
             if R < 10 :
-                PWM.setMotorModel(-1500,-1500,1500,1500)
+                self.PWM.setMotorModel(-1500,-1500,1500,1500)
         else :
             self.PWM.setMotorModel(600,600,600,600)
                 
     def run(self):
-        self.PWM=Motor()
-        self.pwm_S=Servo()
+        self.PWM=devices.motor()
+        self.pwm_S=devices.servo()
         for i in range(30,151,60):
                 self.pwm_S.setServoPwm('0',i)
                 time.sleep(0.2)
@@ -92,13 +90,13 @@ class Ultrasonic:
         
             
         
-ultrasonic=Ultrasonic()              
 # Main program logic follows:
 if __name__ == '__main__':
     print ('Program is starting ... ')
+    ultrasonic=devices.ultrasonic()
     try:
         ultrasonic.run()
     except KeyboardInterrupt:  # When 'Ctrl+C' is pressed, the child program destroy() will be  executed.
-        PWM.setMotorModel(0,0,0,0)
+        devices.motor().setMotorModel(0,0,0,0)
         ultrasonic.pwm_S.setServoPwm('0',90)
 
@@ -2,6 +2,7 @@ from timeit import default_timer as timer
 
 from Ultrasonic import *
 from servo import *
+import devices
 
 import traceback
 import logging
@@ -9,82 +10,80 @@ import logging
 import sys
 import math
 from networking.client import *
-
-# Utilities
-ultrasonic = Ultrasonic()
-ultrasonic.pwm_S = Servo()
-wheels = Motor()
-client = Client()
+from networking.telemetry import TelemetrySender
+from distanceEstimator import *
+from sweep import *
+from imuSampler import *
+from turnController import *
+from headingFusion import *
+from odometry import *
+
+# Utilities (created once and shared; see devices.py)
+ultrasonic = devices.ultrasonic()
+ultrasonic.pwm_S = devices.servo()
+wheels = devices.motor()
+telemetry = None  # TelemetrySender, once we know the server
+odometry = None  # Odometry, once the sensors are set up
+
+
+def setMotors(duty1, duty2, duty3, duty4):
+    wheels.setMotorModel(duty1, duty2, duty3, duty4)
+    if telemetry is not None:
+        telemetry.motor(duty1, duty2, duty3, duty4)
+    if odometry is not None:
+        odometry.motors(duty1, duty2, duty3, duty4)
 
 
 def forward(speed=0.5):
-    wheels.setMotorModel(int(-4095 * speed), int(-4095 * speed),
-                         int(-4095 * speed), int(-4095 * speed))
+    setMotors(int(-4095 * speed), int(-4095 * speed),
+              int(-4095 * speed), int(-4095 * speed))
 
 
 def stop():
-    wheels.setMotorModel(0, 0, 0, 0)
+    setMotors(0, 0, 0, 0)
 
 
 def turn(speed=0.5):
-    wheels.setMotorModel(int(-4095 * speed), int(-4095 * speed),
-                         int(4095 * speed), int(4095 * speed))
+    setMotors(int(-4095 * speed), int(-4095 * speed),
+              int(4095 * speed), int(4095 * speed))
 
 
 def getUltrasonicDistance():
-    # Average out some values to ensure the reading is sensible since it can fluctuate
-    # in complex obstacle courses.
-    avg = 0
-    count = 5
-    for i in range(0, count):
-        avg += ultrasonic.get_distance()
-    return avg / count
+    # Filtered reading from the background sensor thread (see
+    # distanceEstimator.py). Only waits if the sensor was just pointed
+    # somewhere new and hasn't pinged there `distance_samples` times yet.
+    distance = distanceEstimator.waitFor(distance_samples)
+    # No reading (sensor thread dead or silent): treat as blocked, not open.
+    return 0 if distance is None else distance
 
 
-def accurateTurn(destination_angle = 0, speed = 0):
-    # Turn
-    current_degree = 0
-    if destination_angle < 0:
-        print("Turning left")
-        turn(-speed)
-    elif destination_angle > 0:
-        print("Turning right")
-        turn(speed)
+# Points the ultrasonic sensor `angle` degrees from the middle. Readings from
+# the old direction, or taken while the servo is still turning, don't count.
+def pointSensor(angle):
+    sweeper.point(angle)
+
 
+def accurateTurn(destination_angle = 0, speed = 0):
     if turn_method == 0:
+        if destination_angle < 0:
+            print("Turning left")
+            turn(-speed)
+        elif destination_angle > 0:
+            print("Turning right")
+            turn(speed)
         while True:
             # Get current distance as we turn
             c = getUltrasonicDistance()
             if abs(c - destination_distance) <= dist_epsilon:
                 stop()
                 break
-    elif turn_method == 1:
-        while True:
-            # Grab current angular velocity z in degrees per second.
-            (dRoll, dPitch, dYaw) = mpu.gyro
-            end_time = timer()
-            current_degree -= (end_time - start_time) * dYaw
-            print("At " + str(current_degree) + " degrees out of " +
-                  str(destination_angle) + " degrees")
-            if abs(current_degree - destination_angle) <= angle_epsilon:
-                stop()
-                break
-    elif turn_method == 2:
-        flow.prepare()
-        while True:
-            # Get current distance as we turn
-            c = getUltrasonicDistance()
-            (closestPointToCenter, flowVector) = flow.computeCentermostFlow()
-            current_degree -= math.degrees(
-                flow.computeRadiansOfCameraRotation(c, flowVector))
-            print("At " + str(current_degree) + " degrees out of " +
-                  str(destination_angle) + " degrees")
-            if abs(current_degree - destination_angle) <= angle_epsilon:
-                stop()
-                break
-    elif turn_method == 3:
-        time.sleep(abs(destination_angle)/180)
-        stop()
+    else:
+        turn_mark = odometry.mark()
+        # Slows down as it gets close (see turnController.py).
+        result = turnController.turnBy(destination_angle, speed)
+        odometry.correctTurn(turn_mark, result.heading)
+        print("Turned " + str(result.heading) + " degrees out of " +
+              str(destination_angle) + " degrees in " + str(result.seconds) + " seconds")
 
 
 # Get `use` for which CarConfig to use:
@@ -100,13 +99,50 @@ else:
     isReceivingVehicle = bool(int(sys.argv[2]))
     debugWindowEnabled = bool(int(sys.argv[3]))
 
+# Relay server to send the path to or receive it from (IP, or IP:port), and the
+# channel (fleet) to share it in:
+serverAddress = sys.argv[4] if len(sys.argv) > 4 else promptForServer()
+(serverIp, _, serverPort) = serverAddress.partition(':')
+channel = sys.argv[5] if len(sys.argv) > 5 else DEFAULT_CHANNEL
+client = Client(serverIp, int(serverPort or 8080), channel=channel)
+# Live sweeps, turn progress and motor commands, for watching the run with
+# `python -m networking.telemetry SERVER_IP`. Sending never blocks.
+telemetry = TelemetrySender(serverIp, vehicle=carConfig)
+
 # Configuration
 d = 20  # Centimeters from car to object at which to stop and scan from
-# distance polling(0), gyroscope(1), optical flow(2), timed (3)
-turn_method = 3
+# distance polling(0), gyroscope(1), optical flow(2), timed (3), fused (4)
+turn_method = int(sys.argv[6]) if len(sys.argv) > 6 else 3
 dist_epsilon = 30  # For distance polling(0)
-angle_epsilon = 5  # For gyroscope(1) and optical flow(2)
+angle_epsilon = 1  # Degrees, for gyroscope(1), optical flow(2), timed(3) and fused(4)
+turn_control_rate = 100  # Hz, for gyroscope(1), timed(3) and fused(4)
+flow_control_rate = 30  # Hz, for optical flow(2); no faster than the camera's frame rate
+turn_degrees_per_second = 360  # How fast the car turns at full speed, for timed(3) and fused(4)
+fuse_optical_flow = False  # Whether fused(4) also uses optical flow (at flow_control_rate)
+threaded_camera = True  # Grab camera frames on a background thread, for optical flow(2) and fused(4)
+flow_scale = 0.5  # Shrink camera frames by this before optical flow
+flow_roi = None  # (x, y, width, height) part of the camera frame to track in, or None for all of it
+drive_cm_per_second = 44  # How fast the car drives at full speed, for odometry
+trajectory_file = None  # File to save the car's estimated trajectory to (CSV, or .npy), or None
+# Filter for the ultrasonic readings: 'none', 'median', 'outlier', 'kalman' or
+# several joined with '+' (see makeFilter in distanceEstimator.py)
+distance_filter = 'outlier+median'
+distance_samples = 3  # Pings per reading, so the filter has more than one to work on
 speed = 0.5
+# Degrees between look-around readings; the sweep then fills in every
+# fine step around the most open directions (equal steps read every angle).
+sweep_coarse_step = 30
+sweep_fine_step = 10
+# Send each segment to the receiving vehicle as soon as it's recorded, so it
+# can start driving before exploration is over, instead of the whole path at
+# the end.
+stream_path = True
+# Whether the receiving vehicle only follows a path while it's being streamed
+# (1), or else the latest one stored on the server, e.g. from a run that's
+# already over (0). The server sends a path being streamed instead of the
+# stored one anyway; live-only waits when nothing is streaming yet, so that a
+# car started before the exploration doesn't drive the previous run's path.
+follow_live = bool(int(sys.argv[7])) if len(sys.argv) > 7 else False
 
 if carConfig == 1:
     middleHoriz = 75
@@ -120,41 +156,67 @@ else:
     middleHoriz = 90
     middleVert = 90
 
-# If we are the receiving vehicle, we need to wait for a path first.
+backup_time = 0.25  # Seconds to back up after stopping in front of an obstacle
+
+# If we are the receiving vehicle, we follow a path from the server.
+# A path is a list of Segment(duration, speed, angle): drive forward for
+# `duration` seconds at `speed` (backwards if negative), then turn by `angle`.
+# Its segments are driven as they arrive, so a path that is still being
+# streamed by the navigation vehicle is followed while it's explored, and
+# otherwise the latest stored one. With `follow_live`, the stored path (e.g.
+# from a previous run) is ignored and it waits for one to be streamed.
 if isReceivingVehicle:
-    recordedPath = [0.5, 
-                    1.257-0.25, 
-                    -60, 
-                    0.852-0.25, 
-                    10, 
-                    3.916-0.25, 
-                    -90,
-                    0.182-0.25, 
-                    -20, 
-                    0.346-0.25, 
-                    -90, 
-                    2.956-0.25, 
-                    60, 
-                    2.834-0.25]
-    # recordedPath = client.receivePath()
+    recordedPath = client.streamedPath(live=follow_live)
 else:
     recordedPath = []
 
 # Initialize sensors
+distanceEstimator = DistanceEstimator(ultrasonic, makeFilter(distance_filter))
+distanceEstimator.start()
+sweeper = SweepScheduler(ultrasonic.pwm_S, distanceEstimator, middleHoriz,
+                         coarseStep=sweep_coarse_step, fineStep=sweep_fine_step,
+                         onReading=telemetry.sweep, samples=distance_samples)
 if turn_method == 1:
-    import busio
-    import adafruit_mpu6050
-
-    i2c = busio.I2C(1, 0)
-    mpu = adafruit_mpu6050.MPU6050(i2c)
+    # Calibrates the gyro's bias first, so the car must be standing still.
+    imuSampler = ImuSampler(devices.imu())
+    imuSampler.start()
+    turnController = TurnController(turn, stop, GyroHeading(imuSampler), rate=turn_control_rate,
+                                    tolerance=angle_epsilon, onProgress=telemetry.turn)
 elif turn_method == 2:
     import flow
 
-    flow = flow.OpticalFlow(show_debug=debugWindowEnabled)
+    flow = flow.OpticalFlow(show_debug=debugWindowEnabled, threaded=threaded_camera,
+                            scale=flow_scale, roi=flow_roi)
+    turnController = TurnController(turn, stop, FlowHeading(flow, getUltrasonicDistance),
+                                    rate=flow_control_rate,
+                                    tolerance=angle_epsilon, onProgress=telemetry.turn)
+elif turn_method == 3:
+    turnController = TurnController(turn, stop, TimedHeading(turn_degrees_per_second),
+                                    rate=turn_control_rate, tolerance=angle_epsilon,
+                                    onProgress=telemetry.turn)
+elif turn_method == 4:
+    # The gyro, the commanded turn rate and optionally optical flow in one
+    # estimate; keeps working if the gyro stops reporting.
+    fusion = HeadingFusion()
+    imuSampler = ImuSampler(devices.imu(), onSample=fusion.gyro)
+    imuSampler.start()
+    turnFlow = None
+    if fuse_optical_flow:
+        import flow
+
+        turnFlow = flow.OpticalFlow(show_debug=debugWindowEnabled, threaded=threaded_camera,
+                                    scale=flow_scale, roi=flow_roi)
+    turnController = TurnController(turn, stop, FusedHeading(fusion, turn_degrees_per_second, turnFlow),
+                                    rate=flow_control_rate if fuse_optical_flow else turn_control_rate,
+                                    tolerance=angle_epsilon, onProgress=telemetry.turn)
+# Where the car is, from the motor commands and the gyro if there is one.
+odometry = Odometry(drive_cm_per_second, turn_degrees_per_second,
+                    heading=imuSampler.heading if turn_method == 1 else
+                    fusion.heading if turn_method == 4 else None)
 
 try:
     # Move the ultrasonic sensor to the middle:
-    ultrasonic.pwm_S.setServoPwm('0', middleHoriz)
+    sweeper.point(0)
     ultrasonic.pwm_S.setServoPwm('1', middleVert)
     # Allow time to settle:
     time.sleep(0.25)
@@ -167,16 +229,20 @@ try:
             flag = True
             while flag:
                 for angle in range(-20, 40, 10):
-                    ultrasonic.pwm_S.setServoPwm('0', angle + middleHoriz)
+                    pointSensor(angle)
                     c = getUltrasonicDistance()  # Grab distance from bot to object
+                    telemetry.sweep(angle, c)
+                    odometry.sample()
                     print("dist: " + str(c) + " angle: " + str(angle))
                     if c <= d:
                         stop()
                         flag = False
                         break
                 for angle in range(20, -40, -10):
-                    ultrasonic.pwm_S.setServoPwm('0', angle + middleHoriz)
+                    pointSensor(angle)
                     c = getUltrasonicDistance()  # Grab distance from bot to object
+                    telemetry.sweep(angle, c)
+                    odometry.sample()
                     print("dist: " + str(c) + " angle: " + str(angle))
                     if c <= d:
                         stop()
@@ -186,63 +252,78 @@ try:
             print("Time forward " + str(end_time - start_time))
             time.sleep(0.25)
             forward(-forward_speed)
-            time.sleep(0.25)
+            time.sleep(backup_time)
             stop()
-            recordedPath.append([end_time - start_time, forward_speed])
 
             # Look around, checking distances
-            destination_distance = 0
-            destination_angle = 0
-            for angle in range(-90, 100, 10):
-                ultrasonic.pwm_S.setServoPwm('0', angle + middleHoriz)
-                time.sleep(0.25)
-                dist = getUltrasonicDistance()
-                if dist > destination_distance:
-                    destination_distance = dist
-                    destination_angle = angle
+            lookAround = sweeper.sweep()
+            for (angle, dist) in lookAround.readings:
                 print("Recorded distance " + str(dist) + " for angle " + str(angle))
-            print("Chose angle " + str(destination_angle))
+            destination_distance = lookAround.distance
+            destination_angle = lookAround.angle
+            print("Chose angle " + str(destination_angle) + " (sweep took " +
+                  str(round(lookAround.seconds, 3)) + " s for " + str(len(lookAround.readings)) + " readings)")
 
-            ultrasonic.pwm_S.setServoPwm('0', middleHoriz)
-            time.sleep(0.25)
+            if turn_method in (0, 2):
+                # These measure the turn with the sensor, so it has to face forward.
+                sweeper.moveTo(0)
 
             accurateTurn(destination_angle, speed)
 
-            recordedPath.append([end_time - start_time, speed])
+            # Record the net forward time (minus backing up) and the turn taken.
+            recordedPath.append(Segment(end_time - start_time - backup_time,
+                                        forward_speed, destination_angle))
 
             # Check for end condition: all polled distance values are less
             # than or equal to some constant end_dist:
-            if destination_distance <= d:
+            end_reached = destination_distance <= d
+            if stream_path:
+                client.sendSegment(recordedPath[-1], final=end_reached)
+            if end_reached:
                 print("End reached")
 
-                client.sendPath(recordedPath)
+                if not stream_path:
+                    client.sendPath(recordedPath)
                 break
 
-    else:  # Then we are the receiving vehicle, so we have a path already.
-        speed = recordedPath.pop(0)
-        print("speed: " +  str(speed))
-        while len(recordedPath) != 0:
-            period = recordedPath.pop(0)
-            print("forward: " + str(period))
-            if period < 0:
-                forward(-speed * 0.3)
-                time.sleep(abs(period))
+    else:  # Then we are the receiving vehicle, following the path as it arrives.
+        for segment in recordedPath:
+            print("forward: " + str(segment.duration) + " at speed " + str(segment.speed))
+            if segment.duration < 0:
+                forward(-segment.speed)
+                time.sleep(abs(segment.duration))
             else:
-                forward(speed * 0.3)
-                time.sleep(period)
+                forward(segment.speed)
+                time.sleep(segment.duration)
             stop()
             time.sleep(0.25)
-            angle = recordedPath.pop(0)
-            print("turn: " + str(angle))
-            accurateTurn(angle, speed)
+            print("turn: " + str(segment.angle))
+            accurateTurn(segment.angle, speed)
             stop()
             time.sleep(0.25)
 
 finally:
     logging.error(traceback.format_exc())
     stop()
+    distanceEstimator.stop()
+    if turn_method in (1, 4):
+        imuSampler.stop()
+        print("IMU sampling: " + str(imuSampler.stats()))
+    if turn_method == 4:
+        print("Heading fusion: " + str(fusion.health()))
+    if turn_method == 2:
+        print("Camera: " + str(flow.stats()))
+    if turn_method == 4 and turnFlow is not None:
+        print("Camera: " + str(turnFlow.stats()))
+    if turn_method != 0:
+        print("Turns: " + str(turnController.stats()))
+    print("Odometry: " + str(odometry.stats()))
+    if trajectory_file is not None:
+        odometry.save(trajectory_file)
     ultrasonic.pwm_S.setServoPwm('0', middleHoriz)
     ultrasonic.pwm_S.setServoPwm('1', middleVert)
 
     if client:
         client.close()
+    print("Telemetry: " + str(telemetry.stats()))
+    telemetry.close()
@@ -1,6 +1,7 @@
 from servo import *
+import devices
 
-pwm=Servo()
+pwm=devices.servo()
 print("""Enter an amount of degrees to turn to. 
 Put v at the end to test vertical movement (for example, 50v).\n""")
 while True:
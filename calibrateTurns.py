@@ -1,4 +1,5 @@
 from Motor import *
+import devices
 
 import time
 
@@ -10,7 +11,7 @@ def stop():
     wheels.setMotorModel(0, 0, 0, 0)
 
 
-wheels = Motor()
+wheels = devices.motor()
 speed = 0.5
 
 print("Enter an amount of time to turn in seconds.\n")
@@ -0,0 +1,113 @@
+# Shared registry of the robot's hardware. Each physical device is created
+# once, the first time something asks for it, and then shared; importing this
+# module (or Motor, servo, Ultrasonic, PCA9685) touches no hardware and doesn't
+# need smbus or RPi.GPIO to be installed.
+#
+#   wheels = devices.motor()
+#   servos = devices.servo()       # same PCA9685 as the motors
+#   ultrasonic = devices.ultrasonic()
+#
+# The GPIO and SMBus modules used, and how the gyro and camera are made, can be
+# swapped before first use, e.g. for the stand-ins in simulation/:
+#
+#   devices.configure(gpio=SimulatedGPIO(), smbus=simulation.smbus,
+#                     imu=lambda: SimulatedMPU6050(world),
+#                     camera=lambda source: SimulatedVideoCapture(world))
+
+import threading
+
+PWM_ADDRESS = 0x40 # The car's PCA9685, shared by the motors and the servos
+PWM_FREQUENCY = 50 # Hz; servos need 50
+I2C_BUS = 1
+
+IMU_I2C_PINS = (1, 0) # SCL, SDA of the MPU6050's I2C bus
+
+lock = threading.RLock()
+instances = {} # name -> device
+# None means the real module; 'imu' and 'camera' are factories, imu() and
+# camera(source).
+backends = {'gpio': None, 'smbus': None, 'imu': None, 'camera': None}
+
+# Replaces the GPIO and/or SMBus module, and/or the IMU or camera factory, used
+# for devices created from now on.
+def configure(gpio=None, smbus=None, imu=None, camera=None):
+    with lock:
+        for name, backend in [('gpio', gpio), ('smbus', smbus), ('imu', imu), ('camera', camera)]:
+            if backend is not None:
+                backends[name] = backend
+
+# Returns the device called `name`, creating it with `factory()` the first time.
+def get(name, factory):
+    with lock:
+        device = instances.get(name)
+        if device is None:
+            device = instances[name] = factory()
+        return device
+
+# Forgets every device, so the next request creates them again.
+def reset():
+    with lock:
+        instances.clear()
+
+def gpio():
+    def load():
+        if backends['gpio'] is not None:
+            return backends['gpio']
+        import RPi.GPIO
+        return RPi.GPIO
+    return get('gpio', load)
+
+def bus(number=I2C_BUS):
+    def load():
+        smbus = backends['smbus']
+        if smbus is None:
+            import smbus
+        return smbus.SMBus(number)
+    return get('bus' + str(number), load)
+
+def pwm(address=PWM_ADDRESS):
+    def load():
+        from PCA9685 import PCA9685
+        device = PCA9685(address, debug=True, bus=bus())
+        device.setPWMFreq(PWM_FREQUENCY)
+        return device
+    return get('pwm' + hex(address), load)
+
+def motor():
+    def load():
+        from Motor import Motor
+        return Motor(pwm())
+    return get('motor', load)
+
+def servo():
+    def load():
+        from servo import Servo
+        return Servo(pwm())
+    return get('servo', load)
+
+def ultrasonic():
+    def load():
+        from Ultrasonic import Ultrasonic
+        return Ultrasonic(gpio=gpio())
+    return get('ultrasonic', load)
+
+# The MPU6050 gyro/accelerometer; `.gyro` is (x, y, z) in radians per second,
+# counter-clockwise positive.
+def imu():
+    def load():
+        if backends['imu'] is not None:
+            return backends['imu']()
+        import busio
+        import adafruit_mpu6050
+        return adafruit_mpu6050.MPU6050(busio.I2C(*IMU_I2C_PINS))
+    return get('imu', load)
+
+# A cv2.VideoCapture (or something with the same read/get/set/isOpened/release)
+# for camera `source`.
+def camera(source=0):
+    def load():
+        if backends['camera'] is not None:
+            return backends['camera'](source)
+        import cv2
+        return cv2.VideoCapture(source)
+    return get('camera' + str(source), load)
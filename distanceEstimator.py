@@ -0,0 +1,234 @@
+# Continuous ultrasonic distance estimation on a background thread. The thread
+# pings as fast as the sensor safely allows and runs every reading through a
+# streaming filter, so callers get the latest estimate without waiting on
+# pings themselves:
+#
+#   estimator = DistanceEstimator(ultrasonic, FilterChain(OutlierRejector(), RollingMedian(3)))
+#   estimator.start()
+#   ...
+#   (distance, age) = estimator.latest()   # never blocks
+#
+# After pointing the sensor somewhere else, call reset() so readings from the
+# old direction are forgotten; waitFor(n) then returns once n pings were taken
+# from the new one. If the sensor is still turning, reset(after=...) also
+# holds back pings until it gets there. waitFor() returns None when it can't
+# tell (no pings in time, or the thread died), which callers should take as
+# blocked rather than open.
+#
+# While the estimator runs, nothing else may ping the same sensor.
+
+import bisect
+import collections
+import threading
+import time
+from ranging import MAX_RANGE_CM, MIN_PING_INTERVAL
+
+# Filters #
+# Each takes one reading at a time (in cm, with its time in seconds) and
+# returns the current estimate.
+
+# Median of the last `window` readings.
+class RollingMedian:
+    def __init__(self, window=5):
+        self.window = window
+        self.reset()
+
+    def reset(self):
+        self.readings = collections.deque()
+        self.ordered = [] # The same readings, sorted
+
+    def update(self, reading, t):
+        self.readings.append(reading)
+        bisect.insort(self.ordered, reading)
+        if len(self.readings) > self.window:
+            self.ordered.pop(bisect.bisect_left(self.ordered, self.readings.popleft()))
+        middle = len(self.ordered) // 2
+        if len(self.ordered) % 2 == 1:
+            return self.ordered[middle]
+        return (self.ordered[middle - 1] + self.ordered[middle]) / 2
+
+# Passes readings through unless they jump more than `threshold` cm away from
+# the last accepted one. After `maxRejects` rejections in a row the jump is
+# taken to be real (e.g. an obstacle appeared) and accepted.
+class OutlierRejector:
+    def __init__(self, threshold=40, maxRejects=2):
+        self.threshold = threshold
+        self.maxRejects = maxRejects
+        self.reset()
+
+    def reset(self):
+        self.last = None
+        self.rejected = 0
+        self.totalRejected = 0
+
+    def update(self, reading, t):
+        if self.last is not None and abs(reading - self.last) > self.threshold and self.rejected < self.maxRejects:
+            self.rejected += 1
+            self.totalRejected += 1
+            return self.last
+        self.rejected = 0
+        self.last = reading
+        return reading
+
+# 1-D Kalman filter for a distance that drifts as a random walk.
+# @param processNoise -- how much the true distance may change, in cm^2 per
+# second (it grows while the robot drives or the sensor turns).
+# @param measurementNoise -- variance of a single ping, in cm^2.
+class Kalman1D:
+    def __init__(self, processNoise=400.0, measurementNoise=4.0):
+        self.processNoise = processNoise
+        self.measurementNoise = measurementNoise
+        self.reset()
+
+    def reset(self):
+        self.estimate = None
+        self.variance = None
+        self.t = None
+
+    def update(self, reading, t):
+        if self.estimate is None:
+            self.estimate = reading
+            self.variance = self.measurementNoise
+        else:
+            self.variance += self.processNoise * max(0.0, t - self.t) # Predict
+            gain = self.variance / (self.variance + self.measurementNoise)
+            self.estimate += gain * (reading - self.estimate)
+            self.variance *= 1 - gain
+        self.t = t
+        return self.estimate
+
+# Runs each reading through `filters` in order.
+class FilterChain:
+    def __init__(self, *filters):
+        self.filters = filters
+
+    def reset(self):
+        for f in self.filters:
+            f.reset()
+
+    def update(self, reading, t):
+        for f in self.filters:
+            reading = f.update(reading, t)
+        return reading
+
+# Builds a filter from a name: 'none', 'median', 'outlier', 'kalman', or
+# several joined with '+' (e.g. 'outlier+kalman').
+def makeFilter(name):
+    filters = {'median': RollingMedian, 'outlier': OutlierRejector, 'kalman': Kalman1D}
+    if name == 'none':
+        return FilterChain()
+    try:
+        return FilterChain(*[filters[part]() for part in name.split('+')])
+    except KeyError as e:
+        raise ValueError("Unknown distance filter: " + str(e))
+
+# Estimator #
+
+class DistanceEstimator:
+    # @param sensor -- anything with a ping() returning a distance in cm, or None
+    # for a missed echo (an Ultrasonic, or a ranger from ranging.py).
+    # @param interval -- seconds from the start of one ping to the next.
+    def __init__(self, sensor, filter=None, interval=MIN_PING_INTERVAL):
+        self.sensor = sensor
+        self.filter = filter if filter is not None else RollingMedian()
+        self.interval = interval
+        self.condition = threading.Condition()
+        self.estimate = None
+        self.timestamp = None # time.monotonic() of the ping behind the estimate
+        self.samples = 0 # Readings since the last reset()
+        self.misses = 0 # Missed echoes since the last reset()
+        self.generation = 0 # Incremented by reset()
+        self.notBefore = None # time.monotonic() before which not to ping, see reset()
+        self.pings = 0
+        self.missed = 0
+        self.running = False
+        self.pinging = False # Whether the thread is running and hasn't died
+        self.thread = None
+
+    def start(self):
+        if self.thread is not None:
+            return
+        self.running = True
+        self.pinging = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def _run(self):
+        try:
+            self._pingLoop()
+        finally:
+            # Also when ping() raised: nobody should wait for readings that
+            # won't come.
+            with self.condition:
+                self.pinging = False
+                self.condition.notify_all()
+
+    def _pingLoop(self):
+        nextPing = time.monotonic()
+        while self.running:
+            with self.condition:
+                generation = self.generation
+                notBefore = self.notBefore
+            t = time.monotonic()
+            if notBefore is not None and t < notBefore:
+                time.sleep(notBefore - t)
+                continue
+            reading = self.sensor.ping()
+            with self.condition:
+                self.pings += 1
+                if reading is None:
+                    self.missed += 1
+                    if generation == self.generation:
+                        self.misses += 1
+                        self.condition.notify_all()
+                elif generation == self.generation: # Else pinged before a reset()
+                    self.estimate = self.filter.update(reading, t)
+                    self.timestamp = t
+                    self.samples += 1
+                    self.condition.notify_all()
+            # The sensor needs this long for echoes of the last ping to die down.
+            nextPing = max(nextPing + self.interval, time.monotonic())
+            time.sleep(max(0.0, nextPing - time.monotonic()))
+
+    # Returns (distance in cm, seconds since the ping it came from), or
+    # (None, None) if there's been no reading since the last reset(). Never blocks.
+    def latest(self):
+        with self.condition:
+            if self.estimate is None:
+                return (None, None)
+            return (self.estimate, time.monotonic() - self.timestamp)
+
+    # Forgets the current estimate and filter state, e.g. after turning the
+    # sensor. With `after` (a time.monotonic() time, e.g. when the sensor will
+    # have finished turning), no pings start before then.
+    def reset(self, after=None):
+        with self.condition:
+            self.generation += 1
+            self.notBefore = after
+            self.filter.reset()
+            self.estimate = None
+            self.timestamp = None
+            self.samples = 0
+            self.misses = 0
+
+    # Returns the estimate once at least `samples` pings were taken since the
+    # last reset(), or right away if there are enough already. Missed echoes
+    # count as pings but not as readings: the estimate comes from the readings
+    # among them, and only if every one of them missed is it MAX_RANGE_CM
+    # (nothing in range). Returns None if there aren't enough pings within
+    # `timeout` seconds or the thread isn't running.
+    def waitFor(self, samples=1, timeout=1.0):
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while self.samples + self.misses < samples:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not self.pinging:
+                    return None
+                self.condition.wait(remaining)
+            return self.estimate if self.estimate is not None else MAX_RANGE_CM
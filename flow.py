@@ -3,48 +3,83 @@
 import numpy as np 
 import cv2 
 import debugUtils
+import devices
 import math
 import time
+from frameGrabber import FrameGrabber
+
+FOV_HORIZ_DEGREES = 75 # 180 # 62 # Field of view of the camera, in horizontal degrees
+
+MAX_REDETECTS = 10 # Frames in a row computeCentermostFlow() looks for new points in
+
+# Stages of the flow pipeline timed in stats(): reading a frame, turning it
+# into the gray image tracked in, finding corners, tracking them, finding the
+# centermost one, and estimating the rotation.
+STAGES = ('read', 'preprocess', 'detect', 'track', 'select', 'rotation')
 
 # Helper functions #
 
 # Function to return a pair of:
-#   1. closest "K" points to the origin, i.e. [0, 0], in a list `points` of 
-# lists where each list in `points` has 2 elements representing a 2D vector.
-# For example,
+#   1. closest "K" points to the origin, i.e. [0, 0], in `points`: a list of
+# 2D vectors or an array of shape (N, 2), closest first. For example,
 # ```
 # points = [[3, 3], [5, -1], [-2, 4]]
 # K = 2
 # print(closestKPointsToOrigin(points, K)[0])
 # ```
-# will print [[3, 3], [-2, 4]] since those are the 2 closest points to [0, 0], the origin.
-#   2. indices of those items in the list.
+# will print [[ 3.  3.] [-2.  4.]] since those are the 2 closest points to [0, 0], the origin.
+#   2. indices of those points in `points`.
+# With K == 1, the pair is the closest point and its index.
 def closestKPointsToOrigin(points, K):
     if len(points) == 0:
         return None
+    points = np.asarray(points, dtype=float).reshape(-1, 2)
+    distances = np.einsum('ij,ij->i', points, points) # Squared
     if K == 1:
-        best = points[0]
-        bestDist = best[0]**2 + best[1]**2
-        bestIndex = 0
-        for i in range(0, len(points)):
-            p = points[i]
-            #print(p)
-            #print(points)
-            #print(p[0])
-            #print(p[0]**2)
-            #print(best)
-            dist = p[0]**2 + p[1]**2
-            if dist < bestDist:
-                best = p
-                bestDist = dist
-                bestIndex = i
-        return (best, bestIndex)
-    else:
-        # Algorithm from https://www.geeksforgeeks.org/find-k-closest-points-to-the-origin/ ,
-        # with modifications :
-        indicesSorted = np.argsort(points) # https://numpy.org/doc/stable/reference/generated/numpy.argsort.html , https://stackoverflow.com/questions/6422700/how-to-get-indices-of-a-sorted-array-in-python
-        points.sort(key = lambda K: K[0]**2 + K[1]**2)
-        return (points[:K], indicesSorted)
+        bestIndex = int(np.argmin(distances))
+        return (points[bestIndex], bestIndex)
+    # Only the K closest need sorting.
+    K = min(K, len(points))
+    indices = np.argpartition(distances, K - 1)[:K]
+    indices = indices[np.argsort(distances[indices])]
+    return (points[indices], indices)
+
+# Estimates how far the camera turned between two frames from all the points
+# tracked between them, as a pair of:
+#   1. the change in camera angle in radians, positive when the scene moved
+#   right in the image (the camera turned left);
+#   2. a confidence from 0 (no estimate) to 1: the weighted fraction of
+#   points that agree, less if fewer than `minPoints` do.
+# Each point gives its own estimate, the change in the direction it's seen in
+# for a pinhole camera turning about its vertical axis. Estimates further than
+# `rejectMads` median absolute deviations (and `tolerance` pixels) from the
+# median are outliers, e.g. points on something moving or mistracked; the rest
+# are averaged, weighted toward the center of the frame, where the lens
+# distorts least and the ultrasonic sensor points.
+# @param old, new -- the points' pixel positions in the previous and the
+# current frame, arrays of shape (N, 2).
+def estimateRotation(old, new, frameWidth, frameHeight, fov=math.radians(FOV_HORIZ_DEGREES),
+                     rejectMads=3.0, tolerance=1.0, minPoints=10):
+    old = np.asarray(old, dtype=float).reshape(-1, 2)
+    new = np.asarray(new, dtype=float).reshape(-1, 2)
+    if len(old) == 0:
+        return (0.0, 0.0)
+    center = np.array([frameWidth / 2, frameHeight / 2])
+    focal = frameWidth / 2 / math.tan(fov / 2) # In pixels
+    estimates = np.arctan((new[:, 0] - center[0]) / focal) - np.arctan((old[:, 0] - center[0]) / focal)
+
+    median = np.median(estimates)
+    deviations = np.abs(estimates - median)
+    # 1.4826 * MAD is the standard deviation for normally distributed estimates.
+    limit = max(rejectMads * 1.4826 * np.median(deviations), tolerance / focal)
+    inliers = deviations <= limit
+
+    offsets = new - center
+    weights = 1 / (1 + np.einsum('ij,ij->i', offsets, offsets) / (frameWidth / 4) ** 2)
+    inlierWeights = weights[inliers]
+    radians = float(np.average(estimates[inliers], weights=inlierWeights))
+    confidence = float(inlierWeights.sum() / weights.sum()) * min(1.0, np.count_nonzero(inliers) / minPoints)
+    return (radians, confidence)
 
 # Returns the angle in radians between two vectors of any dimension.
 def angleBetween(vector_1, vector_2):
@@ -63,22 +98,98 @@ def angleBetween(vector_1, vector_2):
 def map_(value, istart, istop, ostart, ostop):
     return ostart + (ostop - ostart) * ((value - istart) / (istop - istart))
 
+# Keeps enough corners to track. detect() looks for them in the whole image;
+# once fewer than `threshold` are left, replenish() looks for more only in the
+# cells of a `grid` over the image that have none left (through a mask, so the
+# rest of the image isn't searched again), up to `target` in all.
+class FeatureManager:
+    # @param featureParams -- parameters for cv2.goodFeaturesToTrack; its
+    # maxCorners is the default `target`.
+    # @param grid -- (columns, rows) of cells.
+    def __init__(self, featureParams, target=None, threshold=None, grid=(4, 3)):
+        self.featureParams = dict(featureParams)
+        maxCorners = self.featureParams.pop('maxCorners', 100)
+        self.target = target if target is not None else maxCorners
+        self.threshold = threshold if threshold is not None else self.target // 2
+        self.grid = grid
+        self.detections = 0 # Over the whole image
+        self.replenishments = 0
+        self.added = 0 # Corners added by replenish()
+
+    # Up to `count` (default `target`) corners in `gray`, only where `mask` is
+    # non-zero if given, as an array of shape (N, 1, 2).
+    def detect(self, gray, mask=None, count=None):
+        if mask is None:
+            self.detections += 1
+        corners = cv2.goodFeaturesToTrack(gray, maxCorners=count if count is not None else self.target,
+                                          mask=mask, **self.featureParams)
+        if corners is None:
+            return np.empty((0, 1, 2), np.float32)
+        return corners
+
+    # Returns `points` (shape (N, 1, 2), in `gray`'s pixels), with corners in
+    # the grid's empty cells added if fewer than `threshold` are left.
+    def replenish(self, gray, points):
+        if len(points) >= self.threshold:
+            return points
+        (height, width) = gray.shape[:2]
+        (columns, rows) = self.grid
+        xy = points.reshape(-1, 2)
+        column = np.clip((xy[:, 0] * columns / width).astype(int), 0, columns - 1)
+        row = np.clip((xy[:, 1] * rows / height).astype(int), 0, rows - 1)
+        empty = np.bincount(row * columns + column, minlength=rows * columns).reshape(rows, columns) == 0
+        if not empty.any():
+            return points
+        # Each pixel's cell, looked up in `empty`.
+        cellRows = np.arange(height) * rows // height
+        cellColumns = np.arange(width) * columns // width
+        mask = empty[cellRows[:, None], cellColumns[None, :]].astype(np.uint8) * 255
+        corners = self.detect(gray, mask, self.target - len(points))
+        self.replenishments += 1
+        self.added += len(corners)
+        return np.concatenate([points.reshape(-1, 1, 2), corners]) if len(corners) else points
+
+    def stats(self):
+        return {'detections': self.detections, 'replenishments': self.replenishments, 'added': self.added}
+
 # Optical flow processing class #
 
 class OpticalFlow:
-    def __init__(self, source=0, frame_width=None, frame_height=None, show_debug=False):
+    # @param threaded -- grab frames on a background thread (see
+    # frameGrabber.py), so flow is always computed on the newest frame and
+    # never waits on camera I/O longer than for the next frame.
+    # @param scale -- factor frames are shrunk by before tracking, e.g. 0.5
+    # for half the width and height. Points are still in full-frame pixels.
+    # @param roi -- (x, y, width, height) part of the frame to track in, in
+    # full-frame pixels, or None for the whole frame.
+    # @param timer -- clock for the stage timings in stats(); default
+    # time.perf_counter.
+    # @param minFeatures -- tracked points below which more are looked for in
+    # the parts of the frame that have none left (see FeatureManager); 0 to
+    # only look again once all are lost.
+    def __init__(self, source=0, frame_width=None, frame_height=None, show_debug=False, threaded=False,
+                 scale=1.0, roi=None, timer=None, minFeatures=50):
         #cap = cv2.VideoCapture('sample.mp4')
-        self.cap = cv2.VideoCapture(source)
+        self.cap = devices.camera(source)
         # Set video capture properties
         if frame_width is not None:
             self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, frame_width)
         if frame_height is not None:
             self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, frame_height)
+        self.threaded = threaded
+        if threaded:
+            self.cap = FrameGrabber(self.cap)
+            self.cap.start()
 
         self.source = source
         self.frame_width = frame_width if frame_width is not None else self.cap.get(cv2.CAP_PROP_FRAME_WIDTH)
         self.frame_height = frame_height if frame_height is not None else self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT)
         self.show_debug = show_debug
+        self.scale = scale
+        self.roi = roi
+        # Full-frame position of the tracked image's top left corner
+        self.offset = np.array(roi[:2] if roi is not None else (0, 0), dtype=np.float32)
+        self.timer = timer if timer is not None else time.perf_counter
 
         # Lists holding good points to track
         self.good_new = None
@@ -86,10 +197,22 @@ class OpticalFlow:
         self.averagePoint = None
         
         self.__initializeFlowParams()
+        self.features = FeatureManager(self.feature_params, threshold=minFeatures)
         self.p0 = None
         
         self.angle_ = None
         self.change_ = None
+        self.confidence = None # Of the last computeRadiansOfCameraRotation(), see estimateRotation()
+
+        # time.monotonic() when the current and the previous frame were captured
+        self.frameTime = None
+        self.previousFrameTime = None
+        self.frames = 0
+
+        # Seconds spent in each of STAGES, in total and for the latest frame
+        self.stageTotals = dict.fromkeys(STAGES, 0.0)
+        self.stageCounts = dict.fromkeys(STAGES, 0)
+        self.timings = {}
 
     # Call this before beginning to turn the car. It locks onto feature points 
     # in the camera image which will be tracked while turning. 
@@ -99,29 +222,32 @@ class OpticalFlow:
         self.__setPointChanged(True)
 
         # Take first frame and find corners in it
-        ret, old_frame = self.cap.read() 
+        start = self.timer()
+        ret, old_frame = self.__read()
+        start = self.__timed('read', start)
 
         # Check if frame is not empty
         if not ret:
             print("prepare(): Empty frame")
             return False
 
-        self.old_gray = cv2.cvtColor(old_frame, 
-                                cv2.COLOR_BGR2GRAY)
+        self.old_gray = self.__preprocess(old_frame)
+        start = self.__timed('preprocess', start)
         
         if self.show_debug:
             # Create a mask image for drawing purposes 
             self.mask = np.zeros_like(old_frame) 
 
-        self.p0 = cv2.goodFeaturesToTrack(self.old_gray, mask = None, 
-                                    **self.feature_params) 
+        self.p0 = self.features.detect(self.old_gray)
+        self.__timed('detect', start)
     
     # Compute the last optical flow and return the flow vector at the point
     # that was centermost in the frame (i.e., is in-line with the distance sensor
     # on the RPi).
     # @param reprepare -- indicates whether to prepare again or return False when no tracking
     # points are found in the image anymore or if an empty frame 
-    # is captured. Recommended to keep True.
+    # is captured. Recommended to keep True. Even then, False is returned if
+    # no points are found in MAX_REDETECTS frames in a row (e.g. a blank wall).
     # @param show_debug -- When show_debug was set to True, this method
     # returns True to request exiting the program, or in all cases it may return one of:
     #   1. A pair consisting of:
@@ -139,35 +265,57 @@ class OpticalFlow:
             while self.prepare() == False:
                 self.p0 = None
         
-        # Capture a frame
+        redetects = 0
         while True:
-            ret, frame = self.cap.read() 
-
-            # Check if frame is not empty
-            if not ret:
-                print("computeCentermostFlow(): Empty frame")
-                if not reprepare:
-                    return False
-            else:
+            # Capture a frame
+            start = self.timer()
+            while True:
+                ret, frame = self.__read()
+
+                # Check if frame is not empty
+                if not ret:
+                    print("computeCentermostFlow(): Empty frame")
+                    if not reprepare:
+                        return False
+                else:
+                    break
+
+            start = self.__timed('read', start)
+            frame_gray = self.__preprocess(frame)
+            start = self.__timed('preprocess', start)
+
+            tracked = np.empty((0, 2), np.float32)
+            if len(self.p0) > 0:
+                # calculate optical flow 
+                # https://docs.opencv.org/3.4/dc/d6b/group__video__track.html#ga5d10ebbd59fe09c5f650289ec0ece5af
+                p1, st, err = cv2.calcOpticalFlowPyrLK(self.old_gray, 
+                                                    frame_gray, 
+                                                    self.p0, None, 
+                                                    **self.lk_params) 
+                # `st` is the "status": array of 0 or 1 where a 0 means we lost that point from self.p0,
+                # and 1 means we kept it. (source: https://docs.opencv.org/master/dc/d6b/group__video__track.html#ga473e4b886d0bcc6b65831eb88ed93323 )
+                #if len(err) > 0:
+                #    print("Error in flow: " + str(err)) # This prints often... strange..
+
+                # Select good points 
+                tracked = p1[st == 1]
+                good_new = self.__toFrame(tracked)
+                good_old = self.__toFrame(self.p0[st == 1])
+            self.__timed('track', start)
+            if len(tracked) > 0:
                 break
 
-        frame_gray = cv2.cvtColor(frame, 
-                                cv2.COLOR_BGR2GRAY) 
-    
-        # calculate optical flow 
-        # https://docs.opencv.org/3.4/dc/d6b/group__video__track.html#ga5d10ebbd59fe09c5f650289ec0ece5af
-        p1, st, err = cv2.calcOpticalFlowPyrLK(self.old_gray, 
-                                            frame_gray, 
-                                            self.p0, None, 
-                                            **self.lk_params) 
-        # `st` is the "status": array of 0 or 1 where a 0 means we lost that point from self.p0,
-        # and 1 means we kept it. (source: https://docs.opencv.org/master/dc/d6b/group__video__track.html#ga473e4b886d0bcc6b65831eb88ed93323 )
-        #if len(err) > 0:
-        #    print("Error in flow: " + str(err)) # This prints often... strange..
-
-        # Select good points 
-        good_new = p1[st == 1] 
-        good_old = self.p0[st == 1] 
+            # No points left: look for new ones in this frame and track them
+            # into the next one.
+            self.__setPointChanged(True)
+            print("computeCentermostFlow(): Re-prepare needed")
+            if not reprepare or redetects == MAX_REDETECTS:
+                return False
+            redetects += 1
+            start = self.timer()
+            self.old_gray = frame_gray
+            self.p0 = self.features.detect(frame_gray)
+            self.__timed('detect', start)
 
 
         if self.show_debug:
@@ -231,33 +379,29 @@ class OpticalFlow:
             #    self.__setPointChanged(False)
         except TypeError: # "TypeError: object of type 'NoneType' has no len()"
             self.__setPointChanged(True)
-        
-        # Check if we have any points left:
-        if len(good_new) == 0:
-            self.__setPointChanged(True)
-            print("computeCentermostFlow(): Re-prepare needed")
-            if not reprepare:
-                return False
-            while self.prepare() == False:
-                self.p0 = None
-            return self.computeCentermostFlow(reprepare)
 
         # Find centermost point:
+        start = self.timer()
         # Translate all points to be centered
         # in the frame, i.e. relative to width/2, height/2 as the origin.
-        good_new_centered = map(lambda l: [l[0] - self.frame_width / 2, 
-                                           l[1] - self.frame_height / 2], good_new)
-        (centermost, centermostIndex) = closestKPointsToOrigin(list(good_new_centered), 1)
+        good_new_centered = good_new - (self.frame_width / 2, self.frame_height / 2)
+        (centermost, centermostIndex) = closestKPointsToOrigin(good_new_centered, 1)
 
         # Updating Previous frame and points  
-        self.old_gray = frame_gray.copy() 
+        self.old_gray = frame_gray # A new image every frame, so no need to copy it
         #print(self.p0)
-        self.p0 = good_new.reshape(-1, 1, 2) # Adds a layer of lists.. why?
+        self.p0 = tracked.reshape(-1, 1, 2) # Adds a layer of lists.. why?
         #print("Reshaped: " + str(self.p0))
 
         self.good_new = good_new
         self.good_old = good_old
-        return (centermost, np.subtract(centermost, good_old[centermostIndex]))
+        start = self.__timed('select', start)
+
+        # Top up points lost along the way, for the next frame.
+        if len(self.p0) < self.features.threshold:
+            self.p0 = self.features.replenish(frame_gray, self.p0)
+            self.__timed('detect', start)
+        return (centermost, np.subtract(good_new[centermostIndex], good_old[centermostIndex]))
 
     # Given a point, this returns how close it is to the center, i.e. how "reliable" it is
     # to use in distance sensor calculations.
@@ -267,11 +411,10 @@ class OpticalFlow:
     
     # Returns the change in camera angle in radians since the last call to
     # reset(). Calls to this function must be after having called
-    # computeCentermostFlow() at least once.
+    # computeCentermostFlow() at least once. Sets self.confidence.
     def computeRadiansOfCameraRotation(self, sensorDistance, flowVector):
         # Constants
-        fovHorizDegrees = 75 # 180 # 62 # Field of view of the camera, in horizontal degrees
-        fovHoriz = math.radians(fovHorizDegrees) # Converted to radians
+        fovHoriz = math.radians(FOV_HORIZ_DEGREES) # Converted to radians
 
         if False:
             # Flow/velocity method #
@@ -292,47 +435,87 @@ class OpticalFlow:
 
             print("Change in angle: " + str(math.degrees(angleChange)) + " degrees")
             return angleChange
-        elif True:
-            # Point position method: average all movement of all points #
-
-            newAveragePoint = 0
-            m=1#len(self.good_old)
-            for i in range(0, m):
-                # Check how much this point has moved
-                pnew = self.good_new[i]
-                pold = self.good_old[i]
-                newAveragePoint = np.add(newAveragePoint, np.subtract(pnew, pold))
-            newAveragePoint = np.divide(newAveragePoint, m)
-
-            changeInAvg = np.subtract(self.good_new[0], self.good_old[0] )
-             #   self.averagePoint if self.averagePoint is not None else newAveragePoint)
-            # Get the angle using the field of view of the camera
-            print_("changeInAvg: " + str(changeInAvg))
-            self.change_ = changeInAvg
-            # Range of the first value is provided in the second argument here:
-            angleChange = map_(changeInAvg[0], 
-                                0, self.frame_width,
-                                0, fovHoriz)
-            # `angle` is now from range -fovHoriz / 2 to fovHoriz / 2.
+        else:
+            # Point position method: the movement of all points, robustly #
+
+            start = self.timer()
+            (angleChange, self.confidence) = estimateRotation(self.good_old, self.good_new,
+                                                              self.frame_width, self.frame_height, fovHoriz)
+            self.__timed('rotation', start)
+            # For the debug window:
+            self.change_ = np.median(self.good_new - self.good_old, axis=0)
+            print_("change: " + str(self.change_))
 
             # Adjust self.averagePoint:
-            self.averagePoint = newAveragePoint
+            self.averagePoint = np.mean(self.good_new - self.good_old, axis=0)
 
-            print_("Change in angle: " + str(math.degrees(angleChange)) + " degrees")
+            print_("Change in angle: " + str(math.degrees(angleChange)) + " degrees" +
+                   " (confidence " + str(self.confidence) + ")")
             return angleChange
         
 
     # Indicates the current frame sequence is no longer being considered.
     def reset(self):
         self.__setPointChanged(True)
+
+    # Frames read, mean milliseconds per stage, and the frames per second
+    # the pipeline could keep up without waiting for the camera.
+    def stats(self):
+        stats = {
+            'frames': self.frames,
+            'features': self.features.stats(),
+            'stage_ms': {stage: self.stageTotals[stage] / self.stageCounts[stage] * 1000
+                         for stage in STAGES if self.stageCounts[stage]},
+        }
+        processing = sum(self.stageTotals[stage] for stage in STAGES if stage != 'read')
+        stats['processing_fps'] = self.frames / processing if processing > 0 else None
+        if self.threaded:
+            stats.update(self.cap.stats())
+        return stats
     
     # Private methods #
 
-    # "Destructor": called upon garbage collection of this object.
+    # "Destructor": called upon garbage collection of this object. The camera
+    # comes from devices.camera() and is shared with any other OpticalFlow on
+    # the same source, so only the frame grabber made here is stopped.
     def __del__(self):
         if self.show_debug:
             cv2.destroyAllWindows() 
-        self.cap.release()
+        if self.threaded:
+            self.cap.stop()
+
+    # Adds the time since `start` to `stage` and returns the time now.
+    def __timed(self, stage, start):
+        now = self.timer()
+        self.timings[stage] = now - start
+        self.stageTotals[stage] += now - start
+        self.stageCounts[stage] += 1
+        return now
+
+    # The gray image to track in: the ROI of `frame`, shrunk by self.scale.
+    def __preprocess(self, frame):
+        if self.roi is not None:
+            (x, y, width, height) = self.roi
+            frame = frame[y:y + height, x:x + width] # A view, not a copy
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        if self.scale != 1.0:
+            gray = cv2.resize(gray, None, fx=self.scale, fy=self.scale, interpolation=cv2.INTER_AREA)
+        return gray
+
+    # Points in the tracked image to full-frame pixels.
+    def __toFrame(self, points):
+        if self.scale == 1.0 and self.roi is None:
+            return points
+        return points / self.scale + self.offset
+
+    # Reads a frame and notes when it was captured.
+    def __read(self):
+        ret, frame = self.cap.read()
+        if ret:
+            self.previousFrameTime = self.frameTime
+            self.frameTime = self.cap.frameTime if self.threaded else time.monotonic()
+            self.frames += 1
+        return (ret, frame)
 
     def __initializeFlowParams(self):
         # params for corner detection 
@@ -341,9 +524,12 @@ class OpticalFlow:
                             minDistance = 7, 
                             blockSize = 7 ) 
         
-        # Parameters for lucas kanade optical flow 
+        # Parameters for lucas kanade optical flow. Each halving of the scale
+        # drops a pyramid level: the same window then covers as much movement
+        # in full-frame pixels with less work.
+        levels = max(0, 2 - int(round(math.log2(1 / self.scale))))
         self.lk_params = dict( winSize = (15, 15), 
-                        maxLevel = 2, 
+                        maxLevel = levels, 
                         criteria = (cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 
                                     10, 0.03)) 
         
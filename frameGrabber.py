@@ -0,0 +1,131 @@
+# Camera frames grabbed on a background thread. The thread reads frames as
+# fast as the camera delivers them into a small ring buffer, so the driver's
+# own queue never fills up with stale frames, and whoever uses them gets the
+# newest one without waiting on camera I/O:
+#
+#   grabber = FrameGrabber(devices.camera())
+#   grabber.start()
+#   (ret, frame) = grabber.read()     # newest frame not handed out yet
+#   print(grabber.frameTime)          # time.monotonic() when it was captured
+#
+# It has the same read/get/set/isOpened/release as a cv2.VideoCapture, so it
+# can be used in place of one. Frames replaced by newer ones before anyone
+# read them are counted as dropped in stats().
+
+import collections
+import threading
+import time
+
+ERROR_RETRY = 0.01 # Seconds to wait after a failed read before trying again
+
+class FrameGrabber:
+    # @param capture -- a cv2.VideoCapture, or anything with the same
+    # read/get/set/isOpened/release (see devices.camera()).
+    # @param capacity -- frames kept in the ring buffer.
+    # @param timeout -- seconds read() waits for a new frame before giving up.
+    def __init__(self, capture, capacity=2, timeout=1.0):
+        self.capture = capture
+        self.timeout = timeout
+        self.condition = threading.Condition()
+        self.frames = collections.deque(maxlen=capacity) # (time.monotonic(), number, frame)
+        self.frameTime = None # time.monotonic() the last frame read() returned was captured at
+        # Since start():
+        self.grabbed = 0 # Frames read from the camera; also the latest frame's number
+        self.delivered = 0 # Frames handed out by read()
+        self.lastDelivered = 0 # Number of the last frame handed out
+        self.dropped = 0 # Frames never handed out because a newer one came first
+        self.errors = 0 # Failed reads
+        self.started = None
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        if self.thread is not None:
+            return
+        with self.condition:
+            # Counted from here on, without the stale frames of a previous run.
+            self.frames.clear()
+            self.grabbed = self.delivered = self.lastDelivered = self.dropped = self.errors = 0
+        self.running = True
+        self.started = time.monotonic()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        with self.condition:
+            self.condition.notify_all()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def _run(self):
+        while self.running:
+            (ret, frame) = self.capture.read()
+            t = time.monotonic()
+            with self.condition:
+                if ret:
+                    self.grabbed += 1
+                    self.frames.append((t, self.grabbed, frame))
+                    self.condition.notify_all()
+                else:
+                    self.errors += 1
+            if not ret:
+                time.sleep(ERROR_RETRY)
+
+    # Returns (True, frame) for the newest frame that hasn't been handed out
+    # yet, waiting for the next one if they all have; (False, None) if none
+    # comes within `timeout` seconds (default: the grabber's). Sets frameTime.
+    def read(self, timeout=None):
+        deadline = time.monotonic() + (self.timeout if timeout is None else timeout)
+        with self.condition:
+            while not self.frames or self.frames[-1][1] == self.lastDelivered:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not self.running:
+                    return (False, None)
+                self.condition.wait(remaining)
+            (t, number, frame) = self.frames[-1]
+            self.dropped += number - self.lastDelivered - 1
+            self.lastDelivered = number
+            self.delivered += 1
+            self.frameTime = t
+            return (True, frame)
+
+    # Returns (frame, time.monotonic() it was captured at) of the newest frame,
+    # whether it was handed out already or not, or (None, None). Never blocks.
+    def latest(self):
+        with self.condition:
+            if not self.frames:
+                return (None, None)
+            (t, number, frame) = self.frames[-1]
+            return (frame, t)
+
+    # Copy of the ring buffer: [(time.monotonic(), frame)], oldest first.
+    def recent(self):
+        with self.condition:
+            return [(t, frame) for (t, number, frame) in self.frames]
+
+    def get(self, propId):
+        return self.capture.get(propId)
+
+    def set(self, propId, value):
+        return self.capture.set(propId, value)
+
+    def isOpened(self):
+        return self.capture.isOpened()
+
+    def release(self):
+        self.stop()
+        self.capture.release()
+
+    def stats(self):
+        with self.condition:
+            elapsed = time.monotonic() - self.started if self.started is not None else 0.0
+            return {
+                'grabbed': self.grabbed,
+                'delivered': self.delivered,
+                'dropped': self.dropped,
+                'errors': self.errors,
+                'grab_fps': self.grabbed / elapsed if elapsed > 0 else None,
+                'latest_age_seconds': time.monotonic() - self.frames[-1][0] if self.frames else None,
+            }
@@ -0,0 +1,210 @@
+# Heading from several sensors at once. A Kalman filter tracks the heading
+# and the turn rate. Sensors report a turn rate whenever they have one, at
+# whatever rate they run. When the turn rate the motors are asked for
+# changes, the estimate changes with it, and without sensors saying
+# otherwise it drifts back to it:
+#
+#   fusion = HeadingFusion()
+#   sampler = ImuSampler(devices.imu(), onSample=fusion.gyro)   # 500 Hz
+#   ...
+#   fusion.command(t, speed * 360)                               # when the motors change
+#   fusion.update('flow', t, degreesPerSecond)                   # ~30 Hz
+#   print(fusion.heading(), fusion.rate())
+#
+# Readings that disagree too much with the estimate (more than `gate`
+# standard deviations) are rejected. A sensor that is rejected `maxRejects`
+# times in a row, or hasn't reported for `timeout` seconds, is unhealthy;
+# while any other sensor is healthy, its readings keep being rejected until
+# one agrees again. With no other healthy sensor, the jump is taken to be
+# real and accepted, like OutlierRejector in distanceEstimator.py. With no
+# sensor at all, the heading comes from the commanded turn rate alone.
+#
+# Angles are in degrees and clockwise positive, like turn angles.
+
+import math
+import threading
+import time
+import numpy as np
+from turnController import HeadingSource
+
+# How much a sensor's turn rate is off, in degrees per second.
+class SensorModel:
+    def __init__(self, noise, timeout=0.5, gate=3.0, maxRejects=10):
+        self.noise = noise
+        self.timeout = timeout
+        self.gate = gate
+        self.maxRejects = maxRejects
+
+# The MPU6050 and optical flow from flow.py. The gyro's bias isn't estimated
+# here: ImuSampler already takes it out, and with nothing but the commanded
+# turn rate to compare against, a bias estimate soaks up real slow turning
+# (e.g. from mismatched wheels while driving straight).
+DEFAULT_SENSORS = {
+    'gyro': SensorModel(0.5, timeout=0.05),
+    'flow': SensorModel(150.0, timeout=0.2),
+}
+
+class SensorState:
+    def __init__(self, model):
+        self.model = model
+        self.H = np.array([0.0, 1.0])
+        self.R = model.noise ** 2
+        self.enabled = True
+        self.updates = 0
+        self.rejected = 0
+        self.rejectedInARow = 0
+        self.first = None
+        self.last = None
+
+class HeadingFusion:
+    # @param sensors -- {name: SensorModel}.
+    # @param rateNoise -- how quickly the turn rate can change by itself, in
+    # degrees per second per square root second.
+    # @param reversion -- time constant in seconds of the turn rate going
+    # back to the commanded one.
+    # @param stepUncertainty -- fraction of a change in the commanded turn
+    # rate that the real change may be off by (the motors take a moment and
+    # don't turn exactly as fast as asked).
+    def __init__(self, sensors=DEFAULT_SENSORS, rateNoise=30.0, reversion=0.1, stepUncertainty=0.2):
+        self.sensors = {name: SensorState(model) for name, model in sensors.items()}
+        self.rateNoise = rateNoise
+        self.reversion = reversion
+        self.stepUncertainty = stepUncertainty
+        self.lock = threading.Lock()
+        self.x = np.zeros(2) # Heading, turn rate
+        self.P = np.diag([0.0, 100.0])
+        self.commanded = 0.0 # Degrees per second
+        self.commands = 0
+        self.t = None
+
+    # The state `dt` seconds on, without the noise: (F, u) for F @ x + u.
+    def _transition(self, dt):
+        decay = math.exp(-dt / self.reversion)
+        follow = self.reversion * (1 - decay)
+        F = np.array([[1.0, follow], [0.0, decay]])
+        u = np.array([dt - follow, 1 - decay]) * self.commanded
+        return (F, u)
+
+    # Moves the estimate forward to time `t`.
+    def _predict(self, t):
+        if self.t is None:
+            self.t = t
+            return
+        dt = t - self.t
+        if dt <= 0:
+            return # Late readings are applied at the current time
+        (F, u) = self._transition(dt)
+        q = self.rateNoise ** 2
+        Q = np.array([[q * dt ** 3 / 3, q * dt ** 2 / 2],
+                      [q * dt ** 2 / 2, q * dt]])
+        self.x = F @ self.x + u
+        self.P = F @ self.P @ F.T + Q
+        self.t = t
+
+    def _healthy(self, state, t):
+        return state.enabled and state.last is not None and t - state.last <= state.model.timeout and \
+            state.rejectedInARow < state.model.maxRejects
+
+    # The motors were asked to turn at `rate` degrees per second from
+    # time.monotonic() time `t` on.
+    def command(self, t, rate):
+        with self.lock:
+            self._predict(t)
+            step = rate - self.commanded
+            self.x[1] += step
+            self.P[1, 1] += (step * self.stepUncertainty) ** 2
+            self.commanded = rate
+            self.commands += 1
+
+    # Takes sensor `name`'s turn rate `value` (degrees per second) measured
+    # at time.monotonic() time `t`. Returns whether it was used.
+    def update(self, name, t, value):
+        state = self.sensors[name]
+        if not state.enabled:
+            return False
+        with self.lock:
+            self._predict(t)
+            if state.first is None:
+                state.first = t
+            state.last = t
+            y = value - state.H @ self.x
+            PH = self.P @ state.H
+            S = state.H @ PH + state.R
+            if y * y > state.model.gate ** 2 * S:
+                state.rejectedInARow += 1
+                others = any(self._healthy(other, t) for other in self.sensors.values() if other is not state)
+                if state.rejectedInARow < state.model.maxRejects or others:
+                    state.rejected += 1
+                    return False
+            state.rejectedInARow = 0
+            state.updates += 1
+            K = PH / S
+            self.x = self.x + K * y
+            self.P = self.P - np.outer(K, PH)
+            return True
+
+    # For ImuSampler's onSample.
+    def gyro(self, t, rate):
+        self.update('gyro', t, rate)
+
+    # Drops or brings back a sensor.
+    def setEnabled(self, name, enabled):
+        self.sensors[name].enabled = enabled
+
+    # Degrees turned since the estimate started, at time `t` (default now).
+    def heading(self, t=None):
+        with self.lock:
+            if self.t is None:
+                return 0.0
+            t = time.monotonic() if t is None else t
+            (F, u) = self._transition(max(0.0, t - self.t))
+            return F[0] @ self.x + u[0]
+
+    # Degrees per second.
+    def rate(self):
+        with self.lock:
+            return self.x[1]
+
+    def health(self, t=None):
+        t = time.monotonic() if t is None else t
+        with self.lock:
+            return {name: {
+                'healthy': self._healthy(state, t),
+                'enabled': state.enabled,
+                'updates': state.updates,
+                'rejected': state.rejected,
+                'hz': (state.updates + state.rejected - 1) / (state.last - state.first)
+                    if state.last is not None and state.last > state.first else None,
+                'age_seconds': t - state.last if state.last is not None else None,
+            } for name, state in self.sensors.items()}
+
+# A HeadingSource for TurnController from a HeadingFusion that is fed the
+# gyro elsewhere (see ImuSampler's onSample). Tells it the turn rate the
+# motors are asked for, from `degreesPerSecond` at full speed, and feeds it
+# optical flow's rotation if `flow` is given (every heading() then waits for
+# a camera frame).
+class FusedHeading(HeadingSource):
+    def __init__(self, fusion, degreesPerSecond=360, flow=None):
+        self.fusion = fusion
+        self.degreesPerSecond = degreesPerSecond
+        self.flow = flow
+        self.start = 0.0
+
+    def reset(self):
+        if self.flow is not None:
+            self.flow.prepare()
+        self.start = self.fusion.heading()
+
+    def heading(self):
+        if self.flow is not None:
+            flow = self.flow.computeCentermostFlow()
+            (previous, current) = (self.flow.previousFrameTime, self.flow.frameTime)
+            if isinstance(flow, tuple) and previous is not None and current > previous:
+                # Same sign as FlowHeading's; over the time between the two
+                # frames' captures.
+                radians = self.flow.computeRadiansOfCameraRotation(None, flow[1])
+                self.fusion.update('flow', current, -math.degrees(radians) / (current - previous))
+        return self.fusion.heading() - self.start
+
+    def command(self, speed):
+        self.fusion.command(time.monotonic(), speed * self.degreesPerSecond)
@@ -0,0 +1,137 @@
+# Gyro sampling on a background thread at a fixed rate. At start() the gyro's
+# bias is measured while the car stands still; after that every sample is
+# bias-corrected, integrated into the heading with its own time step, and
+# kept in a ring buffer:
+#
+#   sampler = ImuSampler(devices.imu())
+#   sampler.start()                  # blocks for the calibration
+#   start = sampler.heading()
+#   ...
+#   turned = sampler.heading() - start   # degrees, clockwise positive
+#
+# heading() and rate() only read the latest values, so they're cheap enough
+# to call in a control loop.
+
+import collections
+import math
+import threading
+import time
+
+SAMPLE_RATE = 500 # Hz
+CALIBRATION_TIME = 1.0 # Seconds of standing still to measure the bias over
+
+class ImuSampler:
+    # @param imu -- anything with a `.gyro` of (x, y, z) in rad/s, z
+    # counter-clockwise positive (an adafruit_mpu6050.MPU6050, see devices.imu()).
+    # @param capacity -- samples kept in the ring buffer.
+    # @param onSample -- called as onSample(time, degrees/s) on the sampling
+    # thread for every sample, e.g. HeadingFusion.gyro.
+    def __init__(self, imu, rate=SAMPLE_RATE, capacity=4096, calibrationTime=CALIBRATION_TIME, onSample=None):
+        self.imu = imu
+        self.onSample = onSample
+        self.period = 1.0 / rate
+        self.calibrationTime = calibrationTime
+        self.lock = threading.Lock()
+        self.samples = collections.deque(maxlen=capacity) # (time.monotonic(), degrees/s, heading)
+        self.bias = 0.0 # rad/s
+        self.noise = 0.0 # Standard deviation of the calibration samples, rad/s
+        self.currentHeading = 0.0 # Degrees, clockwise positive
+        self.currentRate = 0.0 # Degrees per second, clockwise positive
+        self.count = 0
+        self.dropped = 0 # Sample times missed because the thread ran late
+        self.errors = 0 # Failed reads
+        self.started = None
+        self.running = False
+        self.thread = None
+
+    # Measures the bias (the car must stand still), then starts sampling.
+    def start(self):
+        if self.thread is not None:
+            return
+        self.calibrate()
+        self.running = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def calibrate(self):
+        readings = []
+        deadline = time.monotonic() + self.calibrationTime
+        while time.monotonic() < deadline:
+            try:
+                readings.append(self.imu.gyro[2])
+            except OSError:
+                self.errors += 1
+            time.sleep(self.period)
+        if readings:
+            self.bias = sum(readings) / len(readings)
+            self.noise = math.sqrt(sum((r - self.bias) ** 2 for r in readings) / len(readings))
+
+    def _run(self):
+        last = None # (time, rate) of the previous sample
+        nextSample = time.monotonic()
+        self.started = nextSample
+        while self.running:
+            try:
+                z = self.imu.gyro[2]
+            except OSError:
+                z = None
+                self.errors += 1
+            t = time.monotonic()
+            if z is not None:
+                rate = -math.degrees(z - self.bias) # Clockwise positive, like turn angles
+                with self.lock:
+                    if last is not None:
+                        # Trapezoidal rule over this sample's own time step.
+                        self.currentHeading += (last[1] + rate) / 2 * (t - last[0])
+                    self.currentRate = rate
+                    self.count += 1
+                    self.samples.append((t, rate, self.currentHeading))
+                last = (t, rate)
+                if self.onSample is not None:
+                    self.onSample(t, rate)
+
+            nextSample += self.period
+            now = time.monotonic()
+            if now > nextSample + self.period:
+                # Too late for one or more samples: skip them instead of bunching up.
+                missed = int((now - nextSample) / self.period)
+                self.dropped += missed
+                nextSample += missed * self.period
+            time.sleep(max(0.0, nextSample - time.monotonic()))
+
+    # Degrees turned since start(), clockwise positive.
+    def heading(self):
+        with self.lock:
+            return self.currentHeading
+
+    # Latest turn rate in degrees per second, clockwise positive.
+    def rate(self):
+        with self.lock:
+            return self.currentRate
+
+    # Copy of the ring buffer: [(time.monotonic(), degrees/s, heading)].
+    def history(self):
+        with self.lock:
+            return list(self.samples)
+
+    def stats(self):
+        with self.lock:
+            recent = (len(self.samples) - 1) / (self.samples[-1][0] - self.samples[0][0]) \
+                if len(self.samples) > 1 and self.samples[-1][0] > self.samples[0][0] else None
+            elapsed = time.monotonic() - self.started if self.started is not None else 0.0
+            return {
+                'samples': self.count,
+                'dropped': self.dropped,
+                'errors': self.errors,
+                'target_hz': 1.0 / self.period,
+                'mean_hz': self.count / elapsed if elapsed > 0 else None,
+                'recent_hz': recent,
+                'bias_degrees_per_second': math.degrees(self.bias),
+                'noise_degrees_per_second': math.degrees(self.noise),
+            }
@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import asyncio
+import time
+from .commands import *
+from .utils import *
+from .fanout import *
+from .pathstore import PathStreams
+from .telemetry import TELEMETRY_PORT, startTelemetry
+
+# An asyncio version of the relay in server.py. Instead of one thread per
+# connection, every connection is a coroutine on a single event loop, so
+# idle connections cost no CPU and no thread stacks. The wire protocol is the
+# same as for ClientThread: see NetworkCommand in commands.py.
+#
+# Sources for some of this code:
+# https://docs.python.org/3/library/asyncio-stream.html
+
+# Largest ASCII header field we accept (command number or payload length).
+# Anything longer than this is not a valid command.
+MAX_HEADER_FIELD = 20
+
+RECV_BUFSIZE = 65536  # maximum amount of data to be received at a time
+
+# Bytes the transport may buffer for one client before its writer task waits;
+# past that, messages pile up in the client's SendQueue instead.
+WRITE_BUFFER_LIMIT = 65536
+
+# Represents a single client connected to the asyncio server.
+class AsyncClientConnection:
+    def __init__(self, server, reader, writer):
+        self.server = server
+        self.reader = reader
+        self.writer = writer
+        address = writer.get_extra_info('peername')
+        self.clientsocket_str = '%s:%d' % (address[0], address[1])
+
+        # Messages waiting to be written, and whether the writer task should look.
+        self.queue = SendQueue(server.maxQueued, server.policy)
+        self.hasQueued = asyncio.Event()
+        self.writer.transport.set_write_buffer_limits(high=WRITE_BUFFER_LIMIT)
+
+        self.channel = None # Set by the server's ChannelIndex
+
+        # Car path that was uploaded, as the encoded bytes of its payload.
+        # (Copied out of the decoder since its payload views are temporary.)
+        self.path = None
+
+    # Writes queued messages, waiting whenever the transport's buffer is full.
+    async def _writeQueued(self):
+        try:
+            while True:
+                await self.hasQueued.wait()
+                self.hasQueued.clear()
+                while True:
+                    message = self.queue.pop()
+                    if message is None:
+                        break
+                    self.writer.write(message)
+                    await self.writer.drain()
+        except ConnectionError:
+            self.writer.close() # Ends run() too
+
+    # main loop: receive/send data from this client
+    async def run(self):
+        decoder = FrameDecoder(RECV_BUFSIZE, MAX_HEADER_FIELD)
+        writerTask = asyncio.ensure_future(self._writeQueued())
+        try:
+            while True:
+                data = await self.reader.read(RECV_BUFSIZE)
+                if len(data) == 0:
+                    break # Disconnected
+                decoder.feed(data)
+                for command, payload in decoder:
+                    self._do_stuff(payload, command)
+        except ConnectionError:
+            pass # Disconnected
+        except Exception as e:
+            print('AsyncClientConnection', self.clientsocket_str, 'error:', e)
+        finally:
+            writerTask.cancel()
+            self.server.removeClient(self)
+            self.writer.close()
+
+    def _do_stuff(self, dataRest, command):
+        if command == NetworkCommand.uploadPath:
+            pass
+        elif command == NetworkCommand.joinChannel:
+            self.server.channels.join(self, decodeChannelName(dataRest))
+            self.send(makeChannelCommand(NetworkCommand.channelJoined, self.channel))
+            self.server.sendLatestPath(self)
+            return
+        elif command == NetworkCommand.uploadSegment:
+            self.server.receiveSegments(bytes(dataRest), self)
+            return
+        else:
+            print("Error: the command", command, "cannot be issued to a server")
+            return
+
+        self.path = bytes(dataRest)
+        if self.server.pathStore is not None:
+            version = self.server.pathStore.append(self.path, self.channel)
+            print("Stored path version", version, "in channel", repr(self.channel))
+
+        # We have received uploadPath so now we send a setPath to all clients
+        # in the sender's channel except the sender. The payload is forwarded as-is.
+        self.server.broadcast(makeCommand(NetworkCommand.setPath, self.path), self, self.channel)
+
+    # Queues `replyBytes` to be sent. Never blocks; a client that can't keep up
+    # loses old messages or is disconnected, depending on the server's policy.
+    def send(self, replyBytes):
+        try:
+            self.queue.put(replyBytes)
+            self.hasQueued.set()
+        except SlowConsumerException:
+            print("Disconnecting slow client", self.clientsocket_str)
+            self.server.removeClient(self)
+            self.writer.transport.abort()
+
+class AsyncRelayServer:
+    def __init__(self, host='', port=8080, backlog=1024, pathStore=None,
+                 maxQueued=16, policy=DROP_OLDEST, telemetryHub=None, telemetryPort=TELEMETRY_PORT):
+        if policy not in BACKPRESSURE_POLICIES:
+            raise ValueError("Unknown backpressure policy: " + str(policy))
+        self.host = host
+        self.port = port
+        self.backlog = backlog
+        self.maxQueued = maxQueued
+        self.policy = policy
+        self.pathStore = pathStore # Optional PathStore of uploaded paths
+        self.allClients = set()
+        self.channels = ChannelIndex()
+        self.streams = PathStreams()
+        self.server = None
+        # Optional TelemetryHub, served over UDP on telemetryPort.
+        self.telemetryHub = telemetryHub
+        self.telemetryPort = telemetryPort
+        self.telemetryTransport = None
+
+    async def _handleConnection(self, reader, writer):
+        client = AsyncClientConnection(self, reader, writer)
+        self.allClients.add(client)
+        self.channels.join(client, DEFAULT_CHANNEL)
+        # Give a newly connected robot the latest path right away.
+        self.sendLatestPath(client)
+        await client.run()
+
+    def removeClient(self, client):
+        self.allClients.discard(client)
+        self.channels.leave(client)
+
+    # Sends the path being streamed in the client's channel so far, or else the
+    # latest stored path of the channel, if there is one.
+    def sendLatestPath(self, client):
+        streamed = self.streams.current(client.channel)
+        if streamed is not None:
+            client.send(makeSegmentCommand(NetworkCommand.setSegment, 0, streamed))
+            return
+        latest = self.pathStore.latest(client.channel) if self.pathStore is not None else None
+        if latest is not None:
+            (version, payload) = latest
+            client.send(makeCommand(NetworkCommand.setPath, payload))
+
+    # Forwards a chunk of a path streamed by `sender` to the rest of its channel,
+    # and stores the path once it's complete.
+    def receiveSegments(self, chunk, sender):
+        try:
+            start, segments, final = decodeSegmentChunk(chunk)
+            path = self.streams.add(sender.channel, start, segments, final)
+        except PathFormatException as e:
+            print("Error: bad segment chunk from", sender.clientsocket_str + ":", e)
+            return
+        self.broadcast(makeCommand(NetworkCommand.setSegment, chunk), sender, sender.channel)
+        if path is not None and self.pathStore is not None:
+            version = self.pathStore.append(encodePath(path), sender.channel)
+            print("Stored streamed path version", version, "in channel", repr(sender.channel))
+
+    # Sends `replyBytes` to every client in `channel` except `sender`.
+    def broadcast(self, replyBytes, sender=None, channel=DEFAULT_CHANNEL):
+        for client in list(self.channels.members(channel)):
+            if client is not sender:
+                client.send(replyBytes)
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._handleConnection,
+                                                 self.host, self.port,
+                                                 backlog=self.backlog)
+        # If port 0 was given the OS picked one for us.
+        self.port = self.server.sockets[0].getsockname()[1]
+        if self.telemetryHub is not None:
+            self.telemetryTransport = await startTelemetry(self.telemetryHub, self.host, self.telemetryPort)
+            print("Telemetry on UDP port", self.telemetryTransport.get_extra_info('sockname')[1])
+        return self.server
+
+    async def serveForever(self):
+        if self.server is None:
+            await self.start()
+        print("Waiting for connections on port", self.port, "...")
+        async with self.server:
+            await self.server.serve_forever()
+
+    def close(self):
+        if self.server is not None:
+            self.server.close()
+        if self.telemetryTransport is not None:
+            self.telemetryTransport.close()
+        for client in list(self.allClients):
+            client.writer.close()
+
+    # Closes the server and waits for every connection handler to finish.
+    async def shutdown(self, timeout=5):
+        self.close()
+        deadline = time.monotonic() + timeout
+        while len(self.allClients) > 0 and time.monotonic() < deadline:
+            await asyncio.sleep(0.01)
+
+def main(host='', port=8080, pathStore=None, maxQueued=16, policy=DROP_OLDEST,
+         telemetryHub=None, telemetryPort=TELEMETRY_PORT):
+    try:
+        asyncio.run(AsyncRelayServer(host, port, pathStore=pathStore,
+                                     maxQueued=maxQueued, policy=policy,
+                                     telemetryHub=telemetryHub,
+                                     telemetryPort=telemetryPort).serveForever())
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Loopback benchmark of the relay. Starts networking.server on localhost in its
+# own process, connects N receiving Clients and one uploading Client, and
+# measures:
+#   - upload-to-delivery latency (p50/p95/p99) with one path in flight at a time,
+#   - relay throughput (paths/sec and MB/sec delivered) when uploading as fast
+#     as possible,
+#   - the server's CPU time and memory per connection.
+# Results are written as JSON so runs can be compared, e.g.
+#   python -m networking.benchmark --clients 100 --segments 500 --output before.json
+#   python -m networking.benchmark --clients 100 --segments 500 --async --output after.json
+
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import time
+from .commands import *
+from .client import Client
+from .pathcodec import *
+
+# Server process statistics #
+
+def readProcessStats(pid):
+    # Returns (CPU seconds, resident memory in bytes), or (None, None) if /proc
+    # isn't available (i.e. not on Linux).
+    try:
+        with open('/proc/%d/stat' % pid) as f:
+            # Fields after the command name, which may contain spaces.
+            fields = f.read().rsplit(')', 1)[1].split()
+        ticks = os.sysconf('SC_CLK_TCK')
+        cpu = (int(fields[11]) + int(fields[12])) / ticks # utime + stime
+        with open('/proc/%d/status' % pid) as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return cpu, int(line.split()[1]) * 1024
+        return cpu, None
+    except (OSError, ValueError, IndexError):
+        return None, None
+
+def waitForServer(port, process, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise Exception("Server exited with code " + str(process.returncode))
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.5).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise Exception("Server didn't start listening on port " + str(port))
+
+def freePort():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def percentile(sortedValues, p):
+    if len(sortedValues) == 0:
+        return None
+    index = min(len(sortedValues) - 1, int(round(p / 100 * (len(sortedValues) - 1))))
+    return sortedValues[index]
+
+# The sequence number of an upload is carried in the angle of its first
+# segment, which float32 holds exactly for anything below 2**24.
+def makePath(sequence, segments):
+    path = [Segment(0.5 + (i % 7) * 0.125, 0.15, (i % 5) * 20 - 40) for i in range(segments)]
+    path[0] = Segment(path[0].duration, path[0].speed, float(sequence))
+    return path
+
+# Measurement #
+
+class Receivers:
+    def __init__(self, clients):
+        self.clients = clients
+        self.received = {} # sequence -> number of receivers that got it
+        self.latencies = []
+        self.sentAt = {}
+        self.lastDelivery = None
+        self.changed = None
+
+    async def _receive(self, client):
+        async for path in client.pathsAsync():
+            now = time.perf_counter()
+            sequence = int(path[0].angle)
+            sentAt = self.sentAt.get(sequence)
+            if sentAt is None:
+                continue # Not one of ours (e.g. a stored path)
+            self.latencies.append(now - sentAt)
+            self.received[sequence] = self.received.get(sequence, 0) + 1
+            self.lastDelivery = now
+            self.changed.set()
+
+    def start(self):
+        self.changed = asyncio.Event()
+        self.tasks = [asyncio.ensure_future(self._receive(c)) for c in self.clients]
+
+    # Waits until every receiver got `sequence`, or `timeout` runs out.
+    async def waitFor(self, sequences, timeout):
+        deadline = time.perf_counter() + timeout
+        expected = len(self.clients)
+        while any(self.received.get(s, 0) < expected for s in sequences):
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                return False
+            self.changed.clear()
+            try:
+                await asyncio.wait_for(self.changed.wait(), remaining)
+            except asyncio.TimeoutError:
+                return False
+        return True
+
+    def stop(self):
+        for task in self.tasks:
+            task.cancel()
+
+async def measure(args, uploader, receivers):
+    result = {}
+    sequence = 0
+
+    # Latency: one upload in flight at a time.
+    receivers.latencies = []
+    for _ in range(args.latency_rounds):
+        sequence += 1
+        path = makePath(sequence, args.segments)
+        receivers.sentAt[sequence] = time.perf_counter()
+        uploader.sendPath(path)
+        if not await receivers.waitFor([sequence], args.timeout):
+            print("Warning: upload", sequence, "didn't reach every receiver", file=sys.stderr)
+    latencies = sorted(receivers.latencies)
+    result['latency_ms'] = {
+        'samples': len(latencies),
+        'p50': percentile(latencies, 50) * 1000 if latencies else None,
+        'p95': percentile(latencies, 95) * 1000 if latencies else None,
+        'p99': percentile(latencies, 99) * 1000 if latencies else None,
+        'max': latencies[-1] * 1000 if latencies else None,
+    }
+
+    # Throughput: upload as fast as possible.
+    receivers.latencies = []
+    first = sequence + 1
+    start = time.perf_counter()
+    for _ in range(args.throughput_uploads):
+        sequence += 1
+        receivers.sentAt[sequence] = time.perf_counter()
+        uploader.sendPath(makePath(sequence, args.segments))
+        await asyncio.sleep(0) # Let receivers run
+    await receivers.waitFor(range(first, sequence + 1), args.timeout)
+    elapsed = (receivers.lastDelivery or time.perf_counter()) - start
+    delivered = sum(receivers.received.get(s, 0) for s in range(first, sequence + 1))
+    pathBytes = len(encodePath(makePath(first, args.segments)))
+    result['throughput'] = {
+        'uploads': args.throughput_uploads,
+        'deliveries_expected': args.throughput_uploads * len(receivers.clients),
+        'deliveries': delivered,
+        'seconds': elapsed,
+        'paths_per_sec': delivered / elapsed if elapsed > 0 else None,
+        'mb_per_sec': delivered * pathBytes / elapsed / 1e6 if elapsed > 0 else None,
+        'path_bytes': pathBytes,
+    }
+    return result
+
+def run(args):
+    port = args.port or freePort()
+    command = [sys.executable, '-m', 'networking.server', '--port', str(port),
+               '--no-store', '--no-telemetry', '--max-queued', str(args.max_queued)]
+    if args.use_async:
+        command.append('--async')
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    server = subprocess.Popen(command, cwd=root, stdout=subprocess.DEVNULL)
+    clients = []
+    try:
+        waitForServer(port, server)
+        cpuIdle, memIdle = readProcessStats(server.pid)
+
+        # Client prints on every connect and upload; keep that out of the results.
+        with contextlib.redirect_stdout(io.StringIO()):
+            uploader = Client('127.0.0.1', port, reconnect=False)
+            clients = [Client('127.0.0.1', port, reconnect=False) for _ in range(args.clients)]
+            time.sleep(args.settle) # Let the server register every connection
+            cpuConnected, memConnected = readProcessStats(server.pid)
+
+            receivers = Receivers(clients)
+            async def main():
+                receivers.start()
+                try:
+                    return await measure(args, uploader, receivers)
+                finally:
+                    receivers.stop()
+            result = asyncio.run(main())
+        cpuDone, memDone = readProcessStats(server.pid)
+
+        connections = args.clients + 1
+        config = {
+            'server': 'async' if args.use_async else 'threaded',
+            'clients': args.clients,
+            'segments': args.segments,
+            'latency_rounds': args.latency_rounds,
+            'throughput_uploads': args.throughput_uploads,
+            'max_queued': args.max_queued,
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+        }
+        result = dict(config=config, **result)
+        if cpuDone is not None:
+            deliveries = max(1, result['throughput']['deliveries'])
+            result['server'] = {
+                'rss_idle_bytes': memIdle,
+                'rss_connected_bytes': memConnected,
+                'rss_bytes_per_connection': (memConnected - memIdle) / connections if memIdle is not None else None,
+                'rss_end_bytes': memDone,
+                'cpu_seconds_connecting': cpuConnected - cpuIdle,
+                'cpu_seconds_measuring': cpuDone - cpuConnected,
+                'cpu_ms_per_connection': (cpuDone - cpuIdle) / connections * 1000,
+                'cpu_us_per_delivery': (cpuDone - cpuConnected) / deliveries * 1e6,
+            }
+        return result
+    finally:
+        for c in clients:
+            c.close()
+        server.terminate()
+        server.wait()
+
+def main():
+    parser = argparse.ArgumentParser(description="Loopback benchmark of the path relay, with JSON output")
+    parser.add_argument('--clients', type=int, default=50, help="number of receiving clients")
+    parser.add_argument('--segments', type=int, default=100, help="segments per path")
+    parser.add_argument('--latency-rounds', type=int, default=100)
+    parser.add_argument('--throughput-uploads', type=int, default=200)
+    parser.add_argument('--async', dest='use_async', action='store_true', help="benchmark the asyncio server")
+    parser.add_argument('--max-queued', type=int, default=1024,
+                        help="server send queue length; large so throughput isn't measured as drops")
+    parser.add_argument('--port', type=int, default=None)
+    parser.add_argument('--settle', type=float, default=0.5)
+    parser.add_argument('--timeout', type=float, default=30)
+    parser.add_argument('--output', default=None, help="file to write the JSON to instead of stdout")
+    args = parser.parse_args()
+
+    result = run(args)
+    text = json.dumps(result, indent=2)
+    if args.output is None:
+        print(text)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+
+if __name__ == "__main__":
+    main()
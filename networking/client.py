@@ -1,59 +1,334 @@
 import socket
+import selectors
+import threading
+import asyncio
 from .commands import *
 from .utils import *
+from .pathcodec import *
 import time
-import io
-import array
 
+RECV_BUFSIZE = 4096  # maximum amount of data to be received at a time
+CLOSE_CHECK_INTERVAL = 1.0  # seconds between checks for close() while waiting
+CLOSE_LINGER = 1.0  # seconds close() waits for the server to hang up
+
+# Asks on the terminal for the server to connect to.
+def promptForServer():
+    return input("Enter IP to connect to (port 8080 will be used): ")
+
+# Connection to the relay server. The socket is non-blocking and every wait
+# is on a selector, so a path is handed over as soon as its last byte arrives
+# instead of on the next poll.
+#
+# Receiving can be done in any of these ways:
+#   path = client.receivePath()           # wait for the next path
+#   for path in client.paths(): ...       # every path, as it arrives
+#   client.onPath(callback)               # callback(path) on a background thread
+#   async for path in client.pathsAsync(): ...
+# or segment by segment, while the path is still being streamed (see
+# sendSegment):
+#   for segment in client.streamedPath(): ...
+#   for segment in client.streamedPath(live=True): ...   # only a new stream
 class Client:
-    def __init__(self):
-        # create an INET, STREAMing socket
-        self.s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        # now connect to the web server on port 8080 - the normal http port
-        ip = input("Enter IP to connect to (port 8080 will be used): ")
-        self.s.connect((ip, 8080))
-        print("Connected")
-    
+    # @param connectTimeout -- seconds to wait for each connection attempt.
+    # @param reconnect -- whether to keep trying to connect (and reconnect after
+    # the server goes away) instead of raising.
+    # @param maxReconnectDelay -- the wait between attempts doubles up to this.
+    # @param channel -- channel to join (see joinChannel in commands.py), also
+    # after every reconnect.
+    def __init__(self, ip, port=8080, connectTimeout=5.0, reconnect=True,
+                 reconnectDelay=0.25, maxReconnectDelay=5.0, channel=DEFAULT_CHANNEL):
+        self.ip = ip
+        self.port = port
+        self.connectTimeout = connectTimeout
+        self.reconnect = reconnect
+        self.reconnectDelay = reconnectDelay
+        self.maxReconnectDelay = maxReconnectDelay
+        self.path = None
+        self.s = None
+        self.closed = False
+        self.connectLock = threading.Lock()
+        self.sendLock = threading.Lock()
+        self.callbackThread = None
+        self.channel = channel
+        # Channel we asked to join but haven't had channelJoined for yet. Paths
+        # received until then belong to the previous channel.
+        self.awaitingJoin = None
+        self.uploadIndex = 0 # Index of the next segment sendSegment() streams
+        self.streamed = [] # Segments of the path being streamed to us so far
+        self._connect()
+
+    # (Re)connects, retrying with exponential backoff if self.reconnect is set.
+    def _connect(self):
+        with self.connectLock:
+            delay = self.reconnectDelay
+            while True:
+                if self.closed:
+                    raise ConnectionError("Client was closed")
+                try:
+                    s = socket.create_connection((self.ip, self.port), timeout=self.connectTimeout)
+                    break
+                except OSError as e:
+                    if not self.reconnect:
+                        raise
+                    print("Couldn't connect to", self.ip, "port", self.port, "(" + str(e) + "), retrying in", delay, "s")
+                    time.sleep(delay)
+                    delay = min(delay * 2, self.maxReconnectDelay)
+            s.setblocking(False)
+            s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            old = self.s
+            self.s = s
+            self.decoder = FrameDecoder(RECV_BUFSIZE)
+            self.readSelector = selectors.DefaultSelector()
+            self.readSelector.register(s, selectors.EVENT_READ)
+            self.writeSelector = selectors.DefaultSelector()
+            self.writeSelector.register(s, selectors.EVENT_WRITE)
+            if old is not None:
+                old.close()
+            print("Connected")
+            if self.channel != DEFAULT_CHANNEL:
+                self._sendJoin(self.channel)
+
+    # Handles a lost connection: reconnects or raises.
+    def _disconnected(self, sock):
+        if self.closed or not self.reconnect:
+            raise ConnectionError("Server closed the connection")
+        print("Lost connection to the server, reconnecting")
+        if sock is self.s: # Another thread may have reconnected already
+            self._connect()
+
+    def _sendAll(self, data):
+        with self.sendLock:
+            view = memoryview(data)
+            while len(view) > 0:
+                try:
+                    view = view[self.s.send(view):]
+                except BlockingIOError:
+                    self.writeSelector.select()
+
+    def _sendJoin(self, channel):
+        self.awaitingJoin = channel
+        self._sendAll(makeChannelCommand(NetworkCommand.joinChannel, channel))
+
+    # Moves this client to another channel. Paths are then only exchanged with
+    # other clients in that channel, starting with its latest stored path.
+    def joinChannel(self, channel):
+        self.channel = channel
+        while True:
+            sock = self.s
+            try:
+                self._sendJoin(channel)
+                break
+            except OSError:
+                self._disconnected(sock) # Reconnecting joins self.channel
+
     def sendPath(self, path):
         msg = makeRobotPathCommand(path, NetworkCommand.uploadPath)
-        self.s.send(msg)
+        while True:
+            sock = self.s
+            try:
+                self._sendAll(msg)
+                break
+            except OSError:
+                self._disconnected(sock)
         print("Sent path:",path)
 
-    def receivePath(self):
-        RECV_BUFSIZE = 4096  # maximum amount of data to be received at a time
+    # Streams one segment of a path, as soon as it's recorded, to the rest of
+    # the channel. Set `final` on the last segment; the next call after that
+    # starts a new path.
+    def sendSegment(self, segment, final=False):
+        msg = makeSegmentCommand(NetworkCommand.uploadSegment, self.uploadIndex, [segment], final)
+        while True:
+            sock = self.s
+            try:
+                self._sendAll(msg)
+                break
+            except OSError:
+                self._disconnected(sock)
+        self.uploadIndex = 0 if final else self.uploadIndex + 1
+        print("Sent segment:", segment, "(final)" if final else "")
+
+    # Returns the next (start index, list of Segments, final) already received,
+    # or None. A setPath counts as one final chunk starting at 0, unless
+    # `streamedOnly` is set, in which case only setSegment chunks count.
+    def _nextChunk(self, streamedOnly=False):
+        for command, payload in self.decoder:
+            chunk = self._do_stuff(payload, command)
+            if chunk is not None and (not streamedOnly or command == NetworkCommand.setSegment):
+                return chunk
+        return None
+
+    # Returns the next complete path already received, or None.
+    def _nextPath(self):
+        while True:
+            chunk = self._nextChunk()
+            if chunk is None:
+                return None
+            if chunk[2]:
+                return self.path
+
+    # Waits for the next path and returns it, as a list of Segments.
+    # @param timeout -- seconds to wait, or None to wait forever. Raises
+    # TimeoutError when it runs out.
+    def receivePath(self, timeout=None):
+        return self._receive(self._nextPath, timeout)
+
+    # Waits for the next chunk of a path and returns (start index, list of
+    # Segments, whether it completes the path). See receivePath for `timeout`.
+    def receiveSegments(self, timeout=None):
+        return self._receive(self._nextChunk, timeout)
+
+    # Yields the segments of the next path as they arrive, finishing with its
+    # last one. Segments already yielded aren't repeated if the server resends
+    # the path from the start (e.g. after a reconnect).
+    # @param live -- only follow a path that is being streamed: complete paths
+    # (setPath, such as the channel's latest stored one the server sends on
+    # connect) are ignored, and it waits for a streamed path from its start.
+    def streamedPath(self, timeout=None, live=False):
+        nextChunk = (lambda: self._nextChunk(streamedOnly=True)) if live else self._nextChunk
+        yielded = 0
+        while True:
+            start, segments, final = self._receive(nextChunk, timeout)
+            if live and yielded == 0 and start != 0:
+                continue # Joined partway through; wait for it from the start
+            for i in range(max(0, yielded - start), len(segments)):
+                yield segments[i]
+            yielded = max(yielded, start + len(segments))
+            if final:
+                return
+
+    # Waits until `nextItem()` returns something other than None, receiving
+    # in between, and returns it.
+    def _receive(self, nextItem, timeout):
+        deadline = None if timeout is None else time.monotonic() + timeout
         while True:
-            data = self.s.recv(RECV_BUFSIZE)
-            def handler():
-                data = self.s.recv(RECV_BUFSIZE) # Change the outer `data`
-                if len(data) == 0:
-                    time.sleep(0.4) # Avoid burning CPU
-                return data
-            return runCommand(data, self._do_stuff, handler)
-    
+            # Commands left over from a previous recv come first.
+            item = nextItem()
+            if item is not None:
+                return item
+            if self.closed:
+                raise ConnectionError("Client was closed")
+            # Wake up now and then even without a deadline, so a close() from
+            # another thread is noticed.
+            remaining = CLOSE_CHECK_INTERVAL if deadline is None else max(0, min(CLOSE_CHECK_INTERVAL, deadline - time.monotonic()))
+            sock = self.s
+            if len(self.readSelector.select(remaining)) == 0:
+                if deadline is not None and time.monotonic() >= deadline:
+                    raise TimeoutError("Nothing received within " + str(timeout) + " s")
+                continue
+            try:
+                if self.decoder.recvInto(sock, RECV_BUFSIZE) == 0:
+                    self._disconnected(sock)
+            except BlockingIOError:
+                pass # Spurious wakeup
+            except OSError:
+                self._disconnected(sock)
+
+    # Yields every path received, forever (or until close()).
+    def paths(self):
+        while not self.closed:
+            yield self.receivePath()
+
+    # Calls `callback(path)` on a background thread for every path received.
+    def onPath(self, callback):
+        def run():
+            try:
+                for path in self.paths():
+                    callback(path)
+            except ConnectionError:
+                pass # Closed
+        self.callbackThread = threading.Thread(target=run, daemon=True)
+        self.callbackThread.start()
+        return self.callbackThread
+
+    # Async iterator over every path received. Must be used from a running
+    # event loop, and not at the same time as the blocking methods above.
+    async def pathsAsync(self):
+        loop = asyncio.get_running_loop()
+        while not self.closed:
+            path = self._nextPath()
+            if path is not None:
+                yield path
+                continue
+            sock = self.s
+            try:
+                count = await loop.sock_recv_into(sock, self.decoder.receiveBuffer(RECV_BUFSIZE))
+                self.decoder.received(count)
+                if count == 0:
+                    await loop.run_in_executor(None, self._disconnected, sock)
+            except OSError:
+                await loop.run_in_executor(None, self._disconnected, sock)
+
     def _do_stuff(self, dataRest, command):
         if command == NetworkCommand.setPath:
-            # Upload to server needs to be handled.
-            pass
+            if self.awaitingJoin is not None:
+                return # For the channel we're leaving
+        elif command == NetworkCommand.setSegment:
+            if self.awaitingJoin is not None:
+                return
+            return self._receiveChunk(dataRest)
+        elif command == NetworkCommand.channelJoined:
+            if decodeChannelName(dataRest) == self.awaitingJoin:
+                self.awaitingJoin = None
+            return
         else:
             print("Error: the command", command, "cannot be issued to a client")
             return
-        
+
         # Receive the path
-        self.path = unpack_array('B', dataRest)
-        return self.path
-    
+        self.path = decodePath(dataRest)
+        self.streamed = []
+        return (0, self.path, True)
+
+    def _receiveChunk(self, chunk):
+        start, segments, final = decodeSegmentChunk(chunk)
+        if start == 0:
+            self.streamed = []
+        elif start != len(self.streamed):
+            # Missed part of the path (e.g. dropped as a slow client). Joining
+            # the channel again makes the server resend it from the start.
+            print("Missed segments", len(self.streamed), "to", start - 1, "of the streamed path, resyncing")
+            try:
+                self._sendJoin(self.channel)
+            except OSError:
+                pass # Reconnecting joins the channel again anyway
+            return
+        self.streamed.extend(segments)
+        if final:
+            self.path = self.streamed
+            self.streamed = []
+        return (start, segments, final)
+
     def close(self):
-        self.s.shutdown(socket.SHUT_RDWR)
-        self.s.close()
-    
-    # "Destructor": called upon garbage collection of this object.
+        if self.closed:
+            return
+        self.closed = True
+        if self.s is not None:
+            try:
+                # Stop sending but keep reading until the server hangs up.
+                # Closing with replies still unread resets the connection,
+                # which can throw away the last things we sent.
+                self.s.shutdown(socket.SHUT_WR)
+                deadline = time.monotonic() + CLOSE_LINGER
+                while self.readSelector.select(max(0, deadline - time.monotonic())):
+                    if not self.s.recv(RECV_BUFSIZE):
+                        break
+                    if time.monotonic() >= deadline:
+                        break
+            except OSError:
+                pass # Already disconnected
+            self.s.close()
+
+    # "Destructor": called upon garbage collection of this object. Only closes
+    # the socket: lingering like close() would block whichever thread (or
+    # interpreter exit) happens to collect the client.
     def __del__(self):
-        self.close()
+        if getattr(self, 's', None) is not None:
+            self.s.close()
 
 def main():
-    c = Client()
+    c = Client(promptForServer())
     time.sleep(2)
-    c.sendPath([90,1,2,3])
+    c.sendPath([Segment(1.0, 0.15, 90), Segment(0.5, 0.15, -60)])
     p = c.receivePath()
     print(p)
 
@@ -1,10 +1,38 @@
 from enum import Enum
 
+# Name of the channel every client starts out in (see joinChannel below).
+DEFAULT_CHANNEL = ''
+MAX_CHANNEL_NAME = 255 # Longest channel name allowed, in bytes of UTF-8
+MAX_PAYLOAD = 64 * 1024 * 1024 # Longest command payload accepted, in bytes
+SEGMENT_FINAL = 1 # Flag on the last chunk of a streamed path (see uploadSegment below)
+
 class NetworkCommand(Enum):
     uploadPath = 1 # [Client to server] Upload a path for the robot to follow. Format:
     # [uploadPath enum value number as ASCII] [path length] [path bytes]
     setPath = 2 # [Server to client] Tells a robot to follow a path. Format:
     # [setPath enum value number as ASCII] [path length] [path bytes]
+    # The path bytes are encoded with networking/pathcodec.py.
+    joinChannel = 3 # [Client to server] Move this client to a named channel: from now
+    # on it only receives paths uploaded in that channel, and its uploads only go
+    # to that channel. Clients start out in the default channel, whose name is
+    # empty. Format:
+    # [joinChannel enum value number as ASCII] [name length] [channel name as UTF-8]
+    channelJoined = 4 # [Server to client] Acknowledges joinChannel. Any setPath
+    # received before this was for the previous channel. The latest path of the
+    # new channel, if there is one, follows right after. Format:
+    # [channelJoined enum value number as ASCII] [name length] [channel name as UTF-8]
+    uploadSegment = 5 # [Client to server] Streams a path a few segments at a time,
+    # as they are recorded, instead of uploading it whole with uploadPath. A
+    # start index of 0 begins a new path in the sender's channel; the chunk
+    # with the final flag set completes it, and the server then stores the
+    # whole path. One uploader per channel at a time. Format:
+    # [uploadSegment enum value number as ASCII] [chunk length] [chunk bytes]
+    # where the chunk bytes are
+    # [start index: uint32] [flags: uint8, SEGMENT_FINAL] [the chunk's segments, encoded with pathcodec.py]
+    setSegment = 6 # [Server to client] Forwards an uploadSegment chunk. A client
+    # that joins while a path is being streamed is first sent everything so far
+    # as one chunk starting at index 0. Format:
+    # [setSegment enum value number as ASCII] [chunk length] [chunk bytes]
 
     # https://stackoverflow.com/questions/43634618/how-do-i-test-if-int-value-exists-in-python-enum-without-using-try-catch
     @classmethod
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Benchmark of FrameDecoder against the runCommand() path, in frames/sec.
+#
+# Usage (from the repository root):
+#   python -m networking.decoderbenchmark
+#
+# runCommand() can only decode one command per call and drops whatever
+# follows it in the buffer, so it is given each command on its own, split
+# into `chunkSize` pieces as they would arrive from recv(). FrameDecoder is
+# given the whole stream of commands split the same way, which is what it
+# sees in practice.
+#
+# Both copy each received byte once here (runCommand() into its growing
+# bytearray, FrameDecoder.feed() into its buffer), so for large payloads in
+# small chunks the per-chunk overhead dominates and they come out about even
+# (0.9-1.1x for 64 KB paths in 1460-byte chunks). FrameDecoder's gain there
+# is not rescanning or re-concatenating, and on a socket recvInto() skips the
+# copy, which this benchmark doesn't measure.
+
+import argparse
+import contextlib
+import os
+import random
+import time
+from .commands import *
+from .utils import *
+
+def makeFrames(count, pathLength):
+    rng = random.Random(0)
+    return [makeCommand(NetworkCommand.uploadPath,
+                        bytes(rng.getrandbits(8) for _ in range(pathLength)))
+            for _ in range(count)]
+
+def split(data, chunkSize):
+    return [data[i:i + chunkSize] for i in range(0, len(data), chunkSize)]
+
+def benchRunCommand(frames, chunkSize):
+    chunkedFrames = [split(frame, chunkSize) for frame in frames]
+    decoded = 0
+    def callback(dataRest, command):
+        return len(dataRest)
+    # runCommand prints every buffer it looks at, which is part of its cost,
+    # but we don't want it on the terminal.
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        start = time.perf_counter()
+        for chunks in chunkedFrames:
+            remaining = iter(chunks[1:])
+            def handler():
+                return next(remaining, False)
+            runCommand(chunks[0], callback, handler)
+            decoded += 1
+        elapsed = time.perf_counter() - start
+    return decoded, elapsed
+
+def benchFrameDecoder(frames, chunkSize):
+    chunks = split(b''.join(frames), chunkSize)
+    decoder = FrameDecoder()
+    decoded = 0
+    start = time.perf_counter()
+    for chunk in chunks:
+        decoder.feed(chunk)
+        for command, payload in decoder:
+            decoded += 1
+    elapsed = time.perf_counter() - start
+    return decoded, elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description="Frame decoder benchmark")
+    parser.add_argument('--frames', type=int, default=2000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    # (path length in bytes, recv chunk size)
+    scenarios = [(16, 4096), (256, 4096), (4096, 1460), (65536, 1460)]
+    print("%10s %10s %18s %18s %8s" % ("path", "chunk", "runCommand f/s", "FrameDecoder f/s", "speedup"))
+    for (pathLength, chunkSize) in scenarios:
+        # Keep the total amount of data roughly constant across scenarios.
+        count = max(10, min(args.frames, args.frames * 256 // pathLength))
+        frames = makeFrames(count, pathLength)
+        old = min((benchRunCommand(frames, chunkSize) for _ in range(args.repeat)), key=lambda r: r[1])
+        new = min((benchFrameDecoder(frames, chunkSize) for _ in range(args.repeat)), key=lambda r: r[1])
+        if old[0] != count or new[0] != count:
+            raise Exception("Decoded the wrong number of frames")
+        oldRate = old[0] / old[1]
+        newRate = new[0] / new[1]
+        print("%10d %10d %18.0f %18.0f %7.1fx" % (pathLength, chunkSize, oldRate, newRate, newRate / oldRate))
+
+if __name__ == "__main__":
+    main()
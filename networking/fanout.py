@@ -0,0 +1,255 @@
+import collections
+import selectors
+import socket
+import threading
+from .commands import *
+
+# Broadcasting the same message to many clients without letting one slow or
+# dead client hold up the rest. Each client gets a bounded queue of messages
+# waiting to be sent (SendQueue); what happens when that queue is full is
+# decided by a backpressure policy:
+#   DROP_OLDEST -- throw away the oldest queued message to make room. A robot
+#                  only ever follows the newest path, so this is the default.
+#   DISCONNECT  -- disconnect the client; it can reconnect and will be sent the
+#                  latest path then.
+# A message that has been partly sent is never dropped, so the stream a client
+# receives is always made of whole commands.
+
+DROP_OLDEST = 'drop-oldest'
+DISCONNECT = 'disconnect'
+BACKPRESSURE_POLICIES = (DROP_OLDEST, DISCONNECT)
+
+# Index of which members (anything with a `channel` attribute) are in which
+# named channel, so a broadcast only visits the members of its own channel.
+class ChannelIndex:
+    def __init__(self):
+        self.channels = {} # channel name -> set of members
+
+    def join(self, member, channel=DEFAULT_CHANNEL):
+        self.leave(member)
+        member.channel = channel
+        self.channels.setdefault(channel, set()).add(member)
+
+    def leave(self, member):
+        members = self.channels.get(getattr(member, 'channel', None))
+        if members is not None:
+            members.discard(member)
+            if len(members) == 0:
+                del self.channels[member.channel]
+
+    def members(self, channel=DEFAULT_CHANNEL):
+        return self.channels.get(channel, ())
+
+# Raised by SendQueue.put() under the DISCONNECT policy when the queue is full.
+class SlowConsumerException(Exception):
+    pass
+
+class SendQueue:
+    def __init__(self, maxMessages=16, policy=DROP_OLDEST):
+        if policy not in BACKPRESSURE_POLICIES:
+            raise ValueError("Unknown backpressure policy: " + str(policy))
+        self.messages = collections.deque()
+        self.maxMessages = maxMessages
+        self.policy = policy
+        self.dropped = 0 # Number of messages thrown away under DROP_OLDEST
+
+    def __len__(self):
+        return len(self.messages)
+
+    def put(self, message):
+        if len(self.messages) >= self.maxMessages:
+            if self.policy == DISCONNECT:
+                raise SlowConsumerException()
+            self.messages.popleft()
+            self.dropped += 1
+        self.messages.append(message)
+
+    # Returns the oldest queued message, or None if there are none.
+    def pop(self):
+        if len(self.messages) == 0:
+            return None
+        return self.messages.popleft()
+
+# A client socket as seen by Fanout.
+class FanoutPeer:
+    def __init__(self, sock, name, maxMessages, policy):
+        self.sock = sock
+        self.name = name
+        self.queue = SendQueue(maxMessages, policy)
+        self.current = None # memoryview of the rest of the message being sent
+        self.registered = False # Whether the selector is watching this peer
+        self.fileno = None # File descriptor it's registered under; the socket may be closed since
+        self.channel = None # Set by ChannelIndex
+
+# Fan-out for blocking sockets that are read by other threads (see
+# ClientThread in server.py). All writing happens on one background thread,
+# which waits on a selector and only ever writes as much as a socket will take
+# without blocking, so broadcast() itself only appends to queues.
+class Fanout:
+    def __init__(self, maxMessages=16, policy=DROP_OLDEST):
+        if policy not in BACKPRESSURE_POLICIES:
+            raise ValueError("Unknown backpressure policy: " + str(policy))
+        self.maxMessages = maxMessages
+        self.policy = policy
+        self.lock = threading.Lock()
+        self.peers = {} # socket -> FanoutPeer
+        self.channels = ChannelIndex()
+        self.pending = set() # Peers that got new messages since the writer last looked
+        self.removed = False # Whether peers were removed since the writer last looked
+        self.selector = selectors.DefaultSelector()
+        # Writing a byte to _wakeSend wakes the writer thread up.
+        self._wakeRecv, self._wakeSend = socket.socketpair()
+        self._wakeRecv.setblocking(False)
+        self._wakeSend.setblocking(False)
+        self.selector.register(self._wakeRecv, selectors.EVENT_READ)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def __len__(self):
+        return len(self.peers)
+
+    def add(self, sock, name=None, channel=DEFAULT_CHANNEL):
+        with self.lock:
+            peer = FanoutPeer(sock, name, self.maxMessages, self.policy)
+            self.peers[sock] = peer
+            self.channels.join(peer, channel)
+            return peer
+
+    # Moves `sock` to another channel.
+    def join(self, sock, channel):
+        with self.lock:
+            peer = self.peers.get(sock)
+            if peer is not None:
+                self.channels.join(peer, channel)
+
+    # Stops sending to `sock`. Anything still queued for it is thrown away.
+    def remove(self, sock):
+        with self.lock:
+            peer = self.peers.pop(sock, None)
+            if peer is not None:
+                self.pending.discard(peer)
+                self.channels.leave(peer)
+                self.removed = True
+        if peer is not None:
+            self._wake()
+
+    def send(self, sock, message):
+        with self.lock:
+            peer = self.peers.get(sock)
+            if peer is not None:
+                self._enqueue(peer, message)
+        self._wake()
+
+    # Queues `message` for every peer in `channel` except `exclude` (a socket).
+    # Returns the number of peers it was queued for.
+    def broadcast(self, message, exclude=None, channel=DEFAULT_CHANNEL):
+        count = 0
+        with self.lock:
+            for peer in list(self.channels.members(channel)):
+                if peer.sock is not exclude:
+                    self._enqueue(peer, message)
+                    count += 1
+        self._wake()
+        return count
+
+    # Must hold self.lock.
+    def _enqueue(self, peer, message):
+        try:
+            peer.queue.put(message)
+            self.pending.add(peer)
+        except SlowConsumerException:
+            print("Fanout: disconnecting slow client", peer.name)
+            self._drop(peer)
+
+    # Forgets a peer and shuts its socket down, which also ends whatever thread
+    # is reading from it. Must hold self.lock.
+    def _drop(self, peer):
+        self.peers.pop(peer.sock, None)
+        self.pending.discard(peer)
+        self.channels.leave(peer)
+        self.removed = True
+        try:
+            peer.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass # Already disconnected
+
+    def _wake(self):
+        try:
+            self._wakeSend.send(b'\0')
+        except BlockingIOError:
+            pass # Already has wake-ups pending
+
+    # Writes as much of the peer's queue as the socket will take right now.
+    # Returns False once everything queued has been sent.
+    def _flush(self, peer):
+        while True:
+            if peer.current is None:
+                with self.lock:
+                    message = peer.queue.pop()
+                if message is None:
+                    return False
+                peer.current = memoryview(message)
+            try:
+                # MSG_DONTWAIT makes just this call non-blocking, so the reading
+                # thread can keep using the socket in blocking mode.
+                sent = peer.sock.send(peer.current, socket.MSG_DONTWAIT)
+            except (BlockingIOError, InterruptedError):
+                return True
+            except OSError:
+                print("Fanout: client", peer.name, "is gone")
+                with self.lock:
+                    self._drop(peer)
+                return False
+            peer.current = peer.current[sent:] if sent < len(peer.current) else None
+
+    def _register(self, peer):
+        fileno = peer.sock.fileno()
+        try:
+            self.selector.register(fileno, selectors.EVENT_WRITE, peer)
+        except KeyError:
+            # A removed peer's socket was closed and its file descriptor number
+            # reused by this one before we got to unregister it.
+            stale = self.selector.unregister(fileno)
+            stale.data.registered = False
+            self.selector.register(fileno, selectors.EVENT_WRITE, peer)
+        peer.fileno = fileno
+        peer.registered = True
+
+    # By the stored file descriptor, which still works after the socket was
+    # closed elsewhere (unregistering the socket itself then fails).
+    def _unregister(self, peer):
+        if peer.registered:
+            self.selector.unregister(peer.fileno)
+            peer.registered = False
+
+    def _run(self):
+        while True:
+            for key, events in self.selector.select():
+                if key.fileobj is self._wakeRecv:
+                    try:
+                        while self._wakeRecv.recv(4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+                    continue
+                peer = key.data
+                if peer.sock not in self.peers or self._flush(peer) is False:
+                    self._unregister(peer)
+
+            with self.lock:
+                pending = self.pending
+                self.pending = set()
+                removed = self.removed
+                self.removed = False
+            if removed:
+                # Forget peers that were removed while registered.
+                gone = [key.data for key in self.selector.get_map().values()
+                        if key.data is not None and key.data.sock not in self.peers]
+                for peer in gone:
+                    self._unregister(peer)
+            for peer in pending:
+                if peer.registered:
+                    continue # Will be flushed when its socket is writable
+                if self._flush(peer) and peer.sock in self.peers:
+                    # The socket is full; continue when it has room again.
+                    self._register(peer)
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Loopback load test for the relay server. Opens many connections to a relay
+# on this machine, has one of them upload a path, and measures how long it
+# takes for every other connection to receive the resulting setPath.
+#
+# Usage (from the repository root):
+#   python -m networking.loadtest --clients 2000 --rounds 20
+# By default an AsyncRelayServer is started in this process. Pass --port to
+# test a server that is already running instead (e.g. the threaded one).
+
+import argparse
+import asyncio
+import resource
+import statistics
+import time
+from .commands import *
+from .utils import *
+from .asyncserver import AsyncRelayServer
+
+# Raises the open file limit as far as we are allowed, since every
+# connection needs a file descriptor on both ends when testing on loopback.
+def raiseFileLimit(wanted):
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard != resource.RLIM_INFINITY:
+        wanted = min(wanted, hard)
+    if wanted > soft:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (wanted, hard))
+    return resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+
+# Reads one command from `reader` and returns (command, payload).
+async def readCommand(reader):
+    separator = bytes(defaultSeparator, encoding='utf-8')
+    commandNumber = int((await reader.readuntil(separator))[:-1])
+    length = int((await reader.readuntil(separator))[:-1])
+    payload = await reader.readexactly(length)
+    return NetworkCommand(commandNumber), payload
+
+def percentile(sortedValues, p):
+    if len(sortedValues) == 0:
+        return float('nan')
+    index = min(len(sortedValues) - 1, int(round(p / 100 * (len(sortedValues) - 1))))
+    return sortedValues[index]
+
+async def runLoadTest(host, port, clientCount, rounds, pathLength, settle=0.5):
+    connections = []
+    connectStart = time.perf_counter()
+    # Connect in batches so we don't overflow the listen backlog.
+    batchSize = 256
+    for i in range(0, clientCount, batchSize):
+        batch = [asyncio.open_connection(host, port)
+                 for _ in range(min(batchSize, clientCount - i))]
+        connections.extend(await asyncio.gather(*batch))
+    connectTime = time.perf_counter() - connectStart
+    print("Connected", len(connections), "clients in %.3f s" % connectTime)
+    # A connection is established before the server has accepted it, so give
+    # the server a moment to register everyone before the first upload.
+    await asyncio.sleep(settle)
+
+    (_, senderWriter) = connections[0]
+    receivers = connections[1:]
+    # The relay forwards payloads without decoding them, so any bytes will do.
+    upload = makeCommand(NetworkCommand.uploadPath, bytes(i % 256 for i in range(pathLength)))
+
+    latencies = []
+    roundTimes = []
+    for r in range(rounds):
+        async def receiveOne(reader):
+            command, payload = await readCommand(reader)
+            if command != NetworkCommand.setPath or len(payload) != pathLength:
+                raise Exception("Unexpected reply: " + str(command))
+            return time.perf_counter()
+
+        waiters = [asyncio.ensure_future(receiveOne(reader)) for (reader, _) in receivers]
+        sentAt = time.perf_counter()
+        senderWriter.write(upload)
+        await senderWriter.drain()
+        receivedAt = await asyncio.gather(*waiters)
+        roundTimes.append(max(receivedAt) - sentAt)
+        latencies.extend(t - sentAt for t in receivedAt)
+
+    for (_, writer) in connections:
+        writer.close()
+
+    latencies.sort()
+    ms = 1000
+    print("Connections:              ", len(connections))
+    print("Rounds:                   ", rounds)
+    print("Path length:              ", pathLength, "bytes")
+    print("Relay latency p50:         %.3f ms" % (percentile(latencies, 50) * ms))
+    print("Relay latency p99:         %.3f ms" % (percentile(latencies, 99) * ms))
+    print("Relay latency max:         %.3f ms" % (latencies[-1] * ms))
+    print("Time to reach all clients: %.3f ms (mean per round)" % (statistics.mean(roundTimes) * ms))
+
+async def amain(args):
+    server = None
+    port = args.port
+    if port is None:
+        server = AsyncRelayServer('127.0.0.1', 0, backlog=args.clients)
+        await server.start()
+        port = server.port
+    try:
+        await runLoadTest(args.host, port, args.clients, args.rounds, args.path_length, args.settle)
+    finally:
+        if server is not None:
+            await server.shutdown()
+
+def main():
+    parser = argparse.ArgumentParser(description="Loopback load test for the path relay")
+    parser.add_argument('--clients', type=int, default=1000)
+    parser.add_argument('--rounds', type=int, default=10)
+    parser.add_argument('--path-length', type=int, default=64)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=None,
+                        help="test an already running server instead of starting one")
+    parser.add_argument('--settle', type=float, default=0.5,
+                        help="seconds to wait after connecting before the first upload")
+    args = parser.parse_args()
+    # Two descriptors per connection when the server is in this process.
+    limit = raiseFileLimit(args.clients * 2 + 64)
+    if limit < args.clients * 2 + 64:
+        print("Warning: open file limit is", limit, "which may be too low for", args.clients, "clients")
+    asyncio.run(amain(args))
+
+if __name__ == "__main__":
+    main()
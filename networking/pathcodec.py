@@ -0,0 +1,156 @@
+import array
+import collections
+import math
+import sys
+
+# Binary encoding of robot paths, used as the payload of uploadPath and setPath.
+#
+# A path is a list of segments. Each segment means "drive for `duration`
+# seconds at `speed` (negative duration drives backwards), then turn by
+# `angle` degrees (negative turns left)".
+#
+# Format (all multi-byte values big-endian):
+#   [version: uint8] [encoding: uint8] [segment count: varint] [columns]
+# The columns are all the durations, then all the speeds, then all the angles:
+#   ENCODING_FLOAT32: 3 * count float32 values.
+#   ENCODING_DELTA_VARINT: for each column, the first value followed by the
+#     differences between consecutive values, each as a zigzag varint of the
+#     value in fixed point (see FIXED_POINT_SCALES).
+# Storing columns instead of rows keeps each column in a single array.array,
+# so the float32 encoding is converted in one call instead of once per value.
+
+Segment = collections.namedtuple('Segment', ['duration', 'speed', 'angle'])
+
+PATH_FORMAT_VERSION = 2 # Version 1 was the unversioned array of uint8s
+
+ENCODING_FLOAT32 = 0
+ENCODING_DELTA_VARINT = 1
+
+# Fixed-point resolution of each column for ENCODING_DELTA_VARINT:
+# milliseconds, thousandths of full speed, and hundredths of a degree.
+FIXED_POINT_SCALES = (1000, 1000, 100)
+
+# Paths with at least this many segments use ENCODING_DELTA_VARINT by default.
+COMPRESS_THRESHOLD = 32
+
+class PathFormatException(Exception):
+    pass
+
+# Varints #
+
+def _zigzag(n):
+    return (n << 1) ^ (n >> 63)
+
+def _unzigzag(n):
+    return (n >> 1) ^ -(n & 1)
+
+def _writeVarint(n, output):
+    while n >= 0x80:
+        output.append((n & 0x7F) | 0x80)
+        n >>= 7
+    output.append(n)
+
+# Returns the varint at `offset` in `data` and the offset after it.
+def _readVarint(data, offset):
+    result = 0
+    shift = 0
+    while True:
+        try:
+            b = data[offset]
+        except IndexError:
+            raise PathFormatException("Truncated varint")
+        offset += 1
+        result |= (b & 0x7F) << shift
+        if b < 0x80:
+            return result, offset
+        shift += 7
+        if shift > 63:
+            raise PathFormatException("Varint too long")
+
+# Columns #
+
+def _columnToBytes(column):
+    arr = array.array('f', column)
+    if sys.byteorder == 'little':
+        arr.byteswap() # To big-endian, for the whole array at once
+    return arr.tobytes()
+
+def _columnFromBytes(data):
+    arr = array.array('f')
+    arr.frombytes(data)
+    if sys.byteorder == 'little':
+        arr.byteswap()
+    return arr
+
+def _writeDeltaColumn(column, scale, output):
+    previous = 0
+    for value in column:
+        if not math.isfinite(value):
+            raise PathFormatException("Can't encode " + str(value) + " in a path")
+        fixed = int(round(value * scale))
+        _writeVarint(_zigzag(fixed - previous), output)
+        previous = fixed
+
+def _readDeltaColumn(data, offset, count, scale):
+    column = array.array('d', [0.0]) * count
+    fixed = 0
+    for i in range(count):
+        delta, offset = _readVarint(data, offset)
+        fixed += _unzigzag(delta)
+        column[i] = fixed / scale
+    return column, offset
+
+# Public API #
+
+# Returns the bytes encoding `segments`, a list of Segments or (duration,
+# speed, angle) tuples. If `encoding` is None, it is chosen from the length
+# of the path.
+def encodePath(segments, encoding=None):
+    count = len(segments)
+    if encoding is None:
+        encoding = ENCODING_DELTA_VARINT if count >= COMPRESS_THRESHOLD else ENCODING_FLOAT32
+    columns = list(zip(*segments)) if count > 0 else [(), (), ()]
+    if len(columns) != 3:
+        raise PathFormatException("Segments must have a duration, speed and angle")
+
+    output = bytearray((PATH_FORMAT_VERSION, encoding))
+    _writeVarint(count, output)
+    if encoding == ENCODING_FLOAT32:
+        for column in columns:
+            output += _columnToBytes(column)
+    elif encoding == ENCODING_DELTA_VARINT:
+        for column, scale in zip(columns, FIXED_POINT_SCALES):
+            _writeDeltaColumn(column, scale, output)
+    else:
+        raise PathFormatException("Unknown path encoding: " + str(encoding))
+    return bytes(output)
+
+# Returns the list of Segments encoded in `data` (any bytes-like object).
+def decodePath(data):
+    data = memoryview(data).cast('B')
+    if len(data) < 2:
+        raise PathFormatException("Path is too short to have a header")
+    version, encoding = data[0], data[1]
+    if version != PATH_FORMAT_VERSION:
+        raise PathFormatException("Unsupported path format version: " + str(version))
+    count, offset = _readVarint(data, 2)
+
+    if encoding == ENCODING_FLOAT32:
+        columnSize = 4 * count
+        if len(data) - offset != 3 * columnSize:
+            raise PathFormatException("Expected " + str(3 * columnSize) + " bytes of segments, got " + str(len(data) - offset))
+        columns = [_columnFromBytes(data[offset + i * columnSize:offset + (i + 1) * columnSize])
+                   for i in range(3)]
+    elif encoding == ENCODING_DELTA_VARINT:
+        # Every value takes at least a byte; checked before allocating columns.
+        if 3 * count > len(data) - offset:
+            raise PathFormatException("Expected at least " + str(3 * count) + " bytes of segments, got " + str(len(data) - offset))
+        columns = []
+        for scale in FIXED_POINT_SCALES:
+            column, offset = _readDeltaColumn(data, offset, count, scale)
+            columns.append(column)
+        if offset != len(data):
+            raise PathFormatException("Trailing bytes after path")
+    else:
+        raise PathFormatException("Unknown path encoding: " + str(encoding))
+    return list(map(Segment._make, zip(*columns)))
@@ -0,0 +1,233 @@
+import collections
+import hashlib
+import mmap
+import os
+import struct
+import threading
+import zlib
+from .commands import *
+from .pathcodec import *
+
+# Append-only log of uploaded paths, so the relay server can hand the latest
+# path to a receiver as soon as it connects, even across server restarts.
+#
+# File layout:
+#   [file header: magic b'PLOG', format version uint32]
+#   [record] [record] ...
+# Each record is:
+#   [header: magic b'PATH', path version uint64, payload length uint32]
+#   [payload: the encoded path (see pathcodec.py)]
+#   [trailer: payload length uint32, path version uint64, crc32 uint32, magic b'HTAP']
+# The trailer repeats the length so the last record can be found from the end
+# of the file. Opening the log only reads the file header and the last
+# record; the whole log is only scanned if the last record is damaged
+# (e.g. the server was killed in the middle of a write), in which case the
+# damaged tail is cut off.
+
+FILE_MAGIC = b'PLOG'
+LOG_FORMAT_VERSION = 1
+FILE_HEADER = struct.Struct('>4sI')
+RECORD_HEADER = struct.Struct('>4sQI')
+RECORD_TRAILER = struct.Struct('>IQI4s')
+RECORD_MAGIC = b'PATH'
+TRAILER_MAGIC = b'HTAP'
+
+class PathLogException(Exception):
+    pass
+
+class PathLog:
+    # @param sync -- whether to fsync after every append. Slower, but survives
+    # power loss and not just the server process dying.
+    def __init__(self, filename, sync=False):
+        self.filename = filename
+        self.sync = sync
+        self.lock = threading.Lock()
+        self.file = open(filename, 'a+b')
+        self.latestVersion = 0
+        self.latestPayload = None
+        self._open()
+
+    def _open(self):
+        size = os.fstat(self.file.fileno()).st_size
+        if size == 0:
+            self.file.write(FILE_HEADER.pack(FILE_MAGIC, LOG_FORMAT_VERSION))
+            self.file.flush()
+            return
+        with mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            if size < FILE_HEADER.size:
+                raise PathLogException(self.filename + " is not a path log")
+            magic, formatVersion = FILE_HEADER.unpack_from(m, 0)
+            if magic != FILE_MAGIC:
+                raise PathLogException(self.filename + " is not a path log")
+            if formatVersion != LOG_FORMAT_VERSION:
+                raise PathLogException("Unsupported path log format version: " + str(formatVersion))
+            if size == FILE_HEADER.size:
+                return
+            record = self._recordEndingAt(m, size)
+            if record is not None:
+                (self.latestVersion, self.latestPayload) = record
+                return
+            # The tail is damaged: find the last complete record.
+            print("PathLog: recovering", self.filename)
+            validEnd = FILE_HEADER.size
+            for (version, offset, length) in self._scan(m):
+                validEnd = offset + RECORD_HEADER.size + length + RECORD_TRAILER.size
+                self.latestVersion = version
+                self.latestPayload = bytes(m[offset + RECORD_HEADER.size:offset + RECORD_HEADER.size + length])
+        self.file.truncate(validEnd)
+        self.file.seek(0, os.SEEK_END)
+
+    # Returns (version, payload) of the record that ends at `end`, or None if
+    # there isn't a valid one.
+    def _recordEndingAt(self, m, end):
+        if end - FILE_HEADER.size < RECORD_HEADER.size + RECORD_TRAILER.size:
+            return None
+        length, version, crc, magic = RECORD_TRAILER.unpack_from(m, end - RECORD_TRAILER.size)
+        start = end - RECORD_TRAILER.size - length - RECORD_HEADER.size
+        if magic != TRAILER_MAGIC or start < FILE_HEADER.size:
+            return None
+        headerMagic, headerVersion, headerLength = RECORD_HEADER.unpack_from(m, start)
+        if headerMagic != RECORD_MAGIC or headerVersion != version or headerLength != length:
+            return None
+        payload = m[start + RECORD_HEADER.size:start + RECORD_HEADER.size + length]
+        if zlib.crc32(payload) != crc:
+            return None
+        return (version, payload)
+
+    # Yields (version, offset, payload length) of each valid record from the
+    # start of the log, stopping at the first damaged one. Only headers and
+    # trailers are read; payloads are only checksummed.
+    def _scan(self, m):
+        offset = FILE_HEADER.size
+        size = len(m)
+        while offset + RECORD_HEADER.size <= size:
+            magic, version, length = RECORD_HEADER.unpack_from(m, offset)
+            end = offset + RECORD_HEADER.size + length + RECORD_TRAILER.size
+            if magic != RECORD_MAGIC or end > size or self._recordEndingAt(m, end) is None:
+                return
+            yield (version, offset, length)
+            offset = end
+
+    # Appends an encoded path and returns its version number.
+    def append(self, payload):
+        payload = bytes(payload)
+        with self.lock:
+            version = self.latestVersion + 1
+            self.file.write(RECORD_HEADER.pack(RECORD_MAGIC, version, len(payload))
+                            + payload
+                            + RECORD_TRAILER.pack(len(payload), version, zlib.crc32(payload), TRAILER_MAGIC))
+            self.file.flush()
+            if self.sync:
+                os.fsync(self.file.fileno())
+            self.latestVersion = version
+            self.latestPayload = payload
+            return version
+
+    # Returns (version, payload) of the latest path, or None if the log is empty.
+    def latest(self):
+        with self.lock:
+            if self.latestPayload is None:
+                return None
+            return (self.latestVersion, self.latestPayload)
+
+    # Returns the payload of the path with the given version, or None.
+    def get(self, version):
+        with self.lock:
+            if version == self.latestVersion:
+                return self.latestPayload
+            self.file.flush()
+            with mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                for (recordVersion, offset, length) in self._scan(m):
+                    if recordVersion == version:
+                        return bytes(m[offset + RECORD_HEADER.size:offset + RECORD_HEADER.size + length])
+        return None
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+# One PathLog per channel (see joinChannel in commands.py), kept as files in
+# `directory`. A channel's log is only opened the first time it's used, and
+# only created by the first append to it. At most `maxOpen` logs are kept
+# open; the least recently used one is closed to make room (its file stays).
+class PathStore:
+    def __init__(self, directory, sync=False, maxOpen=16):
+        self.directory = directory
+        self.sync = sync
+        self.maxOpen = maxOpen
+        self.lock = threading.Lock()
+        self.logs = collections.OrderedDict() # channel name -> PathLog, least recently used first
+        os.makedirs(directory, exist_ok=True)
+
+    # Channel names can contain anything and be up to MAX_CHANNEL_NAME bytes,
+    # so the filename has a digest of the name instead.
+    def filename(self, channel):
+        if channel == DEFAULT_CHANNEL:
+            return os.path.join(self.directory, 'default.log')
+        return os.path.join(self.directory, 'channel-' + hashlib.sha256(channel.encode('utf-8')).hexdigest() + '.log')
+
+    # Returns the channel's PathLog, opening it if needed, or None if it has
+    # no file yet and `create` isn't set. Call with self.lock held.
+    def _log(self, channel, create):
+        log = self.logs.get(channel)
+        if log is not None:
+            self.logs.move_to_end(channel)
+            return log
+        filename = self.filename(channel)
+        if not create and not os.path.exists(filename):
+            return None
+        log = PathLog(filename, self.sync)
+        self.logs[channel] = log
+        while len(self.logs) > self.maxOpen:
+            self.logs.popitem(last=False)[1].close()
+        return log
+
+    # Appends an encoded path to a channel and returns its version number.
+    def append(self, payload, channel=DEFAULT_CHANNEL):
+        # Under the store's lock, so the log can't be closed to make room
+        # in the middle of it.
+        with self.lock:
+            return self._log(channel, True).append(payload)
+
+    # Returns (version, payload) of the latest path in a channel, or None.
+    def latest(self, channel=DEFAULT_CHANNEL):
+        with self.lock:
+            log = self._log(channel, False)
+            return log.latest() if log is not None else None
+
+    def close(self):
+        with self.lock:
+            for log in self.logs.values():
+                log.close()
+            self.logs.clear()
+
+# Paths being streamed with uploadSegment, per channel, until their final
+# chunk arrives.
+class PathStreams:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.streams = {} # channel name -> list of Segments received so far
+
+    # Adds a chunk of segments starting at index `start`. Returns the whole
+    # path once the final chunk is added, otherwise None. Raises
+    # PathFormatException if the chunk doesn't continue the channel's path.
+    def add(self, channel, start, segments, final):
+        with self.lock:
+            path = [] if start == 0 else self.streams.get(channel)
+            if path is None or start > len(path):
+                raise PathFormatException("Segment chunk starting at " + str(start) +
+                                          " doesn't continue the path being streamed")
+            del path[start:] # A resent chunk replaces what it overlaps
+            path.extend(segments)
+            if final:
+                self.streams.pop(channel, None)
+                return path
+            self.streams[channel] = path
+            return None
+
+    # Returns a copy of the segments streamed so far in `channel`, or None if
+    # no path is being streamed there.
+    def current(self, channel=DEFAULT_CHANNEL):
+        with self.lock:
+            path = self.streams.get(channel)
+            return None if path is None else list(path)
@@ -11,6 +11,11 @@ import array
 import struct
 from .utils import *
 import time
+import argparse
+from .asyncserver import main as asyncMain
+from .pathstore import PathStore, PathStreams
+from .fanout import *
+from .telemetry import TELEMETRY_PORT, TelemetryHub, TelemetryThread
 
 # Sources for some of this code:
 # https://docs.python.org/3/howto/sockets.html
@@ -19,55 +24,104 @@ import time
 
 # Represents a single client connected to the server.
 class ClientThread:
-    def __init__(self, clientsocket, address, allClients):
+    def __init__(self, clientsocket, address, fanout, pathStore=None, streams=None):
         try:
             RECV_BUFSIZE = 4096  # maximum amount of data to be received at a time
             self.clientsocket = clientsocket
             self.clientsocket_str = '%s:%d' % (address[0],address[1])
-            self.allClients = allClients
+            self.fanout = fanout
+            self.pathStore = pathStore
+            self.streams = streams # PathStreams shared by every ClientThread
+            self.channel = DEFAULT_CHANNEL
 
-            # Car path that was uploaded. Currently is an array of angles encoded as bytes.
+            # Car path that was uploaded, still encoded (see pathcodec.py).
             self.path = None
 
+            # Give a newly connected robot the latest path right away.
+            self._sendLatestPath()
+
             # main loop: receive/send data from this client
+            decoder = FrameDecoder(RECV_BUFSIZE)
             while True:
-                data = self.clientsocket.recv(RECV_BUFSIZE)
-                def handler():
-                    data = self.clientsocket.recv(RECV_BUFSIZE) # Change the outer `data`
-                    if len(data) == 0:
-                        time.sleep(0.4) # Avoid burning CPU
-                    return data
-                runCommand(data, self._do_stuff, handler)
+                if decoder.recvInto(self.clientsocket, RECV_BUFSIZE) == 0:
+                    break # Disconnected
+                for command, payload in decoder:
+                    self._do_stuff(payload, command)
+        except OSError:
+            pass # Disconnected, or shut down by the fan-out as a slow client
+        except ProtocolException as e:
+            print("Error: dropping", self.clientsocket_str + ":", e)
         finally:
+            self.fanout.remove(self.clientsocket)
             self.clientsocket.close()
             print('ClientThread', self.clientsocket_str, 'disconnected')
     
+    # Sends the path being streamed in this client's channel so far, or else
+    # the latest stored path of the channel, if there is one.
+    def _sendLatestPath(self):
+        streamed = self.streams.current(self.channel) if self.streams is not None else None
+        if streamed is not None:
+            self.fanout.send(self.clientsocket, makeSegmentCommand(NetworkCommand.setSegment, 0, streamed))
+            return
+        latest = self.pathStore.latest(self.channel) if self.pathStore is not None else None
+        if latest is not None:
+            (version, payload) = latest
+            print("Sending stored path version", version, "to", self.clientsocket_str)
+            self.fanout.send(self.clientsocket, makeCommand(NetworkCommand.setPath, payload))
+
     # play with received data
     def _do_stuff(self, dataRest, command):
         if command == NetworkCommand.uploadPath:
             # Upload to server needs to be handled.
             pass
+        elif command == NetworkCommand.joinChannel:
+            self.channel = decodeChannelName(dataRest)
+            self.fanout.join(self.clientsocket, self.channel)
+            self.fanout.send(self.clientsocket, makeChannelCommand(NetworkCommand.channelJoined, self.channel))
+            self._sendLatestPath()
+            return
+        elif command == NetworkCommand.uploadSegment:
+            self._receiveSegments(dataRest)
+            return
         else:
             print("Error: the command", command, "cannot be issued to a server")
             return
         
-        # Receive the uploadPath
-        self.path = unpack_array('>B', dataRest)
+        # Receive the uploadPath. The server doesn't need to decode the path to
+        # relay it, so it keeps the encoded bytes.
+        self.path = bytes(dataRest)
+        if self.pathStore is not None:
+            version = self.pathStore.append(self.path, self.channel)
+            print("Stored path version", version, "in channel", repr(self.channel))
 
         # We have received uploadPath so now we send a bunch of setPath's:
-        # Send the path to all clients except the sender.
+        # Send the path to all clients in the sender's channel except the sender.
 
-        replyBytes = makeRobotPathCommand(self.path, NetworkCommand.setPath)
+        replyBytes = makeCommand(NetworkCommand.setPath, self.path)
         
         #reply = ('OK: %s' % data.decode()).encode()
-        # Send to all clients except sender:
-        for client in self.allClients:
-            if client != self.clientsocket:
-                print("sendPath:", replyBytes)
-                client.send(replyBytes)
+        # Send to all clients except sender. This only queues the reply; the
+        # fan-out thread does the sending, so a stalled client can't hold up the rest.
+        count = self.fanout.broadcast(replyBytes, exclude=self.clientsocket, channel=self.channel)
+        print("sendPath to", count, "client(s)")
+
+    # Forwards a chunk of a streamed path, and stores the path once it's complete.
+    def _receiveSegments(self, chunk):
+        try:
+            start, segments, final = decodeSegmentChunk(chunk)
+            path = self.streams.add(self.channel, start, segments, final)
+        except PathFormatException as e:
+            print("Error: bad segment chunk from", self.clientsocket_str + ":", e)
+            return
+        count = self.fanout.broadcast(makeCommand(NetworkCommand.setSegment, chunk),
+                                      exclude=self.clientsocket, channel=self.channel)
+        print("setSegment", start, "to", count, "client(s)")
+        if path is not None and self.pathStore is not None:
+            version = self.pathStore.append(encodePath(path), self.channel)
+            print("Stored streamed path version", version, "in channel", repr(self.channel))
         
 
-def main():
+def runThreaded(port=8080, pathStore=None, fanout=None, streams=None):
     s = None
     try:
         # create an INET, STREAMing socket
@@ -78,26 +132,61 @@ def main():
 
         # bind the socket to a public host, and a well-known port
         #socket.gethostname()
-        s.bind(('', 8080))
+        s.bind(('', port))
         # become a server socket
-        s.listen(5)
+        s.listen(socket.SOMAXCONN)
 
         # main loop to accept connections
-        allClients = []
+        if fanout is None:
+            fanout = Fanout()
+        if streams is None:
+            streams = PathStreams()
         while True:
             print("Waiting for connections...")
 
             # accept connections from outside
             (clientsocket, address) = s.accept()
-            allClients.append(clientsocket)
+            fanout.add(clientsocket, '%s:%d' % (address[0], address[1]))
             
             # Spawn a thread for each client.
-            thread = threading.Thread(target=ClientThread, args=(clientsocket, address, allClients))
-            thread.setDaemon(True)
+            thread = threading.Thread(target=ClientThread, args=(clientsocket, address, fanout, pathStore, streams))
+            thread.daemon = True
             thread.start()
     finally:
         s.shutdown(socket.SHUT_RDWR)
         s.close()
 
+def main():
+    parser = argparse.ArgumentParser(description="Path relay server")
+    parser.add_argument('--async', dest='useAsync', action='store_true',
+                        help="use the asyncio server instead of one thread per client")
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--store', default='paths',
+                        help="directory to keep uploaded paths in across restarts")
+    parser.add_argument('--no-store', dest='store', action='store_const', const=None,
+                        help="don't keep uploaded paths")
+    parser.add_argument('--max-queued', type=int, default=16,
+                        help="messages that may wait to be sent to one client")
+    parser.add_argument('--backpressure', choices=BACKPRESSURE_POLICIES, default=DROP_OLDEST,
+                        help="what to do when a client's queue is full")
+    parser.add_argument('--telemetry-port', type=int, default=TELEMETRY_PORT,
+                        help="UDP port for live telemetry (see telemetry.py)")
+    parser.add_argument('--no-telemetry', dest='telemetry_port', action='store_const', const=None,
+                        help="don't accept telemetry")
+    parser.add_argument('--telemetry-buffer', type=int, default=4096,
+                        help="telemetry readings kept for subscribers that join late")
+    args = parser.parse_args()
+    pathStore = PathStore(args.store) if args.store is not None else None
+    hub = TelemetryHub(args.telemetry_buffer) if args.telemetry_port is not None else None
+    if args.useAsync:
+        asyncMain(port=args.port, pathStore=pathStore,
+                  maxQueued=args.max_queued, policy=args.backpressure,
+                  telemetryHub=hub, telemetryPort=args.telemetry_port)
+    else:
+        if hub is not None:
+            TelemetryThread(hub, port=args.telemetry_port).start()
+            print("Telemetry on UDP port", args.telemetry_port)
+        runThreaded(args.port, pathStore, Fanout(args.max_queued, args.backpressure))
+
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,383 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import argparse
+import asyncio
+import collections
+import hashlib
+import hmac
+import json
+import os
+import socket
+import struct
+import threading
+import time
+
+# Live telemetry from the robots: ultrasonic sweep readings, turn progress and
+# motor commands, sent over UDP next to the TCP path protocol. Every reading is
+# its own small datagram, so sending never waits on the network and a lost
+# datagram only loses that one reading. Each datagram has a sequence number
+# so the server can count what was lost.
+#
+# Datagram format (big-endian):
+#   [magic b'TL'] [format version: uint8] [kind: uint8] [vehicle: uint16]
+#   [sequence: uint32] [sender's clock in seconds: float64] [body]
+# Bodies:
+#   KIND_SWEEP:       angle in degrees (float32), distance in cm (float32)
+#   KIND_TURN:        current heading and target heading in degrees (2 float32)
+#   KIND_MOTOR:       the 4 wheel duties given to Motor.setMotorModel (4 int16)
+#   KIND_SUBSCRIBE:   number of buffered readings to send right away (uint32),
+#                     then the nonce from the server's challenge (uint64; 0
+#                     before there is one). Sent by a subscriber to the
+#                     server, and again every SUBSCRIPTION_RENEW seconds to
+#                     stay subscribed.
+#   KIND_UNSUBSCRIBE: the nonce (uint64).
+#   KIND_CHALLENGE:   a nonce for the subscriber's address (uint64). The
+#                     server's answer to a subscribe without the right nonce.
+# The server forwards every reading datagram to its subscribers unchanged.
+# Subscribing takes the challenge round trip so that a subscribe with a
+# spoofed source address can't point the server's backlog and live readings
+# at someone else; the challenge is no bigger than the subscribe.
+
+TELEMETRY_PORT = 8081
+
+MAGIC = b'TL'
+TELEMETRY_FORMAT_VERSION = 1
+HEADER = struct.Struct('>2sBBHId')
+
+KIND_SWEEP = 1
+KIND_TURN = 2
+KIND_MOTOR = 3
+KIND_SUBSCRIBE = 100
+KIND_UNSUBSCRIBE = 101
+KIND_CHALLENGE = 102
+
+BODIES = {
+    KIND_SWEEP: struct.Struct('>ff'),
+    KIND_TURN: struct.Struct('>ff'),
+    KIND_MOTOR: struct.Struct('>hhhh'),
+    KIND_SUBSCRIBE: struct.Struct('>IQ'),
+    KIND_UNSUBSCRIBE: struct.Struct('>Q'),
+    KIND_CHALLENGE: struct.Struct('>Q'),
+}
+KIND_NAMES = {KIND_SWEEP: 'sweep', KIND_TURN: 'turn', KIND_MOTOR: 'motor',
+              KIND_SUBSCRIBE: 'subscribe', KIND_UNSUBSCRIBE: 'unsubscribe',
+              KIND_CHALLENGE: 'challenge'}
+
+SUBSCRIPTION_TIMEOUT = 10 # Seconds a subscription lasts without being renewed
+SUBSCRIPTION_RENEW = 3
+
+TelemetryRecord = collections.namedtuple('TelemetryRecord',
+                                         ['kind', 'vehicle', 'sequence', 'timestamp', 'values'])
+
+class TelemetryFormatException(Exception):
+    pass
+
+def encodeTelemetry(kind, vehicle, sequence, timestamp, values):
+    return HEADER.pack(MAGIC, TELEMETRY_FORMAT_VERSION, kind, vehicle,
+                       sequence & 0xFFFFFFFF, timestamp) + BODIES[kind].pack(*values)
+
+def decodeTelemetry(data):
+    if len(data) < HEADER.size:
+        raise TelemetryFormatException("Datagram is too short")
+    magic, version, kind, vehicle, sequence, timestamp = HEADER.unpack_from(data, 0)
+    if magic != MAGIC or version != TELEMETRY_FORMAT_VERSION:
+        raise TelemetryFormatException("Not a telemetry datagram")
+    body = BODIES.get(kind)
+    if body is None or len(data) != HEADER.size + body.size:
+        raise TelemetryFormatException("Bad telemetry datagram of kind " + str(kind))
+    return TelemetryRecord(kind, vehicle, sequence, timestamp, body.unpack_from(data, HEADER.size))
+
+# Robot side #
+
+# Sends telemetry from a robot. Every method returns immediately: if the
+# socket can't take a datagram right now, the reading is dropped.
+class TelemetrySender:
+    # @param maxRate -- most readings per second of each kind to send. A
+    # reading that comes sooner is held back, and the latest one held back is
+    # sent once the interval is up (so e.g. the stop after a turn isn't
+    # lost); the ones it replaced are skipped. None sends everything.
+    def __init__(self, host, port=TELEMETRY_PORT, vehicle=0, maxRate=100):
+        self.address = (host, port)
+        self.vehicle = vehicle
+        self.minInterval = 0 if maxRate is None else 1 / maxRate
+        self.lock = threading.Condition()
+        self.sequence = 0
+        self.lastSent = {} # kind -> time of the last reading sent
+        self.pending = {} # kind -> (time, values) of the latest reading held back
+        self.thread = None # Sends the pending readings; started on the first one
+        self.closed = False
+        self.sent = 0
+        self.skipped = 0 # Held back, then replaced by a newer reading
+        self.dropped = 0
+        self.s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.s.setblocking(False)
+
+    def _send(self, kind, values):
+        now = time.monotonic()
+        with self.lock:
+            if self.closed:
+                return
+            wait = self.lastSent.get(kind, -self.minInterval) + self.minInterval - now
+            if wait > 0:
+                if kind in self.pending:
+                    self.skipped += 1
+                else:
+                    self.lock.notify()
+                self.pending[kind] = (now, values)
+                if self.thread is None:
+                    self.thread = threading.Thread(target=self._sendPending, daemon=True)
+                    self.thread.start()
+                return
+            # A newer reading than the one held back, which can go now.
+            if kind in self.pending:
+                del self.pending[kind]
+                self.skipped += 1
+            self._sendNow(kind, now, values)
+
+    # Runs on self.thread: sends each held-back reading once its kind's
+    # interval is up.
+    def _sendPending(self):
+        with self.lock:
+            while not self.closed:
+                if not self.pending:
+                    self.lock.wait()
+                    continue
+                now = time.monotonic()
+                due = {kind: self.lastSent[kind] + self.minInterval for kind in self.pending}
+                for kind, at in due.items():
+                    if at <= now:
+                        self._sendNow(kind, *self.pending.pop(kind))
+                if self.pending:
+                    self.lock.wait(min(due[kind] for kind in self.pending) - now)
+
+    # Call with self.lock held.
+    def _sendNow(self, kind, t, values):
+        self.lastSent[kind] = time.monotonic()
+        self.sequence += 1
+        try:
+            self.s.sendto(encodeTelemetry(kind, self.vehicle, self.sequence, t, values), self.address)
+            self.sent += 1
+        except OSError:
+            self.dropped += 1 # Full buffer, or no route to the server right now
+
+    def sweep(self, angle, distance):
+        self._send(KIND_SWEEP, (angle, distance))
+
+    def turn(self, current, target):
+        self._send(KIND_TURN, (current, target))
+
+    def motor(self, duty1, duty2, duty3, duty4):
+        self._send(KIND_MOTOR, (duty1, duty2, duty3, duty4))
+
+    def stats(self):
+        with self.lock:
+            return {'sent': self.sent, 'skipped': self.skipped, 'dropped': self.dropped,
+                    'pending': len(self.pending)}
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.pending.clear()
+            self.lock.notify()
+            self.s.close()
+
+# Server side #
+
+# Per-vehicle sequence tracking, for loss statistics.
+class VehicleStats:
+    def __init__(self):
+        self.lastSequence = None
+        self.received = 0
+        self.lost = 0
+        self.reordered = 0
+
+    def update(self, sequence):
+        self.received += 1
+        if self.lastSequence is None or sequence < self.lastSequence - 1000:
+            self.lastSequence = sequence # First reading, or the robot restarted
+        elif sequence > self.lastSequence:
+            self.lost += sequence - self.lastSequence - 1
+            self.lastSequence = sequence
+        else:
+            # Arrived after a later one, which counted it as lost.
+            self.reordered += 1
+            self.lost = max(0, self.lost - 1)
+
+# Receives telemetry datagrams, keeps the latest `capacity` of them in a ring
+# buffer, and forwards each one to the current subscribers. This class does no
+# I/O itself; see TelemetryProtocol and TelemetryThread.
+class TelemetryHub:
+    def __init__(self, capacity=4096):
+        self.ring = collections.deque(maxlen=capacity)
+        self.subscribers = {} # address -> time the subscription expires
+        self.vehicles = {} # (address, vehicle) -> VehicleStats
+        self.invalid = 0
+        self.secret = os.urandom(16) # Key for the subscribers' nonces
+
+    # The nonce a subscriber at `address` has to echo. Derived from the
+    # address, so challenges keep no state.
+    def nonce(self, address):
+        digest = hmac.new(self.secret, repr(address).encode(), hashlib.sha256).digest()
+        return int.from_bytes(digest[:8], 'big')
+
+    # Handles a datagram from `address`. Returns a list of (datagram, address)
+    # to send.
+    def handle(self, data, address, now=None):
+        now = time.monotonic() if now is None else now
+        try:
+            record = decodeTelemetry(data)
+        except TelemetryFormatException:
+            self.invalid += 1
+            return []
+        if record.kind == KIND_SUBSCRIBE:
+            (backlog, nonce) = record.values
+            if nonce != self.nonce(address):
+                challenge = encodeTelemetry(KIND_CHALLENGE, 0, 0, now, (self.nonce(address),))
+                return [(challenge, address)]
+            isNew = address not in self.subscribers
+            self.subscribers[address] = now + SUBSCRIPTION_TIMEOUT
+            if not isNew:
+                return [] # Just a renewal
+            backlog = min(backlog, len(self.ring))
+            return [(d, address) for d in list(self.ring)[len(self.ring) - backlog:]]
+        if record.kind == KIND_UNSUBSCRIBE:
+            if record.values[0] == self.nonce(address):
+                self.subscribers.pop(address, None)
+            return []
+        if record.kind == KIND_CHALLENGE:
+            self.invalid += 1
+            return []
+
+        key = (address[0], record.vehicle)
+        stats = self.vehicles.get(key)
+        if stats is None:
+            stats = self.vehicles[key] = VehicleStats()
+        stats.update(record.sequence)
+        data = bytes(data)
+        self.ring.append(data)
+        expired = [a for a, expires in self.subscribers.items() if expires < now]
+        for a in expired:
+            del self.subscribers[a]
+        return [(data, a) for a in self.subscribers]
+
+    def stats(self):
+        return {'%s/%d' % key: vars(stats) for key, stats in self.vehicles.items()}
+
+class TelemetryProtocol(asyncio.DatagramProtocol):
+    def __init__(self, hub):
+        self.hub = hub
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, address):
+        for (reply, to) in self.hub.handle(data, address):
+            self.transport.sendto(reply, to)
+
+    def error_received(self, exc):
+        pass # e.g. a subscriber went away; UDP doesn't care
+
+# Starts serving `hub` on the running event loop.
+async def startTelemetry(hub, host='', port=TELEMETRY_PORT):
+    loop = asyncio.get_running_loop()
+    transport, protocol = await loop.create_datagram_endpoint(
+        lambda: TelemetryProtocol(hub), local_addr=(host, port))
+    return transport
+
+# Serves `hub` on a background thread (for the threaded server).
+class TelemetryThread(threading.Thread):
+    def __init__(self, hub, host='', port=TELEMETRY_PORT):
+        super().__init__(daemon=True)
+        self.hub = hub
+        self.s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.s.bind((host, port))
+
+    def run(self):
+        while True:
+            data, address = self.s.recvfrom(65536)
+            for (reply, to) in self.hub.handle(data, address):
+                try:
+                    self.s.sendto(reply, to)
+                except OSError:
+                    pass
+
+# Subscriber side #
+
+# Receives the live telemetry of every robot from the server.
+class TelemetrySubscriber:
+    def __init__(self, host, port=TELEMETRY_PORT, backlog=0):
+        self.address = (host, port)
+        self.s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.s.settimeout(SUBSCRIPTION_RENEW)
+        self.lastRenewed = None
+        self.backlog = backlog
+        self.nonce = 0 # From the server's last challenge
+
+    def _subscribe(self, backlog):
+        self.s.sendto(encodeTelemetry(KIND_SUBSCRIBE, 0, 0, time.monotonic(), (backlog, self.nonce)),
+                      self.address)
+        self.lastRenewed = time.monotonic()
+
+    # Yields TelemetryRecords as they arrive.
+    def records(self):
+        self._subscribe(self.backlog)
+        while True:
+            if time.monotonic() - self.lastRenewed >= SUBSCRIPTION_RENEW:
+                self._subscribe(0)
+            try:
+                data, address = self.s.recvfrom(65536)
+            except socket.timeout:
+                continue
+            try:
+                record = decodeTelemetry(data)
+            except TelemetryFormatException:
+                continue
+            if record.kind == KIND_CHALLENGE:
+                # First subscribe, or the server restarted.
+                self.nonce = record.values[0]
+                self._subscribe(self.backlog)
+                continue
+            yield record
+
+    def close(self):
+        try:
+            self.s.sendto(encodeTelemetry(KIND_UNSUBSCRIBE, 0, 0, time.monotonic(), (self.nonce,)),
+                          self.address)
+        except OSError:
+            pass
+        self.s.close()
+
+# Prints (and optionally records, as JSON lines) the live telemetry:
+#   python -m networking.telemetry SERVER_IP --record run1.jsonl
+def main():
+    parser = argparse.ArgumentParser(description="Watch live robot telemetry")
+    parser.add_argument('host')
+    parser.add_argument('--port', type=int, default=TELEMETRY_PORT)
+    parser.add_argument('--backlog', type=int, default=0,
+                        help="number of already buffered readings to get first")
+    parser.add_argument('--record', default=None, help="file to append readings to, as JSON lines")
+    parser.add_argument('--quiet', action='store_true', help="don't print readings")
+    args = parser.parse_args()
+
+    subscriber = TelemetrySubscriber(args.host, args.port, args.backlog)
+    output = open(args.record, 'a') if args.record is not None else None
+    try:
+        for record in subscriber.records():
+            line = json.dumps({'kind': KIND_NAMES.get(record.kind, record.kind),
+                               'vehicle': record.vehicle, 'sequence': record.sequence,
+                               'timestamp': record.timestamp, 'values': record.values})
+            if output is not None:
+                output.write(line + '\n')
+            if not args.quiet:
+                print(line)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        subscriber.close()
+        if output is not None:
+            output.close()
+
+if __name__ == "__main__":
+    main()
@@ -2,7 +2,9 @@ import struct
 import array
 import io
 from .commands import *
+from .pathcodec import *
 import time
+import sys
 
 # Separator for use within buffers sent over the network.
 defaultSeparator = ' '
@@ -12,6 +14,11 @@ defaultSeparator = ' '
 class UnfinishedLengthException(Exception):
     pass
 
+# A peer sent something that isn't valid in the command protocol (bad header,
+# unknown command, bad channel name).
+class ProtocolException(Exception):
+    pass
+
 # Returns a memoryview of the data for the item, another memoryview for the rest
 # of the data remaining, and the length that was read.
 # For documentation on memoryview, see https://docs.python.org/3.3/library/stdtypes.html#memoryview
@@ -53,14 +60,20 @@ def readSeparatedData(data, handleUnfinishedLength, ending=defaultSeparator):
         #                                                        ^^^ +1 to move past the
         # `ending` separator.
 
+# Returns `data` grown (using `handleUnfinishedLength`) until it is at least
+# `requiredLength` bytes long.
 def ensureLength(data, requiredLength, handleUnfinishedLength):
+    if len(data) >= requiredLength:
+        return data
+    data = bytearray(data) # Grown in place below instead of re-concatenating
     while len(data) < requiredLength:
         res = handleUnfinishedLength()
         if res == False:
             raise UnfinishedLengthException()
         else:
-            data = data + res # Combine bytes objects (concatenate)
+            data += res
             continue # Try checking `data` again.
+    return data
 
 def readAsciiInt(data, handleUnfinishedLength, ending=defaultSeparator):
     read, rest, length = readSeparatedData(data, handleUnfinishedLength, ending)
@@ -84,37 +97,40 @@ def unpack_array(fmt, data):
     arrayFmt = fmt
     for c in charactersToRemove:
         arrayFmt = arrayFmt.replace(c, '')
-    #size = struct.calcsize(arrayFmt) * len(data)
-    #print(type(arrayFmt), arrayFmt)
-    #print(type(fmt), fmt)
-    #print(type(data), data)
-    # iter_unpack returns an iterator that returns tuples for each formatting letter
-    # in `fmt` so we need to place these into the array properly. The array can hold
-    # one type at a time, so we will ignore the rest (and report an error if the rest
-    # exists). We `map` a function over the results from struct.iter_unpack to ensure
-    # they work as single values instead of as tuples.
-    def unpackHandler(tuple):
-        if len(tuple) == 1:
-            return tuple[0]
-        else:
-            raise Exception("An array.array can't have multiple types in the format string")
-    return array.array(arrayFmt, map(unpackHandler, struct.iter_unpack(fmt, data)))
-    # iter_unpack "returns an iterator
-    # which will read equally-sized chunks from the buffer until all its contents have 
-    # been consumed." ( https://docs.python.org/3/library/struct.html#struct.iter_unpack )
-    # array.extend: "Append items from iterable to the end of the array." [...] "If 
-    # iterable is not an array, it must be iterable and its elements must be the 
-    # right type to be appended to the array."
-    # ( https://docs.python.org/3/library/array.html#array.array.extend )
+    if len(arrayFmt) != 1:
+        raise Exception("An array.array can't have multiple types in the format string")
+    result = array.array(arrayFmt)
+    if result.itemsize != struct.calcsize(fmt):
+        # The standard size in `fmt` doesn't match this machine's size for the
+        # type (e.g. '>l' is 4 bytes but array 'l' may be 8), so convert each item.
+        result.extend(item[0] for item in struct.iter_unpack(fmt, data))
+        return result
+    # Same item size: load all the bytes at once and fix the byte order of the
+    # whole array with one call.
+    result.frombytes(data)
+    if fmt[0] in '>!':
+        byteorder = 'big'
+    elif fmt[0] == '<':
+        byteorder = 'little'
+    else:
+        byteorder = sys.byteorder
+    if byteorder != sys.byteorder:
+        result.byteswap()
+    return result
 
 # Packs an array into a bytes object from machine byte order (always the case for
-# an array.array in Python) into big-endian byte order.
+# an array.array in Python) into big-endian byte order, with struct's standard
+# size for each item, like unpack_array('>' + arr.typecode, ...) reads.
 def pack_array(arr):
-    #elemSize = arr.itemsize #struct.calcsize('!' + arr.typecode)
-    with io.BytesIO() as output:
-        for elem in arr:
-            output.write(struct.pack('>' + arr.typecode, elem))
-        return output.getvalue()
+    fmt = '>' + arr.typecode
+    if arr.itemsize != struct.calcsize(fmt):
+        # e.g. array 'l' may be 8 bytes but '>l' is 4, so convert each item.
+        return struct.pack('>' + str(len(arr)) + arr.typecode, *arr)
+    if sys.byteorder == 'big' or arr.itemsize == 1:
+        return arr.tobytes()
+    swapped = array.array(arr.typecode, arr)
+    swapped.byteswap()
+    return swapped.tobytes()
 
 # Robot commands #
 
@@ -126,20 +142,52 @@ def outputRobotPath(path, outputIO):
     # Write bytes
     outputIO.write(pathBytes)
 
-# @param path -- list
-def makeRobotPathCommand(path, command):
-    replyBytes = None
-    with io.BytesIO() as output:
-        commandBytes = str(command.value)
-        # Write bytes
-        output.write(bytes(commandBytes + ' ', encoding='utf-8'))
+# @param path -- list of Segments (see pathcodec.py)
+# @param encoding -- one of the ENCODING_ constants in pathcodec.py, or None to
+# choose one based on the length of the path.
+def makeRobotPathCommand(path, command, encoding=None):
+    return makeCommand(command, encodePath(path, encoding))
+
+# Builds a complete command from an already-encoded payload, i.e.
+# [command enum value number as ASCII] [payload length] [payload bytes].
+# Used by the relay to forward a payload without decoding it first.
+# @param payload -- bytes-like object
+def makeCommand(command, payload):
+    header = bytes(str(command.value) + ' ' + str(len(payload)) + ' ', encoding='utf-8')
+    return header + bytes(payload)
+
+# Builds a joinChannel or channelJoined command for the channel `name`.
+def makeChannelCommand(command, name):
+    nameBytes = name.encode('utf-8')
+    if len(nameBytes) > MAX_CHANNEL_NAME:
+        raise Exception("Channel name is too long: " + name)
+    return makeCommand(command, nameBytes)
+
+# Returns the channel name in the payload of a joinChannel or channelJoined.
+def decodeChannelName(payload):
+    if len(payload) > MAX_CHANNEL_NAME:
+        raise ProtocolException("Channel name is too long")
+    try:
+        return bytes(payload).decode('utf-8')
+    except UnicodeDecodeError:
+        raise ProtocolException("Channel name is not valid UTF-8")
 
-        # Write path
-        outputRobotPath(array.array('B', path), output)
+# Header of the chunk in an uploadSegment or setSegment: start index, flags.
+SEGMENT_CHUNK_HEADER = struct.Struct('>IB')
 
-        replyBytes = output.getvalue() # Bytes object containing entire buffer
-    #print(type(replyBytes))
-    return replyBytes
+# Builds an uploadSegment or setSegment command for `segments`, which start at
+# index `start` of the path being streamed.
+def makeSegmentCommand(command, start, segments, final=False):
+    flags = SEGMENT_FINAL if final else 0
+    return makeCommand(command, SEGMENT_CHUNK_HEADER.pack(start, flags) + encodePath(segments))
+
+# Returns (start index, list of Segments, whether it's the final chunk) from
+# the payload of an uploadSegment or setSegment.
+def decodeSegmentChunk(payload):
+    if len(payload) < SEGMENT_CHUNK_HEADER.size:
+        raise PathFormatException("Segment chunk is too short")
+    start, flags = SEGMENT_CHUNK_HEADER.unpack_from(payload, 0)
+    return start, decodePath(memoryview(payload)[SEGMENT_CHUNK_HEADER.size:]), bool(flags & SEGMENT_FINAL)
 
 def runCommand(data, callback, handler):
     # Read in the length specified in the packet as ASCII and convert it to an int,
@@ -149,6 +197,168 @@ def runCommand(data, callback, handler):
         raise Exception("Invalid command number received: " + str(commandNumber))
     # Get the length of the path:
     pathLength, dataRest, amountRead = readAsciiInt(dataRest, handler)
-    ensureLength(dataRest, pathLength, handler)
+    dataRest = ensureLength(dataRest, pathLength, handler)
     # We can now use `commandNumber` to run a command on the server.
-    return callback(dataRest[:pathLength], NetworkCommand(commandNumber))
\ No newline at end of file
+    return callback(dataRest[:pathLength], NetworkCommand(commandNumber))
+
+# Streaming decoder #
+
+# Incremental decoder for the command stream. Feed it whatever TCP gave you
+# (any number of partial or complete commands) and iterate it to get every
+# complete command as a (NetworkCommand, payload) pair. Unlike runCommand(),
+# this never rescans bytes it has already looked at, keeps any bytes that
+# belong to the next command, and never copies a payload out: `payload` is a
+# memoryview into the decoder's internal bytearray. feed() still copies each
+# chunk into that bytearray once; recvInto() has the socket write into it
+# directly instead.
+#
+# The memoryviews handed out are only valid until the next call to feed() or
+# recvInto(); call bytes(payload) to keep one for longer.
+#
+# Usage:
+# ```
+# decoder = FrameDecoder()
+# while True:
+#     if decoder.recvInto(sock) == 0:
+#         break # Disconnected
+#     for command, payload in decoder:
+#         ...
+# ```
+class FrameDecoder:
+    def __init__(self, bufsize=4096, maxHeaderField=20, separator=defaultSeparator):
+        self.buffer = bytearray(bufsize)
+        self.start = 0 # Offset of the first byte not yet decoded
+        self.end = 0   # Offset one past the last byte received
+        self.maxHeaderField = maxHeaderField
+        self.separator = ord(separator)
+
+        # Header of a command whose payload hasn't fully arrived yet, so we
+        # don't parse it again for every chunk of a large path.
+        self.pendingCommand = None
+        self.pendingLength = 0
+
+        self._exported = [] # memoryviews to release before moving bytes around
+
+    # Number of bytes received but not yet returned as part of a command.
+    def __len__(self):
+        return self.end - self.start
+
+    def _releaseViews(self):
+        for view in self._exported:
+            view.release()
+        self._exported.clear()
+
+    # Makes room for at least `size` more bytes after `self.end`, discarding
+    # already-decoded bytes first and only growing the buffer if that's not enough.
+    def _reserve(self, size):
+        self._releaseViews()
+        remaining = self.end - self.start
+        if remaining == 0:
+            self.start = self.end = 0
+        if len(self.buffer) - self.end >= size:
+            return
+        newSize = len(self.buffer)
+        while newSize < remaining + size:
+            newSize *= 2
+        begin = self.start
+        try:
+            if begin > 0:
+                # Shift the undecoded bytes to the front, in place.
+                self.buffer[:remaining] = self.buffer[begin:self.end]
+                begin = 0
+            if newSize > len(self.buffer):
+                self.buffer.extend(bytes(newSize - len(self.buffer)))
+        except BufferError:
+            # A caller still holds a payload view, so the bytearray can't be
+            # resized; continue in a fresh one instead.
+            old = self.buffer
+            self.buffer = bytearray(newSize)
+            self.buffer[:remaining] = old[begin:begin + remaining]
+        self.start = 0
+        self.end = remaining
+
+    # Appends received bytes to the decoder.
+    def feed(self, data):
+        size = len(data)
+        # Most chunks of a large payload fit after what's already there.
+        if self._exported or len(self.buffer) - self.end < size:
+            self._reserve(size)
+        self.buffer[self.end:self.end + size] = data
+        self.end += size
+
+    # Returns a writable memoryview of free space at the end of the buffer, for
+    # receiving into directly (e.g. with socket.recv_into() or
+    # loop.sock_recv_into()). Call received() with the number of bytes written.
+    def receiveBuffer(self, bufsize=4096):
+        # Ask for at least the rest of a pending payload so large paths arrive
+        # in as few calls as possible.
+        if self.pendingCommand is not None:
+            bufsize = max(bufsize, self.pendingLength - (self.end - self.start))
+        self._reserve(bufsize)
+        view = memoryview(self.buffer)[self.end:self.end + bufsize]
+        self._exported.append(view)
+        return view
+
+    def received(self, count):
+        self.end += count
+
+    # Receives directly into the decoder's buffer (no intermediate bytes object).
+    # Returns the number of bytes received, which is 0 when the peer disconnected.
+    def recvInto(self, sock, bufsize=4096):
+        count = sock.recv_into(self.receiveBuffer(bufsize))
+        self.received(count)
+        return count
+
+    # Parses an ASCII integer header field starting at `offset`. Returns the int
+    # and the offset just past its separator, or (None, offset) if the separator
+    # hasn't arrived yet.
+    def _readHeaderField(self, offset):
+        index = self.buffer.find(self.separator, offset, self.end)
+        if index == -1:
+            if self.end - offset > self.maxHeaderField:
+                raise ProtocolException("Header field too long: " + str(bytes(self.buffer[offset:offset + self.maxHeaderField])))
+            return None, offset
+        if index == offset:
+            raise ProtocolException("Invalid zero-length")
+        if index - offset > self.maxHeaderField:
+            raise ProtocolException("Header field too long: " + str(bytes(self.buffer[offset:offset + self.maxHeaderField])))
+        try:
+            return int(self.buffer[offset:index]), index + 1
+        except ValueError:
+            raise ProtocolException("Header field is not a number: " + str(bytes(self.buffer[offset:index])))
+
+    # Returns the next complete (NetworkCommand, payload) or None if more bytes
+    # are needed.
+    def next(self):
+        if self.pendingCommand is None:
+            commandNumber, offset = self._readHeaderField(self.start)
+            if commandNumber is None:
+                return None
+            if not NetworkCommand.has_value(commandNumber):
+                raise ProtocolException("Invalid command number received: " + str(commandNumber))
+            pathLength, offset = self._readHeaderField(offset)
+            if pathLength is None:
+                return None
+            if pathLength < 0 or pathLength > MAX_PAYLOAD:
+                raise ProtocolException("Invalid payload length: " + str(pathLength))
+            self.pendingCommand = NetworkCommand(commandNumber)
+            self.pendingLength = pathLength
+            self.start = offset # The header is consumed; only the payload remains
+        if self.end - self.start < self.pendingLength:
+            return None
+        view = memoryview(self.buffer)
+        self._exported.append(view)
+        payload = view[self.start:self.start + self.pendingLength]
+        self._exported.append(payload)
+        command = self.pendingCommand
+        self.start += self.pendingLength
+        self.pendingCommand = None
+        self.pendingLength = 0
+        return (command, payload)
+
+    def __iter__(self):
+        while True:
+            frame = self.next()
+            if frame is None:
+                return
+            yield frame
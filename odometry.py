@@ -0,0 +1,165 @@
+# Dead reckoning: where the car is, from what the motors were told to do and,
+# if there is one, the gyro. Every motor command is passed on and the pose is
+# integrated between them (the wheels turn at a constant speed in between),
+# then recorded in a timestamped trajectory:
+#
+#   odometry = Odometry(driveSpeed=44, turnRate=360, heading=imuSampler.heading)
+#   odometry.motors(duty1, duty2, duty3, duty4)    # with every setMotorModel
+#   ...
+#   (x, y, theta) = odometry.pose()
+#   (x, y, theta) = odometry.poseAt(t)             # any time.monotonic() time since start
+#   odometry.save('trajectory.csv')
+#
+# Poses are (x, y, theta) in cm and degrees from where the car started: x
+# straight ahead, y to the right and theta clockwise, like turn angles.
+# theta isn't wrapped, so a full turn to the right ends at 360.
+
+import math
+import threading
+import time
+import numpy as np
+
+# Columns of the trajectory array
+T = 0
+X = 1
+Y = 2
+THETA = 3
+
+class Odometry:
+    # @param driveSpeed -- cm/s the car drives at full speed.
+    # @param turnRate -- degrees/s the car turns in place at full speed.
+    # @param heading -- function returning the gyro's heading in degrees,
+    # clockwise positive (e.g. ImuSampler.heading or HeadingFusion.heading),
+    # used instead of the motors for turning; or None.
+    # @param capacity -- poses to make room for up front; the array doubles
+    # when it fills up.
+    def __init__(self, driveSpeed=44.0, turnRate=360.0, heading=None, capacity=4096):
+        self.driveSpeed = driveSpeed
+        self.turnRate = turnRate
+        self.heading = heading
+        self.lock = threading.Lock()
+        self.trajectory = np.empty((capacity, 4))
+        self.count = 0
+        self.speed = 0.0 # cm/s forward
+        self.rate = 0.0 # Degrees/s clockwise, from the motors
+        now = time.monotonic()
+        self.lastHeading = heading() if heading is not None else None
+        self.corrections = 0.0 # Degrees added by correctTurn()
+        self._record(now, 0.0, 0.0, 0.0)
+
+    def _record(self, t, x, y, theta):
+        if self.count == len(self.trajectory):
+            grown = np.empty((2 * len(self.trajectory), 4))
+            grown[:self.count] = self.trajectory
+            self.trajectory = grown
+        self.trajectory[self.count] = (t, x, y, theta)
+        self.count += 1
+
+    # The pose `dt` seconds after `pose` at the current speeds, turning by
+    # `turned` degrees (from the motors if None).
+    def _advance(self, pose, dt, turned=None):
+        (x, y, theta) = pose
+        if turned is None:
+            turned = self.rate * dt
+        distance = self.speed * dt
+        if abs(turned) < 1e-9:
+            heading = math.radians(theta)
+            return (x + distance * math.cos(heading), y + distance * math.sin(heading), theta)
+        # Along the arc from theta to theta + turned.
+        (start, end) = (math.radians(theta), math.radians(theta + turned))
+        radius = distance / (end - start)
+        return (x + radius * (math.sin(end) - math.sin(start)),
+                y - radius * (math.cos(end) - math.cos(start)),
+                theta + turned)
+
+    # Brings the trajectory up to time `t` and records the pose there.
+    def _update(self, t):
+        last = self.trajectory[self.count - 1]
+        if t <= last[T]:
+            return
+        turned = None
+        if self.heading is not None:
+            heading = self.heading()
+            turned = heading - self.lastHeading
+            self.lastHeading = heading
+        self._record(t, *self._advance(last[X:], t - last[T], turned))
+
+    # Takes the duties just given to Motor.setMotorModel. Negative duties
+    # drive forward; wheels 1 and 2 are on the left, 3 and 4 on the right.
+    def motors(self, duty1, duty2, duty3, duty4):
+        with self.lock:
+            self._update(time.monotonic())
+            left = -(duty1 + duty2) / 2 / 4095
+            right = -(duty3 + duty4) / 2 / 4095
+            self.speed = (left + right) / 2 * self.driveSpeed
+            self.rate = (left - right) / 2 * self.turnRate
+
+    # Records the pose now, e.g. every so often while driving straight, so
+    # the trajectory follows the gyro more closely.
+    def sample(self):
+        with self.lock:
+            self._update(time.monotonic())
+
+    # Returns a mark to pass to correctTurn() after a turn.
+    def mark(self):
+        with self.lock:
+            self._update(time.monotonic())
+            return float(self.trajectory[self.count - 1, THETA])
+
+    # Sets how far the car turned since mark() to `degrees` as measured
+    # (e.g. TurnResult.heading), instead of what the motors suggest. Does
+    # nothing when following the gyro.
+    def correctTurn(self, mark, degrees):
+        with self.lock:
+            self._update(time.monotonic())
+            if self.heading is not None:
+                return
+            pose = self.trajectory[self.count - 1]
+            correction = mark + degrees - pose[THETA]
+            self.corrections += correction
+            self._record(pose[T] + 1e-9, pose[X], pose[Y], pose[THETA] + correction)
+
+    # (x, y, theta) now.
+    def pose(self):
+        with self.lock:
+            self._update(time.monotonic())
+            return tuple(float(v) for v in self.trajectory[self.count - 1, X:])
+
+    # (x, y, theta) at time.monotonic() time `t`, interpolated between the
+    # recorded poses; from the current speeds after the latest one.
+    def poseAt(self, t):
+        with self.lock:
+            times = self.trajectory[:self.count, T]
+            if t <= times[0]:
+                return tuple(float(v) for v in self.trajectory[0, X:])
+            if t >= times[-1]:
+                last = self.trajectory[self.count - 1]
+                turned = None if self.heading is None else 0.0
+                return tuple(float(v) for v in self._advance(last[X:], t - last[T], turned))
+            i = np.searchsorted(times, t, side='right')
+            (before, after) = (self.trajectory[i - 1], self.trajectory[i])
+            fraction = (t - before[T]) / (after[T] - before[T])
+            return tuple(float(v) for v in before[X:] + fraction * (after[X:] - before[X:]))
+
+    # Copy of the trajectory so far: an array of rows (t, x, y, theta), t in
+    # time.monotonic() seconds.
+    def history(self):
+        with self.lock:
+            self._update(time.monotonic())
+            return self.trajectory[:self.count].copy()
+
+    # Writes the trajectory as CSV (t, x, y, theta, with t in seconds since
+    # the start), or as a NumPy .npy file if `path` ends in .npy.
+    def save(self, path):
+        trajectory = self.history()
+        trajectory[:, T] -= trajectory[0, T]
+        if path.endswith('.npy'):
+            np.save(path, trajectory)
+        else:
+            np.savetxt(path, trajectory, delimiter=',', header='t,x,y,theta', comments='', fmt='%.4f')
+
+    def stats(self):
+        with self.lock:
+            (x, y, theta) = (float(v) for v in self.trajectory[self.count - 1, X:])
+            return {'poses': self.count, 'x': x, 'y': y, 'theta': theta,
+                    'turn_corrections_degrees': self.corrections}
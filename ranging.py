@@ -0,0 +1,115 @@
+# Ultrasonic (HC-SR04) ranging backends. Each one takes the GPIO module to use
+# (RPi.GPIO on the robot, or simulation.gpio.SimulatedGPIO off it), so nothing
+# here touches hardware at import time.
+#
+# A ping: raise the trigger pin for ~10 us, then the sensor raises the echo pin
+# for as long as the sound took to come back (about 58 us per cm of distance).
+# With nothing in range the echo stays high for ~38 ms.
+
+import threading
+import time
+
+NS_PER_CM = 58000 # Echo pulse length per cm of distance (round trip at ~343 m/s)
+MAX_RANGE_CM = 400 # Farthest the HC-SR04 measures reliably
+TRIGGER_PULSE = 0.00015 # Seconds the trigger pin is held high
+ECHO_START_TIMEOUT_NS = 2000000 # The echo rises ~0.5 ms after the trigger; allow for scheduling
+MIN_PING_INTERVAL = 0.06 # Seconds between pings recommended by the HC-SR04 datasheet, so echoes die down
+
+# The original ranging: spin on GPIO.input() until the echo changes, giving up
+# after a fixed number of iterations. Burns a core while waiting, and both its
+# resolution and its timeout depend on how fast the loop runs.
+class PollingRanger:
+    def __init__(self, gpio, trigger_pin, echo_pin, spins=10000):
+        self.gpio = gpio
+        self.trigger_pin = trigger_pin
+        self.echo_pin = echo_pin
+        self.spins = spins
+
+    def send_trigger_pulse(self):
+        self.gpio.output(self.trigger_pin, True)
+        time.sleep(TRIGGER_PULSE)
+        self.gpio.output(self.trigger_pin, False)
+
+    def wait_for_echo(self, value, timeout):
+        count = timeout
+        while self.gpio.input(self.echo_pin) != value and count > 0:
+            count = count - 1
+
+    # Returns the distance in cm. A missed echo gives a meaningless value.
+    def ping(self):
+        self.send_trigger_pulse()
+        self.wait_for_echo(True, self.spins)
+        start = time.time()
+        self.wait_for_echo(False, self.spins)
+        finish = time.time()
+        return (finish - start) / 0.000058
+
+    def close(self):
+        pass
+
+# Ranging with GPIO edge events: the echo pin's edges are timestamped with
+# perf_counter_ns() in the GPIO library's callback thread, and ping() sleeps
+# until the falling edge arrives or the echo would be past `maxRange`.
+class EdgeRanger:
+    def __init__(self, gpio, trigger_pin, echo_pin, maxRange=MAX_RANGE_CM):
+        self.gpio = gpio
+        self.trigger_pin = trigger_pin
+        self.echo_pin = echo_pin
+        self.maxRange = maxRange
+        self.rise = None # perf_counter_ns() of the last rising edge
+        self.pulse = None # Length in ns of the last complete echo pulse
+        self.done = threading.Event()
+        self.timeouts = 0
+        gpio.add_event_detect(echo_pin, gpio.BOTH, callback=self._edge)
+
+    # Edges alternate, so the first one after a trigger is the rising edge.
+    # (Reading the pin here instead could already see the end of a short echo.)
+    def _edge(self, channel):
+        now = time.perf_counter_ns()
+        if self.rise is None:
+            self.rise = now
+        elif self.pulse is None:
+            self.pulse = now - self.rise
+            self.done.set()
+
+    # Longest time to wait for an echo, in seconds.
+    def timeout(self):
+        return (ECHO_START_TIMEOUT_NS + self.maxRange * NS_PER_CM) / 1e9
+
+    # Returns the distance in cm, or None if no echo came back from within
+    # maxRange.
+    def ping(self):
+        # A missed echo can still be high; pinging now would be measured from
+        # its falling edge.
+        deadline = time.monotonic() + self.timeout()
+        while self.gpio.input(self.echo_pin) and time.monotonic() < deadline:
+            time.sleep(0.001)
+        self.rise = None
+        self.pulse = None
+        self.done.clear()
+        self.gpio.output(self.trigger_pin, True)
+        time.sleep(TRIGGER_PULSE)
+        self.gpio.output(self.trigger_pin, False)
+        if not self.done.wait(self.timeout()) or self.pulse is None:
+            self.timeouts += 1
+            return None
+        distance = self.pulse / NS_PER_CM
+        if distance > self.maxRange:
+            self.timeouts += 1
+            return None
+        return distance
+
+    def close(self):
+        self.gpio.remove_event_detect(self.echo_pin)
+
+# Returns an EdgeRanger, or a PollingRanger if the GPIO library can't do edge
+# detection on `echo_pin` (e.g. an old kernel).
+def makeRanger(gpio, trigger_pin, echo_pin, backend='edge', maxRange=MAX_RANGE_CM):
+    if backend == 'edge':
+        try:
+            return EdgeRanger(gpio, trigger_pin, echo_pin, maxRange)
+        except RuntimeError as e:
+            print("Edge detection unavailable (" + str(e) + "), polling the echo pin instead")
+    elif backend != 'polling':
+        raise ValueError("Unknown ranging backend: " + str(backend))
+    return PollingRanger(gpio, trigger_pin, echo_pin)
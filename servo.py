@@ -1,9 +1,9 @@
 import time
-from PCA9685 import PCA9685
+import devices
 class Servo:
-    def __init__(self):
-        self.PwmServo = PCA9685(0x40, debug=True)
-        self.PwmServo.setPWMFreq(50)
+    # @param pwm -- the PCA9685 driving the servos; the car's shared one by default.
+    def __init__(self, pwm=None):
+        self.PwmServo = pwm if pwm is not None else devices.pwm()
         self.PwmServo.setServoPulse(8,1500)
         self.PwmServo.setServoPulse(9,1500)
     def setServoPwm(self,channel,angle,error=10):
@@ -27,7 +27,7 @@ class Servo:
 
 # Main program logic follows:
 if __name__ == '__main__':
-    pwm=Servo()
+    pwm=devices.servo()
     pwm.setServoPwm('0',90)
     pwm.setServoPwm('1',90)
 
@@ -0,0 +1,178 @@
+# Virtual clock for running the robot code faster than real time. Once
+# installed, time.sleep() and the time module's clocks (and timeit's
+# default_timer) run on virtual time:
+#
+#   clock = VirtualClock()
+#   install(clock)
+#
+# Virtual time only moves forward when something is waiting on it. Every
+# thread that has called time.sleep() takes part; when all of them are
+# asleep, the clock jumps straight to the earliest wake-up. If a thread that
+# takes part is busy or blocked on something else (a lock, a socket, an
+# Event), the clock waits `idleAdvance` real seconds for it and then jumps
+# anyway, so nothing waits on virtual time forever.
+#
+# schedule() runs a function at an exact virtual time on the clock's own
+# thread, with the clock stopped at that time while it runs. Simulated
+# hardware uses it so that whatever the function triggers (e.g. a GPIO edge
+# callback) sees exactly that time.
+
+import heapq
+import math
+import itertools
+import threading
+import time
+import timeit
+
+# The real functions, before install() replaces them.
+realTime = {name: getattr(time, name) for name in
+            ('sleep', 'time', 'time_ns', 'monotonic', 'monotonic_ns', 'perf_counter', 'perf_counter_ns')}
+realDefaultTimer = timeit.default_timer
+
+# Raised from time.sleep() on the main thread once virtual time passes the
+# clock's limit.
+class SimulationTimeout(Exception):
+    pass
+
+class VirtualClock:
+    # @param epoch -- what time.time() returns at virtual time 0.
+    # @param limit -- virtual seconds after which the main thread's sleeps
+    # raise SimulationTimeout, or None.
+    def __init__(self, epoch=None, idleAdvance=0.0002, limit=None):
+        self.condition = threading.Condition()
+        self.now = 0 # Virtual time in ns
+        self.epoch = realTime['time']() if epoch is None else epoch
+        self.idleAdvance = idleAdvance
+        self.limit = None if limit is None else int(limit * 1e9)
+        self.sleepers = {} # thread -> virtual time in ns it wakes up at
+        self.participants = set() # Threads that have slept
+        self.timers = [] # Heap of (virtual time in ns, tiebreak, function)
+        self.tiebreak = itertools.count()
+        self.activity = 0 # Incremented whenever a thread starts or stops sleeping
+        self.closed = False
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    # Clocks #
+
+    def perf_counter_ns(self):
+        return self.now
+
+    def perf_counter(self):
+        return self.now / 1e9
+
+    monotonic_ns = perf_counter_ns
+    monotonic = perf_counter
+
+    def time(self):
+        return self.epoch + self.now / 1e9
+
+    def time_ns(self):
+        return int(self.epoch * 1e9) + self.now
+
+    # Waiting #
+
+    def sleep(self, seconds):
+        if seconds <= 0:
+            realTime['sleep'](0)
+            return
+        # Rounded up, so a sleep until a time is never a little short.
+        self.sleepUntil(self.now + math.ceil(seconds * 1e9))
+
+    def sleepUntil(self, at):
+        me = threading.current_thread()
+        with self.condition:
+            if self.limit is not None and at > self.limit and me is threading.main_thread():
+                raise SimulationTimeout("Simulation ran past " + str(self.limit / 1e9) + " virtual seconds")
+            self.participants.add(me)
+            self.sleepers[me] = at
+            self.activity += 1
+            self.condition.notify_all()
+            try:
+                while self.now < at and not self.closed:
+                    self.condition.wait()
+            finally:
+                del self.sleepers[me]
+                self.activity += 1
+                self.condition.notify_all()
+
+    # Makes the main thread's sleeps raise SimulationTimeout once they would
+    # go past `seconds` of virtual time.
+    def setLimit(self, seconds):
+        with self.condition:
+            self.limit = int(seconds * 1e9)
+
+    # Stops the calling thread from holding the clock back until it sleeps
+    # again, e.g. before it blocks waiting for input from outside.
+    def release(self):
+        with self.condition:
+            self.participants.discard(threading.current_thread())
+            self.condition.notify_all()
+
+    # Calls `function()` on the clock's thread at virtual time `at` (in ns).
+    def schedule(self, at, function):
+        with self.condition:
+            heapq.heappush(self.timers, (at, next(self.tiebreak), function))
+            self.condition.notify_all()
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def _nextEvent(self):
+        wakes = [at for at in self.sleepers.values()]
+        if self.timers:
+            wakes.append(self.timers[0][0])
+        return min(wakes) if wakes else None
+
+    def _allAsleep(self):
+        for thread in list(self.participants):
+            if not thread.is_alive():
+                self.participants.discard(thread)
+            elif thread not in self.sleepers:
+                return False
+        return True
+
+    def _run(self):
+        while True:
+            function = None
+            with self.condition:
+                if self.closed:
+                    return
+                nextEvent = self._nextEvent()
+                if nextEvent is None:
+                    self.condition.wait()
+                    continue
+                if nextEvent > self.now:
+                    if not self._allAsleep():
+                        # Give busy threads a moment to get to their next sleep.
+                        activity = self.activity
+                        self.condition.wait(self.idleAdvance)
+                        if self.activity != activity or self._nextEvent() != nextEvent:
+                            continue
+                    self.now = nextEvent
+                if self.timers and self.timers[0][0] <= self.now:
+                    (_, _, function) = heapq.heappop(self.timers)
+                else:
+                    # Sleepers are due; let them run before moving on.
+                    self.condition.notify_all()
+                    self.condition.wait(self.idleAdvance)
+                    continue
+            function()
+
+# Makes the time module (and timeit.default_timer) use `clock`.
+def install(clock):
+    time.sleep = clock.sleep
+    time.time = clock.time
+    time.time_ns = clock.time_ns
+    time.monotonic = clock.monotonic
+    time.monotonic_ns = clock.monotonic_ns
+    time.perf_counter = clock.perf_counter
+    time.perf_counter_ns = clock.perf_counter_ns
+    timeit.default_timer = clock.perf_counter
+
+def uninstall():
+    for name, function in realTime.items():
+        setattr(time, name, function)
+    timeit.default_timer = realDefaultTimer
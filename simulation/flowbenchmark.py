@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Off-robot benchmark of the optical flow pipeline in flow.py, replaying
+# video clips instead of reading the camera, so it runs headless and
+# repeatably. Clips are video files (recorded on the car, or written by
+# simulation/flowdataset.py) or, with none given, a synthetic clip made on
+# the fly. Every frame goes through OpticalFlow as it would while turning,
+# at each of `--scales`, and the rotations are added up into a heading.
+# Reports frames per second, a latency histogram for each stage, and, for
+# clips with known headings (a CSV file next to the video, see
+# flowdataset.py), how far the added-up heading ends up from the truth, as
+# JSON, e.g.
+#   python -m simulation.flowbenchmark --seconds 20 --scales 1 0.5 --output flow.json
+#   python -m simulation.flowbenchmark clip.avi recorded.mp4
+
+import argparse
+import json
+import math
+import platform
+import time
+import cv2
+import numpy as np
+from . import flowdataset
+import devices
+import flow
+
+# Edges of the latency histograms' buckets, in milliseconds
+HISTOGRAM_MS = [0, 0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 50, 100, 200]
+
+class EndOfClip(Exception):
+    pass
+
+# Raises EndOfClip instead of returning an empty frame at the end, since
+# OpticalFlow would keep trying to read.
+class Replay:
+    def __init__(self, capture):
+        self.capture = capture
+
+    def read(self):
+        (ret, frame) = self.capture.read()
+        if not ret:
+            raise EndOfClip()
+        return (ret, frame)
+
+    def get(self, propId):
+        return self.capture.get(propId)
+
+    def set(self, propId, value):
+        return self.capture.set(propId, value)
+
+    def isOpened(self):
+        return self.capture.isOpened()
+
+    def release(self):
+        self.capture.release()
+
+# Frames already in memory, with `like`'s properties.
+class FrameList:
+    def __init__(self, frames, like):
+        self.frames = frames
+        self.like = like
+        self.index = 0
+
+    def read(self):
+        if self.index >= len(self.frames):
+            return (False, None)
+        self.index += 1
+        return (True, self.frames[self.index - 1])
+
+    def get(self, propId):
+        return self.like.get(propId)
+
+    def set(self, propId, value):
+        return False
+
+    def isOpened(self):
+        return True
+
+    def release(self):
+        pass
+
+# Count per HISTOGRAM_MS bucket, and percentiles, of `seconds`.
+def latencies(seconds):
+    ms = np.array(seconds) * 1000
+    counts = np.histogram(ms, bins=HISTOGRAM_MS + [math.inf])[0]
+    return {
+        'histogram': [int(count) for count in counts],
+        'p50_ms': float(np.percentile(ms, 50)),
+        'p95_ms': float(np.percentile(ms, 95)),
+        'max_ms': float(ms.max()),
+    }
+
+# Runs `opener()`'s clip through OpticalFlow at `scale`. `headings` are the
+# clip's true headings per frame, or None.
+def replay(opener, headings, scale, minFeatures):
+    devices.configure(camera=lambda source: Replay(opener()))
+    devices.reset()
+    opticalFlow = flow.OpticalFlow(scale=scale, minFeatures=minFeatures)
+    stages = {stage: [] for stage in flow.STAGES}
+    frameSeconds = []
+    estimates = [] # (frame, heading added up so far)
+    heading = 0.0
+    start = time.perf_counter()
+    try:
+        opticalFlow.prepare()
+        first = opticalFlow.frames - 1
+        while True:
+            opticalFlow.timings.clear()
+            frameStart = time.perf_counter()
+            result = opticalFlow.computeCentermostFlow()
+            if isinstance(result, tuple):
+                # Clockwise positive, like FlowHeading's.
+                heading -= math.degrees(opticalFlow.computeRadiansOfCameraRotation(None, result[1]))
+            frameSeconds.append(time.perf_counter() - frameStart)
+            for stage, seconds in opticalFlow.timings.items():
+                stages[stage].append(seconds)
+            estimates.append((opticalFlow.frames - 1, heading))
+    except EndOfClip:
+        pass
+    elapsed = time.perf_counter() - start
+    stats = opticalFlow.stats()
+
+    result = {
+        'scale': scale,
+        'frames': stats['frames'],
+        'fps': stats['frames'] / elapsed,
+        'processing_fps': stats['processing_fps'],
+        'features': stats['features'],
+        'frame_latency': latencies(frameSeconds),
+        'stage_latency': {stage: latencies(seconds) for stage, seconds in stages.items() if seconds},
+    }
+    if headings is not None and estimates:
+        (frames, estimated) = (np.array([e[0] for e in estimates]), np.array([e[1] for e in estimates]))
+        truth = headings[frames] - headings[first]
+        errors = estimated - truth
+        steps = np.diff(np.concatenate([[0.0], estimated])) - np.diff(np.concatenate([[0.0], truth]))
+        result.update({
+            'turned_degrees': float(np.abs(np.diff(headings)).sum()),
+            'final_heading_error_degrees': float(errors[-1]),
+            'max_abs_heading_error_degrees': float(np.abs(errors).max()),
+            'mean_abs_frame_error_degrees': float(np.abs(steps).mean()),
+        })
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the optical flow pipeline on replayed clips")
+    parser.add_argument('clips', nargs='*', help="video files; a synthetic clip if none")
+    parser.add_argument('--scales', type=float, nargs='+', default=[1.0, 0.5], help="OpticalFlow scales to run at")
+    parser.add_argument('--min-features', type=int, default=50, help="OpticalFlow's minFeatures")
+    parser.add_argument('--seconds', type=float, default=20, help="length of the synthetic clip")
+    parser.add_argument('--width', type=int, default=640, help="synthetic frame width")
+    parser.add_argument('--height', type=int, default=480, help="synthetic frame height")
+    parser.add_argument('--max-rate', type=float, default=300, help="synthetic clip's fastest turn, degrees/s")
+    parser.add_argument('--threads', type=int, default=None, help="OpenCV threads (e.g. 1, like a busy Pi)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=None, help="file to write the JSON to instead of stdout")
+    args = parser.parse_args()
+    if args.threads is not None:
+        cv2.setNumThreads(args.threads)
+
+    # (name, function opening the clip, true headings or None)
+    clips = []
+    for path in args.clips:
+        clips.append((path, lambda path=path: cv2.VideoCapture(path), flowdataset.loadHeadings(path)))
+    if not clips:
+        # Rendered once, so rendering isn't timed along with the pipeline.
+        capture = flowdataset.synthetic(args.seconds, args.width, args.height, maxRate=args.max_rate, seed=args.seed)
+        frames = []
+        while True:
+            (ret, frame) = capture.read()
+            if not ret:
+                break
+            frames.append(frame)
+        clips.append(('synthetic', lambda: FrameList(frames, capture), capture.headings))
+
+    results = []
+    for (name, opener, headings) in clips:
+        for scale in args.scales:
+            result = replay(opener, headings, scale, args.min_features)
+            result['clip'] = name
+            results.append(result)
+
+    result = {
+        'config': {
+            'clips': [name for (name, opener, headings) in clips],
+            'scales': args.scales,
+            'min_features': args.min_features,
+            'synthetic': None if args.clips else {
+                'seconds': args.seconds, 'width': args.width, 'height': args.height,
+                'max_rate': args.max_rate, 'seed': args.seed,
+            },
+            'threads': cv2.getNumThreads(),
+            'histogram_edges_ms': HISTOGRAM_MS,
+            'python': platform.python_version(),
+            'opencv': cv2.__version__,
+            'machine': platform.machine(),
+        },
+        'results': results,
+    }
+    text = json.dumps(result, indent=2)
+    if args.output is None:
+        print(text)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Synthetic clips for optical flow with known ground truth: a pinhole camera
+# turning in place inside a cylinder papered with a random, non-repeating
+# texture (unlike the mazes' checkerboards, which flow can lock onto the
+# wrong square of). The camera makes turns of random angles and speeds, with
+# pauses in between; every frame's heading is known exactly. Frames come from
+# PanoramaCapture, which stands in for a cv2.VideoCapture, or are written to
+# a video file with the headings in a CSV file next to it:
+#   python -m simulation.flowdataset clip.avi --seconds 20 --seed 0
+# writes clip.avi and clip.csv (frame, t, heading in degrees, clockwise
+# positive like turn angles). Needs cv2 and numpy.
+
+import argparse
+import math
+import os
+import cv2
+import numpy as np
+
+PANORAMA_WIDTH = 2048 # Pixels for 360 degrees
+
+# Random texture `width` by `height`, wrapping around horizontally: noise
+# blurred at several scales, so there are corners of every size.
+def makePanorama(rng, width=PANORAMA_WIDTH, height=512):
+    texture = np.zeros((height, width), np.float32)
+    for sigma in (1.5, 4, 12):
+        noise = rng.standard_normal((height, width)).astype(np.float32)
+        # Blurred with the other end's columns on either side, so it wraps.
+        pad = int(4 * sigma)
+        blurred = cv2.GaussianBlur(np.pad(noise, ((0, 0), (pad, pad)), mode='wrap'), (0, 0), sigma)
+        texture += sigma * blurred[:, pad:pad + width]
+    return cv2.normalize(texture, None, 0, 255, cv2.NORM_MINMAX).astype(np.uint8)
+
+# Headings in degrees (clockwise positive) of `frames` frames at `fps`:
+# turns of 20 to 180 degrees either way at peak rates of 60 to `maxRate`
+# degrees per second, each speeding up and slowing down smoothly
+# (sin^2 rate), with pauses of 0.2 to 0.6 seconds in between.
+def turnHeadings(rng, frames, fps=30, maxRate=300):
+    times = np.arange(frames) / fps
+    headings = np.zeros(frames)
+    (start, base) = (rng.uniform(0.2, 0.6), 0.0)
+    while start < times[-1]:
+        angle = rng.choice([-1, 1]) * rng.uniform(20, 180)
+        duration = 2 * abs(angle) / rng.uniform(60, maxRate) # sin^2 averages to half the peak
+        phase = np.clip((times - start) / duration, 0, 1)
+        # Integral of the sin^2 rate, from 0 to `angle`.
+        turned = angle * (phase - np.sin(2 * math.pi * phase) / (2 * math.pi))
+        during = times >= start
+        headings[during] = base + turned[during]
+        base += angle
+        start += duration + rng.uniform(0.2, 0.6)
+    return headings
+
+# Renders the camera's view of the panorama for each of `headings` in turn;
+# read() returns (False, None) after the last one. Frames are BGR uint8 like
+# cv2's, with Gaussian noise of `noise` gray levels.
+class PanoramaCapture:
+    def __init__(self, panorama, headings, width=320, height=240, fov=75, fps=30, noise=2.0, seed=None):
+        self.panorama = panorama
+        self.headings = headings
+        self.width = width
+        self.height = height
+        self.fps = fps
+        self.noise = noise
+        self.rng = np.random.default_rng(seed)
+        self.index = 0
+        self.opened = True
+        # A point on the cylinder at angle a and height h (in radii) is seen
+        # at u = f tan(a - heading), v = f h / cos(a - heading).
+        focal = width / 2 / math.tan(math.radians(fov) / 2)
+        scale = panorama.shape[1] / (2 * math.pi) # Panorama pixels per radian
+        u = np.arange(width, dtype=np.float32) - width / 2 + 0.5
+        v = np.arange(height, dtype=np.float32)[:, None] - height / 2 + 0.5
+        offsets = np.arctan(u / focal)
+        self.columns = np.broadcast_to(offsets * scale, (height, width)).astype(np.float32)
+        self.rows = (panorama.shape[0] / 2 + v / focal * np.cos(offsets) * scale).astype(np.float32)
+        self.scale = scale
+
+    def isOpened(self):
+        return self.opened
+
+    def release(self):
+        self.opened = False
+
+    def get(self, propId):
+        return {cv2.CAP_PROP_FRAME_WIDTH: self.width, cv2.CAP_PROP_FRAME_HEIGHT: self.height,
+                cv2.CAP_PROP_FPS: self.fps, cv2.CAP_PROP_FRAME_COUNT: len(self.headings),
+                cv2.CAP_PROP_POS_FRAMES: self.index}.get(propId, 0)
+
+    def set(self, propId, value):
+        return False
+
+    def read(self):
+        if not self.opened or self.index >= len(self.headings):
+            return (False, None)
+        shift = math.radians(self.headings[self.index]) * self.scale
+        self.index += 1
+        gray = cv2.remap(self.panorama, self.columns + np.float32(shift), self.rows, cv2.INTER_LINEAR,
+                         borderMode=cv2.BORDER_WRAP)
+        if self.noise > 0:
+            gray = np.clip(gray + self.rng.normal(0, self.noise, gray.shape), 0, 255).astype(np.uint8)
+        return (True, cv2.cvtColor(gray, cv2.COLOR_GRAY2BGR))
+
+# A PanoramaCapture of a random clip.
+def synthetic(seconds=20, width=320, height=240, fps=30, maxRate=300, noise=2.0, seed=0):
+    rng = np.random.default_rng(seed)
+    headings = turnHeadings(rng, int(seconds * fps), fps, maxRate)
+    return PanoramaCapture(makePanorama(rng), headings, width, height, fps=fps, noise=noise, seed=seed)
+
+# The CSV file of headings that goes with the video file at `path`.
+def headingsPath(path):
+    return os.path.splitext(path)[0] + '.csv'
+
+# Headings of each frame of the video file at `path`, or None if it has no
+# CSV file.
+def loadHeadings(path):
+    path = headingsPath(path)
+    if not os.path.exists(path):
+        return None
+    return np.loadtxt(path, delimiter=',', skiprows=1, ndmin=2)[:, 2]
+
+# Writes every frame of `capture` (a PanoramaCapture) to the video file at
+# `path` (Motion JPEG), and its headings to the CSV file next to it.
+def saveClip(capture, path):
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'MJPG'), capture.fps, (capture.width, capture.height))
+    if not writer.isOpened():
+        raise Exception("Can't write video file " + path)
+    while True:
+        (ret, frame) = capture.read()
+        if not ret:
+            break
+        writer.write(frame)
+    writer.release()
+    frames = np.arange(len(capture.headings))
+    np.savetxt(headingsPath(path), np.column_stack([frames, frames / capture.fps, capture.headings]),
+               delimiter=',', header='frame,t,heading', comments='', fmt=['%d', '%.4f', '%.4f'])
+
+def main():
+    parser = argparse.ArgumentParser(description="Write a synthetic optical flow clip with known headings")
+    parser.add_argument('output', help="video file to write, e.g. clip.avi; the headings go to clip.csv")
+    parser.add_argument('--seconds', type=float, default=20)
+    parser.add_argument('--width', type=int, default=320)
+    parser.add_argument('--height', type=int, default=240)
+    parser.add_argument('--fps', type=float, default=30)
+    parser.add_argument('--max-rate', type=float, default=300, help="fastest turn, degrees per second")
+    parser.add_argument('--noise', type=float, default=2.0, help="pixel noise, gray levels")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    capture = synthetic(args.seconds, args.width, args.height, args.fps, args.max_rate, args.noise, args.seed)
+    saveClip(capture, args.output)
+    print("Wrote " + str(len(capture.headings)) + " frames to " + args.output + " and " + headingsPath(args.output))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Off-robot benchmark of HeadingFusion, in a simulated maze on virtual time
+# (see simulation/robot.py). TurnController turns the car by random angles
+# steering by the gyro alone and by fused headings (the commanded turn rate
+# with the gyro and/or optical flow), at several turn speeds, and with the
+# gyro disconnected so the fusion has to do without it. Flow is run with
+# frames read in the control loop and grabbed on a background thread. Errors are against
+# how far the simulated car really turned; the cost of a fusion update is in
+# real time. Reports JSON, e.g.
+#   python -m simulation.fusionbenchmark simulation/mazes/rooms.txt --turns 20 --output fusion.json
+
+import argparse
+import json
+import math
+import platform
+import random
+import time
+from .clock import realTime
+from .robot import simulate
+from .world import loadMaze
+from imuSampler import ImuSampler
+from turnController import TurnController, GyroHeading
+from headingFusion import HeadingFusion, FusedHeading
+import devices
+
+TURN_DEGREES_PER_SECOND = 360 # At full speed, like algorithm.py's turn_degrees_per_second
+
+# Passes the gyro through until it's disconnected, then fails to read.
+class DisconnectableImu:
+    def __init__(self, imu):
+        self.imu = imu
+        self.disconnected = False
+
+    @property
+    def gyro(self):
+        if self.disconnected:
+            raise OSError("MPU6050 disconnected")
+        return self.imu.gyro
+
+# Times HeadingFusion.update in real time.
+class TimedFusion(HeadingFusion):
+    def __init__(self):
+        HeadingFusion.__init__(self)
+        self.updateTime = 0.0
+        self.updateCount = 0
+
+    def update(self, name, t, value):
+        start = realTime['perf_counter']()
+        used = HeadingFusion.update(self, name, t, value)
+        self.updateTime += realTime['perf_counter']() - start
+        self.updateCount += 1
+        return used
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark fused headings for turns in a simulated maze")
+    parser.add_argument('maze', help="maze file (see simulation/world.py)")
+    parser.add_argument('--turns', type=int, default=10, help="turns per configuration")
+    parser.add_argument('--speeds', type=float, nargs='+', default=[0.5, 0.8], help="turn speeds, 0 to 1")
+    parser.add_argument('--no-flow', action='store_true', help="skip configurations with optical flow (slow to render)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=None, help="file to write the JSON to instead of stdout")
+    args = parser.parse_args()
+
+    (clock, world) = simulate(loadMaze(args.maze), args.seed)
+    wheels = devices.motor()
+    def turn(speed):
+        wheels.setMotorModel(int(-4095 * speed), int(-4095 * speed), int(4095 * speed), int(4095 * speed))
+    def stop():
+        wheels.setMotorModel(0, 0, 0, 0)
+    def trueHeading():
+        with world.lock:
+            world.update()
+            return -math.degrees(world.heading)
+
+    imu = DisconnectableImu(devices.imu())
+    feeding = [] # The fusion the gyro goes to
+    def onSample(t, rate):
+        if feeding:
+            feeding[0].gyro(t, rate)
+    sampler = ImuSampler(imu, onSample=onSample)
+    sampler.start()
+    flow = None
+    threadedFlow = None
+    if not args.no_flow:
+        import flow as flowModule
+        flow = flowModule.OpticalFlow(timer=realTime['perf_counter'])
+        # Same camera, grabbed on a background thread while it's used.
+        threadedFlow = flowModule.OpticalFlow(threaded=True, timer=realTime['perf_counter'])
+        threadedFlow.cap.stop()
+
+    # (name, fuses the gyro, fuses flow, gyro disconnected, threaded camera)
+    configurations = [
+        ('gyro only', False, False, False, False),
+        ('fused gyro', True, False, False, False),
+        ('fused gyro, gyro disconnected', True, False, True, False),
+    ]
+    if flow is not None:
+        configurations += [
+            ('fused gyro + flow', True, True, False, False),
+            ('fused flow', False, True, False, False),
+            ('fused gyro + flow, threaded camera', True, True, False, True),
+            ('fused flow, threaded camera', False, True, False, True),
+        ]
+
+    rng = random.Random(args.seed)
+    angles = [rng.choice([-1, 1]) * rng.choice(range(10, 190, 10)) for _ in range(args.turns)]
+    realStart = realTime['perf_counter']()
+    results = []
+    for speed in args.speeds:
+        for (name, fuseGyro, useFlow, disconnected, threaded) in configurations:
+            fusion = None
+            camera = threadedFlow if threaded else flow
+            if threaded:
+                camera.cap.start()
+            if name == 'gyro only':
+                source = GyroHeading(sampler)
+            else:
+                fusion = TimedFusion()
+                if not fuseGyro:
+                    fusion.setEnabled('gyro', False)
+                if not useFlow:
+                    fusion.setEnabled('flow', False)
+                source = FusedHeading(fusion, TURN_DEGREES_PER_SECOND, camera if useFlow else None)
+                feeding[:] = [fusion]
+            imu.disconnected = disconnected
+            controller = TurnController(turn, stop, source, rate=30 if useFlow else 100, maxSpeed=speed)
+            errors = []
+            for angle in angles:
+                before = trueHeading()
+                controller.turnBy(angle)
+                time.sleep(0.25) # Let the car come to rest
+                turned = trueHeading() - before
+                errors.append(abs(turned - angle))
+            feeding[:] = []
+            imu.disconnected = False
+            result = {
+                'configuration': name,
+                'speed': speed,
+                'seconds_per_turn': controller.stats()['mean_turn_seconds'],
+                'mean_abs_error_degrees': sum(errors) / len(errors),
+                'max_abs_error_degrees': max(errors),
+                'missed_deadlines': controller.stats()['missed_deadlines'],
+                'timeouts': controller.stats()['timeouts'],
+            }
+            if useFlow:
+                # Stage timings in real time, over all configurations so far
+                result['camera'] = camera.stats()
+            if threaded:
+                camera.cap.stop() # Not release(): the camera is shared with `flow`
+            if fusion is not None:
+                result['update_microseconds'] = fusion.updateTime / fusion.updateCount * 1e6 \
+                    if fusion.updateCount else None
+                result['sensors'] = fusion.health()
+            results.append(result)
+    sampler.stop()
+
+    result = {
+        'config': {
+            'maze': args.maze,
+            'turns': args.turns,
+            'speeds': args.speeds,
+            'flow': flow is not None,
+            'seed': args.seed,
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+        },
+        'real_seconds': realTime['perf_counter']() - realStart,
+        'results': results,
+    }
+    text = json.dumps(result, indent=2)
+    if args.output is None:
+        print(text)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,225 @@
+# Stand-in for RPi.GPIO, for running and benchmarking the robot code off the
+# robot. A SimulatedGPIO has the same functions and constants as the RPi.GPIO
+# module, so it can be passed wherever that module is used:
+#
+#   gpio = SimulatedGPIO()
+#   SimulatedUltrasonic(gpio, 27, 22, distance=50)
+#   ranger = ranging.EdgeRanger(gpio, 27, 22)
+#
+# Simulated devices (e.g. SimulatedUltrasonic) watch output pins and schedule
+# input pin changes some time later. A background thread applies those changes
+# on time and runs edge callbacks, like RPi.GPIO's own event thread. Given a
+# simulation.clock.VirtualClock, the changes are made by the clock instead, at
+# exactly their virtual time.
+
+import heapq
+import itertools
+import random
+import threading
+import time
+from ranging import NS_PER_CM, MAX_RANGE_CM
+
+# Waits shorter than this are spun instead of slept, so edges happen within a
+# few microseconds of when they were scheduled.
+SPIN_NS = 500000
+
+class SimulatedGPIO:
+    BOARD = 10
+    BCM = 11
+    OUT = 0
+    IN = 1
+    LOW = 0
+    HIGH = 1
+    PUD_OFF = 20
+    PUD_DOWN = 21
+    PUD_UP = 22
+    RISING = 31
+    FALLING = 32
+    BOTH = 33
+
+    def __init__(self, clock=None):
+        self.clock = clock
+        self.now = time.perf_counter_ns if clock is None else clock.perf_counter_ns
+        self.condition = threading.Condition()
+        self.mode = None
+        self.levels = {} # pin -> 0 or 1
+        self.directions = {} # pin -> IN or OUT
+        self.detectors = {} # pin -> [edge, [callbacks], whether an edge happened]
+        self.outputListeners = {} # pin -> [function(pin, level, time in ns)]
+        self.edgeCount = 0 # Incremented on every edge, for wait_for_edge()
+        self.lastEdge = None # (pin, level) of the latest edge
+        self.events = [] # Heap of (time in ns, tiebreak, pin, level)
+        self.tiebreak = itertools.count()
+        self.closed = False
+        if clock is None:
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+
+    # RPi.GPIO API #
+
+    def setwarnings(self, flag):
+        pass
+
+    def setmode(self, mode):
+        self.mode = mode
+
+    def setup(self, pin, direction, pull_up_down=PUD_OFF, initial=LOW):
+        with self.condition:
+            self.directions[pin] = direction
+            if pin not in self.levels:
+                self.levels[pin] = 1 if pull_up_down == self.PUD_UP else initial
+
+    def output(self, pin, value):
+        if self.directions.get(pin) != self.OUT:
+            raise RuntimeError("The GPIO channel has not been set up as an OUTPUT")
+        level = 1 if value else 0
+        with self.condition:
+            changed = self.levels.get(pin) != level
+            self.levels[pin] = level
+        if changed:
+            now = self.now()
+            for listener in self.outputListeners.get(pin, ()):
+                listener(pin, level, now)
+
+    def input(self, pin):
+        return self.levels.get(pin, 0)
+
+    def add_event_detect(self, pin, edge, callback=None, bouncetime=None):
+        with self.condition:
+            if pin in self.detectors:
+                raise RuntimeError("Conflicting edge detection already enabled for this GPIO channel")
+            self.detectors[pin] = [edge, [] if callback is None else [callback], False]
+
+    def add_event_callback(self, pin, callback):
+        with self.condition:
+            if pin not in self.detectors:
+                raise RuntimeError("Add event detection using add_event_detect first before adding a callback")
+            self.detectors[pin][1].append(callback)
+
+    def remove_event_detect(self, pin):
+        with self.condition:
+            self.detectors.pop(pin, None)
+
+    def event_detected(self, pin):
+        with self.condition:
+            detector = self.detectors.get(pin)
+            if detector is None or not detector[2]:
+                return False
+            detector[2] = False
+            return True
+
+    # Returns `pin` once it has an `edge`, or None after `timeout` ms.
+    def wait_for_edge(self, pin, edge, bouncetime=None, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout / 1000
+        with self.condition:
+            while True:
+                seen = self.edgeCount
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return None
+                self.condition.wait(remaining)
+                if self.edgeCount != seen and self._matches(edge, self.lastEdge, pin):
+                    return pin
+
+    def cleanup(self, pin=None):
+        with self.condition:
+            if pin is None:
+                self.detectors.clear()
+                self.closed = True
+                self.condition.notify_all()
+            else:
+                self.detectors.pop(pin, None)
+
+    # Simulation API #
+
+    # Calls `listener(pin, level, time in ns)` whenever output pin `pin` changes.
+    def onOutput(self, pin, listener):
+        self.outputListeners.setdefault(pin, []).append(listener)
+
+    # Sets input pin `pin` to `level` at perf_counter_ns() time `at`.
+    def schedule(self, at, pin, level):
+        if self.clock is not None:
+            self.clock.schedule(at, lambda: self._apply(pin, level))
+            return
+        with self.condition:
+            heapq.heappush(self.events, (at, next(self.tiebreak), pin, level))
+            self.condition.notify_all()
+
+    def _matches(self, edge, lastEdge, pin):
+        edgePin, level = lastEdge
+        if edgePin != pin:
+            return False
+        return edge == self.BOTH or (edge == self.RISING) == (level == 1)
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.closed:
+                    if self.events:
+                        wait = self.events[0][0] - time.perf_counter_ns()
+                        if wait <= SPIN_NS:
+                            break
+                        self.condition.wait((wait - SPIN_NS) / 1e9)
+                    else:
+                        self.condition.wait()
+                if self.closed:
+                    return
+                at = self.events[0][0]
+            while time.perf_counter_ns() < at:
+                pass
+            with self.condition:
+                (at, _, pin, level) = heapq.heappop(self.events)
+            self._apply(pin, level)
+
+    # Changes input pin `pin` to `level` now and runs its edge callbacks.
+    def _apply(self, pin, level):
+        with self.condition:
+            if self.levels.get(pin) == level:
+                return
+            self.levels[pin] = level
+            self.edgeCount += 1
+            self.lastEdge = (pin, level)
+            self.condition.notify_all()
+            detector = self.detectors.get(pin)
+            callbacks = []
+            if detector is not None and self._matches(detector[0], self.lastEdge, pin):
+                detector[2] = True
+                callbacks = list(detector[1])
+        for callback in callbacks:
+            callback(pin)
+
+# An HC-SR04 on a SimulatedGPIO: after each trigger pulse, raises the echo pin
+# for as long as the sound would take to reach `distance` and back.
+class SimulatedUltrasonic:
+    # @param distance -- distance in cm to the obstacle, or a function
+    # returning it (called on every ping).
+    # @param noise -- standard deviation in cm added to each echo.
+    # @param dropRate -- fraction of pings that get no echo back.
+    def __init__(self, gpio, trigger_pin, echo_pin, distance=100, responseDelay=0.0005,
+                 noise=0.0, dropRate=0.0, seed=None):
+        self.gpio = gpio
+        self.echo_pin = echo_pin
+        self.distance = distance
+        self.responseDelay = int(responseDelay * 1e9)
+        self.noise = noise
+        self.dropRate = dropRate
+        self.random = random.Random(seed)
+        self.busyUntil = 0
+        gpio.setup(echo_pin, gpio.IN)
+        gpio.onOutput(trigger_pin, self._trigger)
+
+    def trueDistance(self):
+        return self.distance() if callable(self.distance) else self.distance
+
+    def _trigger(self, pin, level, now):
+        if level != 0 or now < self.busyUntil:
+            return # Pings only start on the falling edge of the trigger, when idle
+        distance = self.trueDistance() + self.random.gauss(0, self.noise) if self.noise > 0 else self.trueDistance()
+        if self.random.random() < self.dropRate or distance > MAX_RANGE_CM:
+            pulse = 38000000 # No echo: the sensor gives up after ~38 ms
+        else:
+            pulse = int(max(distance, 2) * NS_PER_CM)
+        rise = now + self.responseDelay
+        self.busyUntil = rise + pulse
+        self.gpio.schedule(rise, self.echo_pin, 1)
+        self.gpio.schedule(rise + pulse, self.echo_pin, 0)
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Off-robot benchmark of PCA9685 I2C traffic, on the simulated SMBus in
+# simulation/smbus.py. Replays the motor commands and servo moves of a few
+# navigation cycles of algorithm.py with the original byte-at-a-time writes
+# and with batched block writes, and reports I2C transactions, bytes and bus
+# time per command as JSON, e.g.
+#   python -m simulation.pwmbenchmark --cycles 50 --output pwm.json
+
+import argparse
+import json
+import platform
+import time
+from . import smbus as simulatedSmbus
+from PCA9685 import PCA9685
+from Motor import Motor
+from servo import Servo
+
+# One navigation cycle: drive forward while sweeping the sensor (the same
+# command is re-sent on every pass), stop, back up, look around, turn.
+def cycle(motor, servo):
+    commands = 0
+    servoMoves = 0
+    for sweep in range(3):
+        motor.setMotorModel(-1228, -1228, -1228, -1228)
+        commands += 1
+        for angle in list(range(-20, 40, 10)) + list(range(20, -40, -10)):
+            servo.setServoPwm('0', angle + 90)
+            servoMoves += 1
+    for duties in [(0, 0, 0, 0), (1228, 1228, 1228, 1228), (0, 0, 0, 0)]:
+        motor.setMotorModel(*duties)
+        commands += 1
+    for angle in range(-90, 100, 10):
+        servo.setServoPwm('0', angle + 90)
+        servoMoves += 1
+    for duties in [(-2047, -2047, 2047, 2047), (0, 0, 0, 0)]:
+        motor.setMotorModel(*duties)
+        commands += 1
+    return commands, servoMoves
+
+def measure(batched, cycles):
+    bus = simulatedSmbus.SMBus(1)
+    pwm = PCA9685(0x40, bus=bus, batched=batched)
+    motor = Motor(pwm)
+    servo = Servo(pwm)
+    bus.state.reset()
+
+    commands = servoMoves = 0
+    start = time.process_time()
+    for _ in range(cycles):
+        (c, s) = cycle(motor, servo)
+        commands += c
+        servoMoves += s
+    cpu = time.process_time() - start
+    stats = bus.stats()
+
+    # Motor commands alone, to report their cost separately.
+    bus.state.reset()
+    for duties in [(-1228,) * 4, (-1228,) * 4, (0,) * 4, (1228,) * 4, (-2047, -2047, 2047, 2047)]:
+        motor.setMotorModel(*duties)
+    motorStats = bus.stats()
+    return {
+        'mode': 'batched' if batched else 'byte-at-a-time',
+        'motor_commands': commands,
+        'servo_moves': servoMoves,
+        'transactions': stats['transactions'],
+        'bytes_written': stats['bytes_written'],
+        'bus_ms': stats['bus_seconds'] * 1000,
+        'cpu_ms': cpu * 1000,
+        'transactions_per_motor_command': motorStats['transactions'] / 5,
+        'bus_ms_per_motor_command': motorStats['bus_seconds'] * 1000 / 5,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark PCA9685 I2C traffic on a simulated bus")
+    parser.add_argument('--cycles', type=int, default=20, help="navigation cycles to replay")
+    parser.add_argument('--output', default=None, help="file to write the JSON to instead of stdout")
+    args = parser.parse_args()
+
+    result = {
+        'config': {
+            'cycles': args.cycles,
+            'i2c_clock': simulatedSmbus.I2C_CLOCK,
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+        },
+        'results': [measure(False, args.cycles), measure(True, args.cycles)],
+    }
+    text = json.dumps(result, indent=2)
+    if args.output is None:
+        print(text)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+
+if __name__ == "__main__":
+    main()
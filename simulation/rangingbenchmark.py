@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Off-robot benchmark of the ultrasonic ranging backends in ranging.py, on a
+# SimulatedGPIO with a SimulatedUltrasonic. For each backend and distance it
+# reports the CPU time the pinging thread used, wall time per ping, and the
+# error and jitter of the measured distances. Results are JSON, e.g.
+#   python -m simulation.rangingbenchmark --pings 200 --output ranging.json
+#
+# The simulated sensor's own thread spins for the last few hundred us before
+# each edge so echoes are timed accurately; that CPU is the "hardware" and is
+# reported separately from the pinging thread's.
+#
+# PollingRanger gives up after a fixed number of spins, which the robot's
+# GPIO.input() makes last tens of ms; SimulatedGPIO.input() is far faster, so
+# the benchmark sizes the spin count to the same time budget the edge backend
+# waits. Readings that are zero or past MAX_RANGE_CM are counted as invalid
+# rather than as measurements.
+
+import argparse
+import json
+import platform
+import statistics
+import sys
+import time
+from ranging import *
+from .gpio import SimulatedGPIO, SimulatedUltrasonic
+
+TRIGGER_PIN = 27
+ECHO_PIN = 22
+SWITCH_INTERVAL = 0.00002 # Seconds; short enough that edges land within ~0.5 cm
+
+def percentile(sortedValues, p):
+    if len(sortedValues) == 0:
+        return None
+    index = min(len(sortedValues) - 1, int(round(p / 100 * (len(sortedValues) - 1))))
+    return sortedValues[index]
+
+# Returns how many PollingRanger spins on `gpio` take about `seconds`.
+def spinsFor(gpio, seconds, samples=100000):
+    ranger = PollingRanger(gpio, TRIGGER_PIN, ECHO_PIN)
+    start = time.perf_counter()
+    ranger.wait_for_echo(True, samples)
+    perSpin = (time.perf_counter() - start) / samples
+    return max(1, int(seconds / perSpin))
+
+def measure(backend, distance, args):
+    gpio = SimulatedGPIO()
+    gpio.setmode(gpio.BCM)
+    gpio.setup(TRIGGER_PIN, gpio.OUT)
+    # The sensor hooks the trigger pin, so gpio keeps it alive.
+    SimulatedUltrasonic(gpio, TRIGGER_PIN, ECHO_PIN, distance,
+                        dropRate=args.drop_rate, seed=1)
+    if backend == 'polling':
+        timeout = (ECHO_START_TIMEOUT_NS + MAX_RANGE_CM * NS_PER_CM) / 1e9
+        ranger = PollingRanger(gpio, TRIGGER_PIN, ECHO_PIN, spinsFor(gpio, timeout))
+    else:
+        ranger = makeRanger(gpio, TRIGGER_PIN, ECHO_PIN, backend)
+    readings = []
+    missed = 0
+    invalid = 0
+    # A spinning ranger holds the GIL for the whole switch interval, which
+    # would hold back the simulated sensor's edges by up to 5 ms; on the robot
+    # the echo comes from separate hardware.
+    switchInterval = sys.getswitchinterval()
+    sys.setswitchinterval(SWITCH_INTERVAL)
+    wallStart = time.perf_counter()
+    threadStart = time.thread_time()
+    processStart = time.process_time()
+    for _ in range(args.pings):
+        reading = ranger.ping()
+        # The polling backend has no way to tell a missed echo apart; it
+        # shows up as a zero or out-of-range reading.
+        if reading is None:
+            missed += 1
+        elif not 0 < reading <= MAX_RANGE_CM:
+            invalid += 1
+        else:
+            readings.append(reading)
+        time.sleep(args.interval)
+    threadCpu = time.thread_time() - threadStart
+    processCpu = time.process_time() - processStart
+    sys.setswitchinterval(switchInterval)
+    wall = time.perf_counter() - wallStart - args.pings * args.interval
+    ranger.close()
+    gpio.cleanup()
+
+    errors = sorted(abs(r - distance) for r in readings)
+    return {
+        'backend': type(ranger).__name__,
+        'distance_cm': distance,
+        'pings': args.pings,
+        'missed': missed,
+        'invalid': invalid,
+        'ping_ms': wall / args.pings * 1000,
+        'ranging_cpu_ms_per_ping': threadCpu / args.pings * 1000,
+        'process_cpu_ms_per_ping': processCpu / args.pings * 1000,
+        'mean_cm': statistics.mean(readings) if readings else None,
+        'jitter_cm': statistics.pstdev(readings) if len(readings) > 1 else None,
+        'error_p50_cm': percentile(errors, 50),
+        'error_p95_cm': percentile(errors, 95),
+        'error_max_cm': errors[-1] if errors else None,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark ultrasonic ranging backends on simulated GPIO")
+    parser.add_argument('--pings', type=int, default=100, help="pings per backend and distance")
+    parser.add_argument('--distances', type=float, nargs='+', default=[10, 50, 150, 300])
+    parser.add_argument('--backends', nargs='+', default=['polling', 'edge'])
+    parser.add_argument('--drop-rate', type=float, default=0.0, help="fraction of pings with no echo")
+    parser.add_argument('--interval', type=float, default=0.005, help="seconds between pings")
+    parser.add_argument('--output', default=None, help="file to write the JSON to instead of stdout")
+    args = parser.parse_args()
+
+    result = {
+        'config': {
+            'pings': args.pings,
+            'drop_rate': args.drop_rate,
+            'interval': args.interval,
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+        },
+        'results': [measure(backend, distance, args)
+                    for backend in args.backends for distance in args.distances],
+    }
+    text = json.dumps(result, indent=2)
+    if args.output is None:
+        print(text)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+
+if __name__ == "__main__":
+    main()
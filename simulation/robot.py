@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Runs algorithm.py unchanged for one car in a simulated maze, on virtual time,
+# and reports how it went as JSON:
+#   python -m simulation.robot mazes/loop.txt --server 127.0.0.1:8080
+#   python -m simulation.robot mazes/loop.txt --server 127.0.0.1:8080 --receiving
+#
+# The motors and servo (PCA9685 on simulation.smbus), the ultrasonic sensor
+# (SimulatedUltrasonic on a SimulatedGPIO), the gyro and the camera are all
+# backed by a simulation.world.World, and time.sleep() and the clocks run on a
+# simulation.clock.VirtualClock, so minutes of driving take seconds. Only one
+# car can be simulated per process, since the clock replaces the time
+# module's functions; see simulation/run.py for running many.
+#
+# algorithm.py's navigation car only stops exploring when it finds itself
+# boxed in, which a maze rarely does, so the run is cut short when the car
+# reaches the maze's goal cell or the time limit. The path explored so far is
+# then uploaded as final, so a receiving car can still follow it.
+
+import argparse
+import contextlib
+import json
+import math
+import os
+import sys
+import traceback
+from .clock import *
+from networking.client import Client
+from .gpio import SimulatedGPIO, SimulatedUltrasonic
+from .sensors import SimulatedMPU6050, SimulatedVideoCapture
+from .world import World, loadMaze
+from . import smbus as simulatedSmbus
+import devices
+
+ALGORITHM = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'algorithm.py')
+TRIGGER_PIN = 27 # As in Ultrasonic.py
+ECHO_PIN = 22
+CAR_CONFIG = 2 # algorithm.py's car whose servo middle is 90 degrees
+SERVO_MIDDLE = 90
+
+# Installs a new VirtualClock and points devices.configure at a car in `maze`
+# made of the simulated parts; returns (clock, world).
+# @param noise -- standard deviation of the ultrasonic readings in cm.
+# @param dropRate -- fraction of pings that get no echo.
+def simulate(maze, seed=None, timeLimit=None, noise=0.3, dropRate=0.01):
+    clock = VirtualClock(limit=timeLimit)
+    install(clock)
+    bus = simulatedSmbus.busState(devices.I2C_BUS)
+    world = World(maze, clock, bus.registers(devices.PWM_ADDRESS), SERVO_MIDDLE, seed=seed)
+    bus.onWrite(lambda address: world.update() if address == devices.PWM_ADDRESS else None)
+    gpio = SimulatedGPIO(clock)
+    SimulatedUltrasonic(gpio, TRIGGER_PIN, ECHO_PIN, distance=world.sensorDistance,
+                        noise=noise, dropRate=dropRate, seed=seed)
+    devices.configure(gpio=gpio, smbus=simulatedSmbus,
+                      imu=lambda: SimulatedMPU6050(world, seed=seed),
+                      camera=lambda source: SimulatedVideoCapture(world))
+    return (clock, world)
+
+# @param server -- the relay server's "IP:port".
+# @param turnMethod -- algorithm.py's turn_method.
+# @param timeLimit -- virtual seconds after which the run is stopped.
+# @param log -- file object for algorithm.py's output, or None to drop it.
+# @param stopAtGoal -- whether to end the run when the car reaches the goal.
+# @param live -- whether a receiving car waits for a path being streamed
+# instead of following the latest stored one (algorithm.py's follow_live).
+def runVehicle(mazeFile, server, channel, receiving=False, turnMethod=3, seed=None,
+               timeLimit=900, noise=0.3, dropRate=0.01, log=None, stopAtGoal=None, live=False):
+    (clock, world) = simulate(loadMaze(mazeFile), seed, timeLimit, noise, dropRate)
+    if stopAtGoal is None:
+        stopAtGoal = not receiving
+    if stopAtGoal:
+        world.onGoal = lambda: clock.setLimit(clock.perf_counter())
+
+    sys.argv = [ALGORITHM, str(CAR_CONFIG), '1' if receiving else '0', '0', server, channel, str(turnMethod),
+                '1' if live else '0']
+    outcome = 'finished'
+    start = realTime['perf_counter']()
+    output = open(os.devnull, 'w') if log is None else log
+    namespace = {'__name__': '__main__', '__file__': ALGORITHM}
+    with open(ALGORITHM) as f:
+        code = compile(f.read(), ALGORITHM, 'exec')
+    with contextlib.redirect_stdout(output), contextlib.redirect_stderr(output):
+        try:
+            exec(code, namespace)
+        except SimulationTimeout:
+            outcome = 'goal' if world.reachedGoal else 'timeout'
+            if not receiving:
+                finishPath(server, channel, namespace.get('recordedPath', []))
+        except Exception:
+            outcome = 'error'
+            traceback.print_exc()
+    if log is None:
+        output.close()
+    result = {
+        'role': 'receiving' if receiving else 'navigation',
+        'outcome': outcome,
+        'virtual_seconds': clock.perf_counter(),
+        'real_seconds': realTime['perf_counter']() - start,
+    }
+    result.update(world.summary())
+    # Segments explored, or received to follow.
+    path = namespace.get('recordedPath')
+    if not isinstance(path, list):
+        client = namespace.get('client')
+        path = (client.streamed or client.path or []) if client is not None else []
+    result['segments'] = len(path)
+    odometry = namespace.get('odometry')
+    if odometry is not None:
+        result['odometry'] = odometryError(odometry, world)
+    result['trace'] = world.trace
+    clock.close()
+    uninstall()
+    return result
+
+# How far algorithm.py's Odometry ended up from where the car really is.
+def odometryError(odometry, world):
+    (x, y, theta) = odometry.pose()
+    (_, startX, startY, startHeading) = world.trace[0]
+    with world.lock:
+        world.update()
+        (dx, dy) = (world.x - startX, world.y - startY)
+        # The same frame as Odometry's: x ahead at the start, y and theta clockwise.
+        ahead = dx * math.cos(startHeading) + dy * math.sin(startHeading)
+        right = dx * math.sin(startHeading) - dy * math.cos(startHeading)
+        turned = math.degrees(startHeading - world.heading)
+    return {
+        'final_pose': {'x': x, 'y': y, 'theta': theta},
+        'position_error_cm': math.hypot(x - ahead, y - right),
+        'heading_error_degrees': theta - turned,
+        'poses': odometry.count,
+    }
+
+# Uploads `path` to the channel as a finished stream, replacing the one the
+# interrupted run left unfinished.
+def finishPath(server, channel, path):
+    if not path:
+        return
+    (ip, _, port) = server.partition(':')
+    client = Client(ip, int(port or 8080), channel=channel)
+    try:
+        for i, segment in enumerate(path):
+            client.sendSegment(segment, final=i == len(path) - 1)
+    finally:
+        client.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Run algorithm.py for one car in a simulated maze")
+    parser.add_argument('maze', help="maze file (see simulation/world.py)")
+    parser.add_argument('--server', default='127.0.0.1:8080', help="relay server IP:port")
+    parser.add_argument('--channel', default='simulation')
+    parser.add_argument('--receiving', action='store_true', help="follow the path instead of exploring")
+    parser.add_argument('--turn-method', type=int, default=3, help="algorithm.py's turn_method")
+    parser.add_argument('--live', action='store_true',
+                        help="when receiving, wait for a path being streamed instead of the stored one")
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--time-limit', type=float, default=900, help="virtual seconds")
+    parser.add_argument('--no-stop-at-goal', dest='stop_at_goal', action='store_false', default=None,
+                        help="keep exploring after reaching the goal")
+    parser.add_argument('--log', default=None, help="file for algorithm.py's output")
+    parser.add_argument('--trace', action='store_true', help="include the pose every 0.1 virtual seconds")
+    parser.add_argument('--output', default=None, help="file to write the JSON to instead of stdout")
+    args = parser.parse_args()
+
+    log = None if args.log is None else open(args.log, 'w')
+    result = runVehicle(args.maze, args.server, args.channel, args.receiving, args.turn_method,
+                        args.seed, args.time_limit, log=log, stopAtGoal=args.stop_at_goal, live=args.live)
+    if not args.trace:
+        result.pop('trace', None)
+    text = json.dumps(result, indent=2)
+    if args.output is None:
+        print(text)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Off-robot benchmark of the camera rotation estimate in flow.py, on
+# synthetic tracked points: random points seen by a pinhole camera before and
+# after it turns by a known angle, with tracking noise and a share of
+# mistracked points. Compares the original estimate (the centermost point
+# found with a Python loop, then the first point's movement mapped linearly
+# onto the field of view) with estimateRotation() over all points, at several
+# numbers of features. Reports per-frame cost and error as JSON, e.g.
+#   python -m simulation.rotationbenchmark --features 100 500 --output rotation.json
+
+import argparse
+import json
+import math
+import platform
+import time
+import numpy as np
+from flow import FOV_HORIZ_DEGREES, closestKPointsToOrigin, estimateRotation, map_
+
+WIDTH = 320
+HEIGHT = 240
+
+# computeCentermostFlow's and computeRadiansOfCameraRotation's work per frame
+# before estimateRotation().
+def original(old, new):
+    centered = map(lambda l: [l[0] - WIDTH / 2, l[1] - HEIGHT / 2], new)
+    points = list(centered)
+    best = points[0]
+    bestDist = best[0]**2 + best[1]**2
+    for i in range(0, len(points)):
+        p = points[i]
+        dist = p[0]**2 + p[1]**2
+        if dist < bestDist:
+            best = p
+            bestDist = dist
+    changeInAvg = np.subtract(new[0], old[0])
+    return map_(changeInAvg[0], 0, WIDTH, 0, math.radians(FOV_HORIZ_DEGREES))
+
+def robust(old, new):
+    closestKPointsToOrigin(new - (WIDTH / 2, HEIGHT / 2), 1)
+    return estimateRotation(old, new, WIDTH, HEIGHT)[0]
+
+# `count` points tracked from one frame to the next while the camera turns
+# left by `radians`, as float32 arrays like cv2.calcOpticalFlowPyrLK's.
+def frame(rng, count, radians, noise, outliers):
+    focal = WIDTH / 2 / math.tan(math.radians(FOV_HORIZ_DEGREES) / 2)
+    old = rng.uniform((0, 0), (WIDTH, HEIGHT), (count, 2))
+    new = old.copy()
+    new[:, 0] = np.tan(np.arctan((old[:, 0] - WIDTH / 2) / focal) + radians) * focal + WIDTH / 2
+    new += rng.normal(0, noise, new.shape)
+    wrong = rng.random(count) < outliers
+    new[wrong] = rng.uniform((0, 0), (WIDTH, HEIGHT), (np.count_nonzero(wrong), 2))
+    return (old.astype(np.float32), new.astype(np.float32))
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark camera rotation estimates on synthetic tracked points")
+    parser.add_argument('--features', type=int, nargs='+', default=[100, 500], help="tracked points per frame")
+    parser.add_argument('--frames', type=int, default=500, help="frames per configuration")
+    parser.add_argument('--noise', type=float, default=0.5, help="tracking noise, pixels")
+    parser.add_argument('--outliers', type=float, default=0.1, help="share of mistracked points")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=None, help="file to write the JSON to instead of stdout")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    methods = {'original': original, 'robust': robust}
+    results = []
+    for count in args.features:
+        # Up to 6 degrees a frame: 180 degrees/s at 30 fps.
+        angles = rng.uniform(-0.1, 0.1, args.frames)
+        frames = [frame(rng, count, radians, args.noise, args.outliers) for radians in angles]
+        for name, method in methods.items():
+            estimates = np.empty(args.frames)
+            start = time.perf_counter()
+            for i, (old, new) in enumerate(frames):
+                estimates[i] = method(old, new)
+            seconds = time.perf_counter() - start
+            errors = np.degrees(np.abs(estimates - angles))
+            results.append({
+                'method': name,
+                'features': count,
+                'microseconds_per_frame': seconds / args.frames * 1e6,
+                'mean_abs_error_degrees': float(errors.mean()),
+                'p95_abs_error_degrees': float(np.percentile(errors, 95)),
+                # How much of the real rotation the estimates add up to; 1 is right.
+                'scale': float(np.sum(estimates * angles) / np.sum(angles * angles)),
+            })
+
+    result = {
+        'config': {
+            'features': args.features,
+            'frames': args.frames,
+            'noise_pixels': args.noise,
+            'outliers': args.outliers,
+            'seed': args.seed,
+            'frame_size': [WIDTH, HEIGHT],
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'machine': platform.machine(),
+        },
+        'results': results,
+    }
+    text = json.dumps(result, indent=2)
+    if args.output is None:
+        print(text)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+
+if __name__ == "__main__":
+    main()
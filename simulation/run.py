@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Explore-then-follow runs of algorithm.py in simulated mazes, many at once.
+# For every maze and seed, a navigation car explores the maze and streams its
+# path to a relay server, then a receiving car (with its own wheel errors)
+# follows that path; each car is a simulation.robot process, so runs go in
+# parallel across processes. Reports JSON, e.g.
+#   python -m simulation.run simulation/mazes/*.txt --seeds 4 --jobs 4 --output runs.json
+
+import argparse
+import concurrent.futures
+import json
+import math
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def freePort():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+# Starts networking.server on a free port; returns (process, "IP:port").
+def startServer(store):
+    port = freePort()
+    process = subprocess.Popen([sys.executable, '-m', 'networking.server', '--port', str(port),
+                                '--store', store, '--no-telemetry'],
+                               cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 10
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return (process, '127.0.0.1:' + str(port))
+        except OSError:
+            if time.monotonic() > deadline or process.poll() is not None:
+                process.kill()
+                raise Exception("Relay server didn't start")
+            time.sleep(0.05)
+
+def runCar(maze, server, channel, seed, args, receiving, logDir):
+    command = [sys.executable, '-m', 'simulation.robot', maze, '--server', server, '--channel', channel,
+               '--seed', str(seed), '--time-limit', str(args.time_limit),
+               '--turn-method', str(args.turn_method)]
+    if receiving:
+        command.append('--receiving')
+    if logDir is not None:
+        command += ['--log', os.path.join(logDir, channel + ('-receiving' if receiving else '-navigation') + '.log')]
+    try:
+        completed = subprocess.run(command, cwd=ROOT, capture_output=True, text=True, timeout=args.real_timeout)
+    except subprocess.TimeoutExpired:
+        return {'role': 'receiving' if receiving else 'navigation', 'outcome': 'killed'}
+    if completed.returncode != 0:
+        return {'role': 'receiving' if receiving else 'navigation', 'outcome': 'crashed',
+                'stderr': completed.stderr[-2000:]}
+    return json.loads(completed.stdout)
+
+def runMaze(maze, seed, server, args):
+    channel = os.path.splitext(os.path.basename(maze))[0] + '-' + str(seed)
+    navigation = runCar(maze, server, channel, seed, args, False, args.logs)
+    # A different seed, so the follower's wheels are off in their own way.
+    receiving = runCar(maze, server, channel, seed + 1000, args, True, args.logs)
+    result = {'maze': maze, 'seed': seed, 'navigation': navigation, 'receiving': receiving}
+    if 'final_pose' in navigation and 'final_pose' in receiving:
+        (a, b) = (navigation['final_pose'], receiving['final_pose'])
+        result['follow_error_cm'] = math.hypot(a['x'] - b['x'], a['y'] - b['y'])
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description="Explore-then-follow runs of algorithm.py in simulated mazes")
+    parser.add_argument('mazes', nargs='+', help="maze files (see simulation/world.py)")
+    parser.add_argument('--seeds', type=int, default=1, help="runs per maze")
+    parser.add_argument('--jobs', type=int, default=os.cpu_count(), help="runs at once")
+    parser.add_argument('--turn-method', type=int, default=3, help="algorithm.py's turn_method")
+    parser.add_argument('--time-limit', type=float, default=900, help="virtual seconds per car")
+    parser.add_argument('--real-timeout', type=float, default=600, help="real seconds per car")
+    parser.add_argument('--logs', default=None, help="directory for each car's algorithm.py output")
+    parser.add_argument('--output', default=None, help="file to write the JSON to instead of stdout")
+    args = parser.parse_args()
+    if args.logs is not None:
+        os.makedirs(args.logs, exist_ok=True)
+
+    start = time.perf_counter()
+    with tempfile.TemporaryDirectory() as store:
+        (server, address) = startServer(store)
+        try:
+            with concurrent.futures.ThreadPoolExecutor(args.jobs) as pool:
+                futures = [pool.submit(runMaze, os.path.abspath(maze), seed, address, args)
+                           for maze in args.mazes for seed in range(args.seeds)]
+                runs = [future.result() for future in futures]
+        finally:
+            server.terminate()
+            server.wait()
+    elapsed = time.perf_counter() - start
+
+    virtual = sum(car.get('virtual_seconds', 0) for run in runs for car in (run['navigation'], run['receiving']))
+    result = {
+        'config': {
+            'mazes': args.mazes,
+            'seeds': args.seeds,
+            'jobs': args.jobs,
+            'turn_method': args.turn_method,
+            'time_limit': args.time_limit,
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+        },
+        'real_seconds': elapsed,
+        'virtual_seconds': virtual,
+        'speedup': virtual / elapsed,
+        'runs': runs,
+    }
+    text = json.dumps(result, indent=2)
+    if args.output is None:
+        print(text)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+# Stand-ins for the MPU6050 (as adafruit_mpu6050 presents it) and the camera
+# (as cv2.VideoCapture presents it), reading the car's motion and view from a
+# simulation.world.World. See devices.configure for swapping them in.
+
+import math
+import random
+import time
+
+GRAVITY = 9.80665 # m/s^2
+
+# cv2's property IDs, so this module doesn't need cv2.
+CAP_PROP_FRAME_WIDTH = 3
+CAP_PROP_FRAME_HEIGHT = 4
+CAP_PROP_FPS = 5
+
+WALL_HEIGHT = 30.0 # cm
+CAMERA_HEIGHT = 10.0 # cm above the floor
+TEXTURE_SIZE = 6.0 # cm; side of the squares in the walls' checkerboard
+
+# `.gyro` is (x, y, z) in rad/s, with z counter-clockwise positive, plus a
+# constant bias per axis and white noise; `.acceleration` is in m/s^2.
+class SimulatedMPU6050:
+    # @param bias -- standard deviation of the per-axis bias, drawn once.
+    # @param noise -- standard deviation of each reading.
+    def __init__(self, world, bias=0.01, noise=0.005, seed=None):
+        self.world = world
+        self.random = random.Random(seed)
+        self.bias = [self.random.gauss(0, bias) for axis in range(3)]
+        self.noise = noise
+        self.temperature = 25.0
+
+    def _noisy(self, axis, value):
+        return value + self.bias[axis] + self.random.gauss(0, self.noise)
+
+    @property
+    def gyro(self):
+        self.world.update()
+        return (self._noisy(0, 0.0), self._noisy(1, 0.0), self._noisy(2, self.world.turnRate))
+
+    @property
+    def acceleration(self):
+        self.world.update()
+        # Only the centripetal acceleration of turning shows up sideways.
+        sideways = self.world.speed / 100 * self.world.turnRate
+        return (self.random.gauss(0, self.noise), sideways + self.random.gauss(0, self.noise),
+                GRAVITY + self.random.gauss(0, self.noise))
+
+# A forward-facing camera: each frame is rendered by casting one ray per
+# column into the maze, with walls textured in a checkerboard so there are
+# corners to track. Frames are BGR uint8 arrays like cv2's; needs numpy.
+# read() waits (on the clock, so virtual time when simulated) for the next
+# frame time, like a real camera.
+class SimulatedVideoCapture:
+    def __init__(self, world, width=320, height=240, fov=75, fps=30):
+        self.world = world
+        self.width = width
+        self.height = height
+        self.fov = math.radians(fov)
+        self.fps = fps
+        self.opened = True
+        self.nextFrame = None
+
+    def isOpened(self):
+        return self.opened
+
+    def release(self):
+        self.opened = False
+
+    def get(self, propId):
+        return {CAP_PROP_FRAME_WIDTH: self.width, CAP_PROP_FRAME_HEIGHT: self.height,
+                CAP_PROP_FPS: self.fps}.get(propId, 0)
+
+    def set(self, propId, value):
+        if propId == CAP_PROP_FRAME_WIDTH:
+            self.width = int(value)
+        elif propId == CAP_PROP_FRAME_HEIGHT:
+            self.height = int(value)
+        elif propId == CAP_PROP_FPS:
+            self.fps = value
+        else:
+            return False
+        return True
+
+    def read(self):
+        if not self.opened:
+            return (False, None)
+        now = time.monotonic()
+        if self.nextFrame is not None and now < self.nextFrame:
+            time.sleep(self.nextFrame - now)
+            now = self.nextFrame
+        self.nextFrame = now + 1 / self.fps
+        return (True, self.render())
+
+    def render(self):
+        import numpy as np
+        (x, y, heading) = self.world.pose()
+        maze = self.world.maze
+        # Pinhole camera: columns are evenly spaced on the image plane.
+        focal = self.width / 2 / math.tan(self.fov / 2)
+        offsets = np.arctan((self.width / 2 - 0.5 - np.arange(self.width)) / focal)
+        rows = np.arange(self.height)[:, None] - self.height / 2 + 0.5
+        frame = np.empty((self.height, self.width), np.uint8)
+        frame[:self.height // 2] = 170 # Ceiling
+        frame[self.height // 2:] = 90 # Floor
+        for column, offset in enumerate(offsets):
+            (distance, along) = maze.castRay(x, y, heading + offset)
+            if distance is None:
+                continue
+            depth = distance * math.cos(offset) # Perpendicular distance, so walls look flat
+            # Height above the floor that each pixel row sees on the wall.
+            heights = CAMERA_HEIGHT - rows[:, 0] * depth / focal
+            onWall = (heights >= 0) & (heights <= WALL_HEIGHT)
+            squares = np.floor(heights / TEXTURE_SIZE) + math.floor(along / TEXTURE_SIZE)
+            shade = np.where(squares % 2 == 0, 40, 220)
+            frame[onWall, column] = shade[onWall]
+        return np.repeat(frame[:, :, None], 3, axis=2)
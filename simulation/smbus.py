@@ -0,0 +1,120 @@
+# Stand-in for the smbus module, for running and benchmarking the robot code
+# off the robot. SMBus(1) behaves like an I2C bus with a register-file device
+# at every address, and counts transactions, bytes and the time they would
+# take on a real bus:
+#
+#   bus = SMBus(1)
+#   pwm = PCA9685(0x40, bus=bus)
+#   ...
+#   print(bus.stats())
+#
+# Like the real module, every SMBus(n) for the same n is the same bus.
+
+import threading
+import time
+
+I2C_CLOCK = 100000 # Hz; the Raspberry Pi's default
+MAX_BLOCK = 32 # Most data bytes in one SMBus block transfer
+
+# Devices that only auto-increment the register address within a block
+# transfer when a bit in one of their registers is set:
+# address -> (register, bit mask). The PCA9685 has it in MODE1; without it, a
+# block write writes every byte to the same register.
+AUTO_INCREMENT_BITS = {0x40: (0x00, 0x20)}
+
+class BusState:
+    def __init__(self, clock=I2C_CLOCK, realTime=False):
+        self.lock = threading.Lock()
+        self.clock = clock
+        self.realTime = realTime # Whether to actually take as long as the transfer would
+        self.devices = {} # address -> bytearray of 256 registers
+        self.writeListeners = [] # [function(address)]
+        self.reset()
+
+    def reset(self):
+        self.transactions = 0
+        self.bytesWritten = 0
+        self.bytesRead = 0
+        self.busTime = 0.0 # Seconds the transfers would take on the wire
+
+    def registers(self, address):
+        registers = self.devices.get(address)
+        if registers is None:
+            registers = self.devices[address] = bytearray(256)
+        return registers
+
+    # Calls `listener(address)` just before every write to a device, while its
+    # registers still hold the old values.
+    def onWrite(self, listener):
+        self.writeListeners.append(listener)
+
+    def beforeWrite(self, address):
+        for listener in self.writeListeners:
+            listener(address)
+
+    # Accounts for one transaction of `bits` clock cycles.
+    def transfer(self, bits, written=0, read=0):
+        seconds = bits / self.clock
+        self.transactions += 1
+        self.bytesWritten += written
+        self.bytesRead += read
+        self.busTime += seconds
+        if self.realTime:
+            time.sleep(seconds)
+
+    def stats(self):
+        return {'transactions': self.transactions, 'bytes_written': self.bytesWritten,
+                'bytes_read': self.bytesRead, 'bus_seconds': self.busTime}
+
+buses = {} # bus number -> BusState
+
+def busState(bus=1):
+    state = buses.get(bus)
+    if state is None:
+        state = buses[bus] = BusState()
+    return state
+
+class SMBus:
+    def __init__(self, bus=1):
+        self.state = busState(bus)
+
+    def _autoIncrement(self, address, registers):
+        flag = AUTO_INCREMENT_BITS.get(address)
+        return flag is None or registers[flag[0]] & flag[1] != 0
+
+    # Bits on the wire: start, 9 per byte (8 + ack), stop; a read adds a
+    # repeated start and the address again.
+    def write_byte_data(self, address, register, value):
+        self.state.beforeWrite(address)
+        with self.state.lock:
+            self.state.registers(address)[register] = value & 0xFF
+            self.state.transfer(2 + 9 * 3, written=1)
+
+    def read_byte_data(self, address, register):
+        with self.state.lock:
+            self.state.transfer(3 + 9 * 4, read=1)
+            return self.state.registers(address)[register]
+
+    def write_i2c_block_data(self, address, register, data):
+        if not 1 <= len(data) <= MAX_BLOCK:
+            raise ValueError("Block writes take 1 to " + str(MAX_BLOCK) + " bytes")
+        self.state.beforeWrite(address)
+        with self.state.lock:
+            registers = self.state.registers(address)
+            step = 1 if self._autoIncrement(address, registers) else 0
+            for i, value in enumerate(data):
+                registers[(register + i * step) & 0xFF] = value & 0xFF
+            self.state.transfer(2 + 9 * (2 + len(data)), written=len(data))
+
+    def read_i2c_block_data(self, address, register, length=MAX_BLOCK):
+        with self.state.lock:
+            registers = self.state.registers(address)
+            step = 1 if self._autoIncrement(address, registers) else 0
+            self.state.transfer(3 + 9 * (3 + length), read=length)
+            return [registers[(register + i * step) & 0xFF] for i in range(length)]
+
+    def close(self):
+        pass
+
+    def stats(self):
+        return self.state.stats()
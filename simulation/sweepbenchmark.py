@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Off-robot benchmark of algorithm.py's look-around sweep, in a simulated maze
+# on virtual time (see simulation/robot.py). Parks the car at random spots
+# and compares the original sweep (19 angles, 0.25 s wait after each servo
+# move) with SweepScheduler reading every angle and coarse-to-fine. Reports
+# the time per sweep, readings per sweep and how often each picks the most
+# open direction (from the maze itself, without sensor noise or missed
+# echoes), as JSON, e.g.
+#   python -m simulation.sweepbenchmark simulation/mazes/rooms.txt --spots 20 --output sweep.json
+
+import argparse
+import json
+import math
+import platform
+import random
+import time
+from .clock import realTime
+from .robot import simulate
+from .world import CAR_RADIUS, loadMaze
+from ranging import MAX_RANGE_CM
+from distanceEstimator import DistanceEstimator, makeFilter
+from sweep import SweepScheduler
+import devices
+
+SERVO_MIDDLE = 90
+
+# The look-around from algorithm.py before SweepScheduler.
+def originalSweep(servo, estimator):
+    start = time.monotonic()
+    readings = []
+    for angle in range(-90, 100, 10):
+        servo.setServoPwm('0', angle + SERVO_MIDDLE)
+        estimator.reset()
+        time.sleep(0.25)
+        distance = estimator.waitFor(1)
+        readings.append((angle, 0 if distance is None else distance))
+    best = max(readings, key=lambda r: (r[1], -r[0]))
+    return (best[0], len(readings), time.monotonic() - start)
+
+# How open each direction the sweeps can pick really is, as the sensor would
+# read it without noise.
+def trueDistances(world):
+    return {angle: min(world.sensorDistance(angle=angle), MAX_RANGE_CM) for angle in range(-90, 100, 10)}
+
+def freeSpots(maze, count, rng):
+    spots = []
+    while len(spots) < count:
+        x = rng.uniform(0, maze.width * maze.cell)
+        y = rng.uniform(0, maze.height * maze.cell)
+        if not maze.collides(x, y, CAR_RADIUS * 2):
+            spots.append((x, y, rng.uniform(-math.pi, math.pi)))
+    return spots
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark look-around sweeps in a simulated maze")
+    parser.add_argument('maze', help="maze file (see simulation/world.py)")
+    parser.add_argument('--spots', type=int, default=10, help="places to sweep from")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--drop-rate', type=float, default=0.01, help="fraction of pings with no echo")
+    parser.add_argument('--output', default=None, help="file to write the JSON to instead of stdout")
+    args = parser.parse_args()
+
+    maze = loadMaze(args.maze)
+    (clock, world) = simulate(maze, args.seed, dropRate=args.drop_rate)
+    servo = devices.servo()
+    estimator = DistanceEstimator(devices.ultrasonic(), makeFilter('outlier+median'))
+    estimator.start()
+    schedulers = {
+        'scheduled, every 10 degrees': SweepScheduler(servo, estimator, SERVO_MIDDLE, coarseStep=10),
+        'scheduled, coarse-to-fine 30/10': SweepScheduler(servo, estimator, SERVO_MIDDLE, coarseStep=30),
+    }
+    modes = ['original'] + list(schedulers)
+    totals = {mode: {'seconds': 0.0, 'readings': 0, 'best': 0, 'openness': 0.0} for mode in modes}
+
+    realStart = realTime['perf_counter']()
+    for (x, y, heading) in freeSpots(maze, args.spots, random.Random(args.seed)):
+        with world.lock:
+            world.update()
+            (world.x, world.y, world.heading) = (x, y, heading)
+        truth = trueDistances(world)
+        best = max(truth.values())
+        results = {'original': originalSweep(servo, estimator)}
+        servoAngle = 90 # Where the original sweep left the servo
+        for mode, scheduler in schedulers.items():
+            scheduler.angle = servoAngle # They share the servo
+            result = scheduler.sweep()
+            servoAngle = scheduler.angle
+            results[mode] = (result.angle, len(result.readings), result.seconds)
+        for mode, (angle, readings, seconds) in results.items():
+            totals[mode]['seconds'] += seconds
+            totals[mode]['readings'] += readings
+            # Several directions can be equally open (e.g. out of range).
+            totals[mode]['best'] += truth[angle] == best
+            totals[mode]['openness'] += truth[angle] / best
+    estimator.stop()
+
+    result = {
+        'config': {
+            'maze': args.maze,
+            'spots': args.spots,
+            'seed': args.seed,
+            'drop_rate': args.drop_rate,
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+        },
+        'real_seconds': realTime['perf_counter']() - realStart,
+        'results': [{
+            'mode': mode,
+            'seconds_per_sweep': totals[mode]['seconds'] / args.spots,
+            'readings_per_sweep': totals[mode]['readings'] / args.spots,
+            'picked_most_open': totals[mode]['best'] / args.spots,
+            # True distance in the picked direction over that in the most open one.
+            'mean_openness': totals[mode]['openness'] / args.spots,
+        } for mode in modes],
+    }
+    text = json.dumps(result, indent=2)
+    if args.output is None:
+        print(text)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+
+if __name__ == "__main__":
+    main()
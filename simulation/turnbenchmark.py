@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Off-robot benchmark of turns in place, in a simulated maze on virtual time
+# (see simulation/robot.py). Compares algorithm.py's original turns (full
+# speed until the gyro heading is within 5 degrees, or for abs(angle)/180
+# seconds) with TurnController on the gyro and on the timed model. Errors are
+# against how far the simulated car really turned. Reports JSON, e.g.
+#   python -m simulation.turnbenchmark simulation/mazes/rooms.txt --turns 40 --output turns.json
+
+import argparse
+import json
+import math
+import platform
+import random
+import time
+from .clock import realTime
+from .robot import simulate
+from .world import loadMaze
+from imuSampler import ImuSampler
+from turnController import TurnController, GyroHeading, TimedHeading
+import devices
+
+SPEED = 0.5
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark turns in place in a simulated maze")
+    parser.add_argument('maze', help="maze file (see simulation/world.py)")
+    parser.add_argument('--turns', type=int, default=20, help="turns per method")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=None, help="file to write the JSON to instead of stdout")
+    args = parser.parse_args()
+
+    (clock, world) = simulate(loadMaze(args.maze), args.seed)
+    wheels = devices.motor()
+    def turn(speed):
+        wheels.setMotorModel(int(-4095 * speed), int(-4095 * speed), int(4095 * speed), int(4095 * speed))
+    def stop():
+        wheels.setMotorModel(0, 0, 0, 0)
+    def trueHeading():
+        with world.lock:
+            world.update()
+            return -math.degrees(world.heading)
+
+    sampler = ImuSampler(devices.imu())
+    sampler.start()
+
+    def originalGyro(angle):
+        start = sampler.heading()
+        turn(math.copysign(SPEED, angle))
+        while abs(sampler.heading() - start - angle) > 5:
+            time.sleep(0.002)
+        stop()
+
+    def originalTimed(angle):
+        turn(math.copysign(SPEED, angle))
+        time.sleep(abs(angle) / 180)
+        stop()
+
+    gyro = TurnController(turn, stop, GyroHeading(sampler), maxSpeed=SPEED)
+    timed = TurnController(turn, stop, TimedHeading(360), maxSpeed=SPEED)
+    methods = {
+        'original gyro': originalGyro,
+        'original timed': originalTimed,
+        'controller, gyro': gyro.turnBy,
+        'controller, timed': timed.turnBy,
+    }
+
+    rng = random.Random(args.seed)
+    angles = [rng.choice([-1, 1]) * rng.choice(range(10, 190, 10)) for _ in range(args.turns)]
+    realStart = realTime['perf_counter']()
+    results = []
+    for name, method in methods.items():
+        errors = []
+        seconds = 0.0
+        for angle in angles:
+            before = trueHeading()
+            start = time.monotonic()
+            method(angle)
+            seconds += time.monotonic() - start
+            time.sleep(0.25) # Let the car come to rest
+            turned = (trueHeading() - before + 180) % 360 - 180 if abs(angle) < 180 else trueHeading() - before
+            errors.append(abs(turned - angle))
+        results.append({
+            'method': name,
+            'seconds_per_turn': seconds / len(angles),
+            'mean_abs_error_degrees': sum(errors) / len(errors),
+            'max_abs_error_degrees': max(errors),
+        })
+    results[2]['controller'] = gyro.stats()
+    results[3]['controller'] = timed.stats()
+    sampler.stop()
+
+    result = {
+        'config': {
+            'maze': args.maze,
+            'turns': args.turns,
+            'seed': args.seed,
+            'speed': SPEED,
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+        },
+        'real_seconds': realTime['perf_counter']() - realStart,
+        'imu': sampler.stats(),
+        'results': results,
+    }
+    text = json.dumps(result, indent=2)
+    if args.output is None:
+        print(text)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+
+if __name__ == "__main__":
+    main()
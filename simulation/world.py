@@ -0,0 +1,284 @@
+# 2-D model of the car in a maze, for simulation/robot.py. The car is a
+# differential-drive robot whose wheel speeds come from the motor duties last
+# written to the (simulated) PCA9685, and whose ultrasonic sensor sits on the
+# servo on PCA9685 channel 8. Lengths are in cm, angles in radians
+# counter-clockwise from the +x axis unless said otherwise.
+#
+# Mazes are text files of equal-length rows, one character per cell:
+#
+#   ; comment
+#   cell 60        ; cell size in cm (default 60)
+#   heading 90     ; start heading in degrees, 90 = up (default 0 = right)
+#   #######
+#   #S  # #
+#   # #   #
+#   #   #E#
+#   #######
+#
+# '#' is a wall, 'S' the start, 'E' the goal; anything else is floor. Outside
+# the grid counts as wall.
+
+import math
+import random
+import threading
+
+DEFAULT_CELL = 60.0
+MAX_WHEEL_SPEED = 44.0 # cm/s at duty 4095; turn(0.5) then turns ~180 degrees/s
+TRACK_WIDTH = 14.0 # cm between the left and right wheels
+CAR_RADIUS = 12.0 # For collisions
+SENSOR_OFFSET = 10.0 # cm from the car's centre to the ultrasonic sensor
+BEAM_HALF_ANGLE = math.radians(7.5) # Half the HC-SR04's beam width
+SERVO_SPEED = 600.0 # Degrees per second the servo turns at
+SERVO_CHANNEL = 8
+SERVO_ERROR = 10 # Servo.setServoPwm's default `error`
+STEP = 0.005 # Longest physics step in seconds
+TRACE_INTERVAL = 0.1 # Seconds between recorded poses
+SEPARATE_CONTACT = 0.5 # Seconds free of walls before touching one counts as a new collision
+RAY_LIMIT = 1000.0 # cm; rays stop looking further than this
+
+# PCA9685 channels driving each wheel: (forward-duty channel, reverse-duty
+# channel), see Motor.py. Wheels 1 and 2 are on the left, 3 and 4 on the right.
+WHEEL_CHANNELS = [(1, 0), (2, 3), (7, 6), (5, 4)]
+LED0_OFF_L = 0x08
+
+class MazeFormatException(Exception):
+    pass
+
+class Maze:
+    def __init__(self, rows, cell=DEFAULT_CELL, heading=0.0):
+        if not rows or any(len(row) != len(rows[0]) for row in rows):
+            raise MazeFormatException("Maze rows must all be the same length")
+        self.rows = rows
+        self.cell = cell
+        self.heading = heading
+        self.width = len(rows[0])
+        self.height = len(rows)
+        # Cells are (column, row counted from the bottom), so y goes up.
+        self.walls = set()
+        self.start = self.goal = None
+        for r, row in enumerate(rows):
+            for c, char in enumerate(row):
+                cell = (c, self.height - 1 - r)
+                if char == '#':
+                    self.walls.add(cell)
+                elif char == 'S':
+                    self.start = cell
+                elif char == 'E':
+                    self.goal = cell
+        if self.start is None:
+            raise MazeFormatException("Maze has no start (S)")
+
+    def isWall(self, c, r):
+        return (c, r) in self.walls or not (0 <= c < self.width and 0 <= r < self.height)
+
+    def cellAt(self, x, y):
+        return (math.floor(x / self.cell), math.floor(y / self.cell))
+
+    def centre(self, cell):
+        return ((cell[0] + 0.5) * self.cell, (cell[1] + 0.5) * self.cell)
+
+    # Distance from (x, y) along `angle` to the first wall, and where along
+    # that wall's face it was hit (for texturing), or (None, None) past
+    # `maxDistance`. Walks the grid cell by cell.
+    def castRay(self, x, y, angle, maxDistance=RAY_LIMIT):
+        dx = math.cos(angle)
+        dy = math.sin(angle)
+        (c, r) = self.cellAt(x, y)
+        stepC = 1 if dx > 0 else -1
+        stepR = 1 if dy > 0 else -1
+        nextC = ((c + (dx > 0)) * self.cell - x) / dx if dx != 0 else math.inf
+        nextR = ((r + (dy > 0)) * self.cell - y) / dy if dy != 0 else math.inf
+        deltaC = self.cell / abs(dx) if dx != 0 else math.inf
+        deltaR = self.cell / abs(dy) if dy != 0 else math.inf
+        while True:
+            if nextC < nextR:
+                t = nextC
+                c += stepC
+                nextC += deltaC
+                alongX = False
+            else:
+                t = nextR
+                r += stepR
+                nextR += deltaR
+                alongX = True
+            if t > maxDistance:
+                return (None, None)
+            if self.isWall(c, r):
+                return (t, x + dx * t if alongX else y + dy * t)
+
+    # Whether a circle of `radius` at (x, y) overlaps a wall.
+    def collides(self, x, y, radius):
+        (c0, r0) = self.cellAt(x - radius, y - radius)
+        (c1, r1) = self.cellAt(x + radius, y + radius)
+        for c in range(c0, c1 + 1):
+            for r in range(r0, r1 + 1):
+                if self.isWall(c, r):
+                    nearestX = min(max(x, c * self.cell), (c + 1) * self.cell)
+                    nearestY = min(max(y, r * self.cell), (r + 1) * self.cell)
+                    if (x - nearestX) ** 2 + (y - nearestY) ** 2 < radius ** 2:
+                        return True
+        return False
+
+def parseMaze(text):
+    cell = DEFAULT_CELL
+    heading = 0.0
+    rows = []
+    for line in text.splitlines():
+        line = line.split(';', 1)[0].rstrip()
+        words = line.split()
+        if len(words) == 2 and words[0] in ('cell', 'heading'):
+            try:
+                value = float(words[1])
+            except ValueError:
+                raise MazeFormatException("Bad number in " + repr(line))
+            if words[0] == 'cell':
+                cell = value
+            else:
+                heading = math.radians(value)
+        elif line:
+            rows.append(line)
+    return Maze(rows, cell, heading)
+
+def loadMaze(path):
+    with open(path) as f:
+        return parseMaze(f.read())
+
+# The car in a maze. Its pose is brought up to date (by integrating the wheel
+# speeds since the last update) whenever something looks at it or is about to
+# change the motor or servo outputs; see update().
+class World:
+    # @param clock -- where the current time comes from: anything with
+    # perf_counter_ns(), e.g. a VirtualClock.
+    # @param registers -- the PCA9685's 256 registers, e.g.
+    # simulation.smbus.busState(1).registers(0x40).
+    # @param servoMiddle -- the servo angle that points the sensor straight
+    # ahead (algorithm.py's middleHoriz).
+    # @param wheelMismatch -- standard deviation of each side's speed error,
+    # as a fraction; drawn once, like an uncalibrated car.
+    def __init__(self, maze, clock, registers, servoMiddle=90, wheelMismatch=0.02, seed=None):
+        self.maze = maze
+        self.clock = clock
+        self.registers = registers
+        self.servoMiddle = servoMiddle
+        self.random = random.Random(seed)
+        self.wheelScale = (1 + self.random.gauss(0, wheelMismatch), 1 + self.random.gauss(0, wheelMismatch))
+        self.lock = threading.RLock()
+        (self.x, self.y) = maze.centre(maze.start)
+        self.heading = maze.heading
+        self.turnRate = 0.0 # rad/s, counter-clockwise
+        self.speed = 0.0 # cm/s forward
+        self.servoAngle = float(servoMiddle) # Degrees, as Servo.setServoPwm takes it
+        self.t = clock.perf_counter_ns()
+        self.elapsed = 0.0 # Seconds simulated so far
+        self.traceDue = TRACE_INTERVAL
+        self.travelled = 0.0
+        self.collisions = 0
+        self.contactTime = 0.0 # Seconds spent pushing against walls
+        self.lastContact = None # self.elapsed at the latest contact
+        self.reachedGoal = False
+        self.onGoal = None # Called once when the car first reaches the goal
+        self.trace = [(0.0, self.x, self.y, self.heading)] # (seconds, x, y, heading)
+
+    # Duty of each wheel as Motor.setMotorModel was given it.
+    def duties(self):
+        def off(channel):
+            base = LED0_OFF_L + 4 * channel
+            return self.registers[base] | (self.registers[base + 1] << 8)
+        duties = []
+        for (forward, reverse) in WHEEL_CHANNELS:
+            (f, r) = (off(forward), off(reverse))
+            duties.append(0 if f == r else f - r)
+        return duties
+
+    def servoTarget(self):
+        base = LED0_OFF_L + 4 * SERVO_CHANNEL
+        pulse = (self.registers[base] | (self.registers[base + 1] << 8)) * 20000 / 4096
+        if pulse == 0:
+            return self.servoAngle # Never set
+        return (2500 - pulse) * 0.09 - SERVO_ERROR
+
+    # Brings the pose up to the clock's current time.
+    def update(self):
+        with self.lock:
+            now = self.clock.perf_counter_ns()
+            if now <= self.t:
+                return
+            (d1, d2, d3, d4) = self.duties()
+            # Negative duties drive forward (see algorithm.py's forward()).
+            left = -(d1 + d2) / 2 / 4095 * MAX_WHEEL_SPEED * self.wheelScale[0]
+            right = -(d3 + d4) / 2 / 4095 * MAX_WHEEL_SPEED * self.wheelScale[1]
+            self.speed = (left + right) / 2
+            self.turnRate = (right - left) / TRACK_WIDTH
+            target = self.servoTarget()
+            remaining = (now - self.t) / 1e9
+            while remaining > 0:
+                dt = min(STEP, remaining)
+                remaining -= dt
+                self._step(dt, target)
+            self.t = now
+
+    def _step(self, dt, servoTarget):
+        self.elapsed += dt
+        self.heading += self.turnRate * dt
+        dx = self.speed * dt * math.cos(self.heading)
+        dy = self.speed * dt * math.sin(self.heading)
+        # Against a wall, slide along it with whatever part of the move is free.
+        for (x, y) in [(self.x + dx, self.y + dy), (self.x + dx, self.y), (self.x, self.y + dy)]:
+            if not self.maze.collides(x, y, CAR_RADIUS):
+                break
+        else:
+            (x, y) = (self.x, self.y)
+        if (x, y) != (self.x + dx, self.y + dy):
+            if self.lastContact is None or self.elapsed - self.lastContact > SEPARATE_CONTACT:
+                self.collisions += 1
+            self.lastContact = self.elapsed
+            self.contactTime += dt
+        self.travelled += math.hypot(x - self.x, y - self.y)
+        (self.x, self.y) = (x, y)
+        if self.maze.cellAt(x, y) == self.maze.goal and not self.reachedGoal:
+            self.reachedGoal = True
+            if self.onGoal is not None:
+                self.onGoal()
+        turn = servoTarget - self.servoAngle
+        self.servoAngle += max(-SERVO_SPEED * dt, min(SERVO_SPEED * dt, turn))
+        if self.elapsed >= self.traceDue:
+            self.traceDue += TRACE_INTERVAL
+            self.trace.append((self.elapsed, self.x, self.y, self.heading))
+
+    # Distance in cm from the ultrasonic sensor to the nearest wall within its
+    # beam, or `maxDistance` if there is none that close. The sensor points
+    # where the servo is, or `angle` degrees clockwise from straight ahead.
+    def sensorDistance(self, maxDistance=RAY_LIMIT, angle=None):
+        with self.lock:
+            self.update()
+            if angle is None:
+                angle = self.servoAngle - self.servoMiddle
+            # The servo angle grows clockwise; headings grow counter-clockwise.
+            bearing = self.heading - math.radians(angle)
+            x = self.x + SENSOR_OFFSET * math.cos(self.heading)
+            y = self.y + SENSOR_OFFSET * math.sin(self.heading)
+        nearest = maxDistance
+        for offset in (-BEAM_HALF_ANGLE, 0.0, BEAM_HALF_ANGLE):
+            (distance, _) = self.maze.castRay(x, y, bearing + offset, maxDistance)
+            if distance is not None:
+                nearest = min(nearest, distance)
+        return nearest
+
+    def pose(self):
+        with self.lock:
+            self.update()
+            return (self.x, self.y, self.heading)
+
+    def summary(self):
+        with self.lock:
+            self.update()
+            (startX, startY) = self.maze.centre(self.maze.start)
+            return {
+                'final_pose': {'x': self.x, 'y': self.y, 'heading_degrees': math.degrees(self.heading)},
+                'displacement_cm': math.hypot(self.x - startX, self.y - startY),
+                'travelled_cm': self.travelled,
+                'collisions': self.collisions,
+                'contact_seconds': self.contactTime,
+                'reached_goal': self.reachedGoal,
+                'wheel_scale': list(self.wheelScale),
+            }
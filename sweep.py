@@ -0,0 +1,131 @@
+# Look-around sweeps of the ultrasonic sensor on its servo. Instead of a fixed
+# wait after every servo move, the wait is modelled from how far the servo has
+# to turn, and the DistanceEstimator's first few pings after the servo gets
+# there make the reading for that angle. No pings are taken while it turns
+# (they'd be of the wrong direction), but the servo is sent on as soon as the
+# last ping of a reading has echoed, so the move overlaps the wait the sensor
+# needs between pings anyway (MIN_PING_INTERVAL): moves shorter than that,
+# like 10 degree steps, cost no time at all.
+#
+#   sweeper = SweepScheduler(servo, distanceEstimator, middle=90)
+#   result = sweeper.sweep()
+#   print(result.angle, result.distance, result.seconds)
+#
+# A sweep first reads every `coarseStep` degrees, then every `fineStep`
+# degrees around the `refine` most open directions only. Sweeps go from
+# whichever end of the range is nearer the servo, so consecutive sweeps
+# alternate direction instead of swinging back to one side first.
+
+import time
+
+SERVO_DEGREES_PER_SECOND = 500.0 # SG90: 0.12 s per 60 degrees at 4.8 V
+SERVO_SETTLE = 0.02 # Seconds for the servo to stop shaking after a move
+
+# Seconds the servo takes to turn from `fromAngle` to `toAngle` and settle.
+def slewTime(fromAngle, toAngle, speed=SERVO_DEGREES_PER_SECOND, settle=SERVO_SETTLE):
+    if fromAngle == toAngle:
+        return 0.0
+    return abs(toAngle - fromAngle) / speed + settle
+
+class SweepResult:
+    def __init__(self, readings, seconds):
+        self.readings = readings # [(angle, distance in cm)] in the order taken
+        self.seconds = seconds
+        # The most open direction; ties go to the lowest angle.
+        (self.angle, self.distance) = max(readings, key=lambda r: (r[1], -r[0]))
+
+    def __repr__(self):
+        return "SweepResult(angle=" + str(self.angle) + ", distance=" + str(self.distance) + \
+            ", readings=" + str(len(self.readings)) + ", seconds=" + str(self.seconds) + ")"
+
+class SweepScheduler:
+    # @param servo -- the Servo the sensor is on (channel '0').
+    # @param estimator -- a running DistanceEstimator for the sensor.
+    # @param middle -- servo angle that points the sensor straight ahead.
+    # @param onReading -- called as onReading(angle, distance) for every
+    # reading a sweep takes, e.g. TelemetrySender.sweep.
+    # @param samples -- pings per reading, for the estimator's filter to work on.
+    def __init__(self, servo, estimator, middle=90, low=-90, high=90, coarseStep=30, fineStep=10,
+                 refine=2, speed=SERVO_DEGREES_PER_SECOND, settle=SERVO_SETTLE, onReading=None,
+                 samples=3):
+        self.servo = servo
+        self.estimator = estimator
+        self.middle = middle
+        self.low = low
+        self.high = high
+        self.coarseStep = coarseStep
+        self.fineStep = fineStep
+        self.refine = refine
+        self.speed = speed
+        self.settle = settle
+        self.onReading = onReading
+        self.samples = samples
+        self.angle = None # Where the servo was last sent; unknown until then
+        self.sweeps = 0
+        self.sweepTime = 0.0
+        self.readings = 0
+
+    # Starts turning the sensor to `angle` degrees from the middle; returns
+    # the time.monotonic() time it will get there. The estimator is reset so
+    # only readings taken from there on count; its next ping is at that time
+    # or when the last ping's echoes have died down, whichever is later.
+    def point(self, angle):
+        moving = slewTime(self.angle, angle, self.speed, self.settle) if self.angle is not None \
+            else abs(self.high - self.low) / self.speed + self.settle
+        self.servo.setServoPwm('0', angle + self.middle)
+        self.angle = angle
+        arrival = time.monotonic() + moving
+        self.estimator.reset(after=arrival)
+        return arrival
+
+    # Turns the sensor to `angle` and waits until it's there.
+    def moveTo(self, angle):
+        arrival = self.point(angle)
+        time.sleep(max(0.0, arrival - time.monotonic()))
+
+    # Distance in cm at `angle`, from the first `samples` pings once the
+    # sensor gets there; 0 (blocked) if the estimator has no reading.
+    def measure(self, angle):
+        self.point(angle)
+        distance = self.estimator.waitFor(self.samples)
+        if distance is None:
+            distance = 0
+        if self.onReading is not None:
+            self.onReading(angle, distance)
+        return distance
+
+    # Angles from the range in `step`s, in the direction starting nearest the servo.
+    def _pass(self, angles):
+        angles = sorted(angles)
+        if self.angle is not None and abs(self.angle - angles[-1]) < abs(self.angle - angles[0]):
+            angles.reverse()
+        return angles
+
+    def sweep(self):
+        start = time.monotonic()
+        coarse = list(range(self.low, self.high + 1, self.coarseStep))
+        if coarse[-1] != self.high:
+            coarse.append(self.high)
+        readings = [(angle, self.measure(angle)) for angle in self._pass(coarse)]
+
+        # Fill in around the most open directions.
+        if self.fineStep < self.coarseStep:
+            best = sorted(readings, key=lambda r: (-r[1], r[0]))[:self.refine]
+            taken = set(coarse)
+            fine = set()
+            for (angle, _) in best:
+                for a in range(angle - self.coarseStep + self.fineStep, angle + self.coarseStep, self.fineStep):
+                    if self.low <= a <= self.high and a not in taken:
+                        fine.add(a)
+            if fine:
+                readings += [(angle, self.measure(angle)) for angle in self._pass(fine)]
+
+        result = SweepResult(readings, time.monotonic() - start)
+        self.sweeps += 1
+        self.sweepTime += result.seconds
+        self.readings += len(readings)
+        return result
+
+    def stats(self):
+        return {'sweeps': self.sweeps, 'readings': self.readings,
+                'mean_sweep_seconds': self.sweepTime / self.sweeps if self.sweeps else None}
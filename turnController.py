@@ -0,0 +1,218 @@
+# Closed-loop turns in place. A TurnController runs at a fixed control rate:
+# every tick it reads the heading from a heading source and sets the turn
+# speed with a PID on the remaining angle, so the car slows down as it gets
+# close instead of turning at full speed and cutting power at the end:
+#
+#   controller = TurnController(turn, stop, GyroHeading(imuSampler), maxSpeed=0.5)
+#   result = controller.turnBy(90)      # degrees, clockwise positive
+#   print(result.heading, result.seconds)
+#
+# A heading source is anything with reset() (start measuring from here),
+# heading() (degrees turned since reset(), clockwise positive) and
+# command(speed) (the turn speed just set). Ticks the controller is too late
+# for (e.g. because heading() blocked) are skipped and counted in stats().
+
+import abc
+import math
+import time
+
+CONTROL_RATE = 100 # Hz
+
+# Heading sources #
+
+# Base class for heading sources: heading() has to be implemented, reset()
+# and command() do nothing unless a source needs them.
+class HeadingSource(abc.ABC):
+    def reset(self):
+        pass
+
+    @abc.abstractmethod
+    def heading(self):
+        pass
+
+    def command(self, speed):
+        pass
+
+# Heading from an ImuSampler's gyro integration.
+class GyroHeading(HeadingSource):
+    def __init__(self, sampler):
+        self.sampler = sampler
+        self.start = 0.0
+
+    def reset(self):
+        self.start = self.sampler.heading()
+
+    def heading(self):
+        return self.sampler.heading() - self.start
+
+# Heading from the camera's optical flow (see flow.py). Every heading() call
+# waits for a camera frame, so use a control rate no higher than the
+# camera's frame rate. Frames without anything to track leave the heading
+# where it was.
+# @param distance -- function returning the distance in cm to what the
+# camera sees, e.g. the latest ultrasonic reading.
+class FlowHeading(HeadingSource):
+    def __init__(self, flow, distance):
+        self.flow = flow
+        self.distance = distance
+        self.current = 0.0
+
+    def reset(self):
+        self.flow.prepare()
+        self.current = 0.0
+
+    def heading(self):
+        flow = self.flow.computeCentermostFlow()
+        if isinstance(flow, tuple):
+            (closestPointToCenter, flowVector) = flow
+            self.current -= math.degrees(self.flow.computeRadiansOfCameraRotation(self.distance(), flowVector))
+        return self.current
+
+# Heading from a model of how fast the car turns: `degreesPerSecond` at full
+# speed, none below `deadband`. Only as good as the model, but needs no
+# sensor.
+class TimedHeading(HeadingSource):
+    def __init__(self, degreesPerSecond=360, deadband=0.0):
+        self.degreesPerSecond = degreesPerSecond
+        self.deadband = deadband
+        self.reset()
+
+    def reset(self):
+        self.current = 0.0
+        self.speed = 0.0
+        self.since = time.monotonic()
+
+    def heading(self):
+        now = time.monotonic()
+        if abs(self.speed) > self.deadband:
+            self.current += self.speed * self.degreesPerSecond * (now - self.since)
+        self.since = now
+        return self.current
+
+    def command(self, speed):
+        self.heading() # Up to now at the old speed
+        self.speed = speed
+
+# Controller #
+
+class TurnResult:
+    def __init__(self, angle, heading, seconds, ticks, missed, timedOut):
+        self.angle = angle # Degrees asked for
+        self.heading = heading # Degrees turned, according to the heading source
+        self.seconds = seconds
+        self.ticks = ticks
+        self.missed = missed # Control ticks skipped because the loop ran late
+        self.timedOut = timedOut
+
+    def __repr__(self):
+        return "TurnResult(angle=" + str(self.angle) + ", heading=" + str(self.heading) + \
+            ", seconds=" + str(self.seconds) + ", missed=" + str(self.missed) + \
+            (", timed out" if self.timedOut else "") + ")"
+
+class TurnController:
+    # @param turn -- turn(speed) turns in place, clockwise for positive
+    # speeds, like algorithm.py's turn().
+    # @param stop -- stops the motors.
+    # @param source -- the HeadingSource to steer by.
+    # @param maxSpeed -- fastest turn speed used, 0 to 1.
+    # @param minSpeed -- slowest turn speed that still moves the car; smaller
+    # outputs are raised to it until the car is within `tolerance` degrees.
+    # @param kp, ki, kd -- PID gains, in speed per degree (kd: per degree
+    # per second, on the measured turn rate).
+    # @param timeout -- seconds before giving up on a turn, or None.
+    # @param onProgress -- called as onProgress(heading, angle) every tick,
+    # e.g. TelemetrySender.turn.
+    def __init__(self, turn, stop, source, rate=CONTROL_RATE, maxSpeed=0.5, minSpeed=0.2,
+                 kp=0.04, ki=0.01, kd=0.0005, tolerance=1.0, timeout=5.0, onProgress=None):
+        self.turn = turn
+        self.stop = stop
+        self.source = source
+        self.period = 1.0 / rate
+        self.maxSpeed = maxSpeed
+        self.minSpeed = minSpeed
+        self.kp = kp
+        self.ki = ki
+        self.kd = kd
+        self.tolerance = tolerance
+        self.timeout = timeout
+        self.onProgress = onProgress
+        self.turns = 0
+        self.turnTime = 0.0
+        self.totalError = 0.0
+        self.ticks = 0
+        self.missed = 0
+        self.timeouts = 0
+
+    def _setSpeed(self, speed):
+        self.turn(speed)
+        self.source.command(speed)
+
+    # Turns `angle` degrees, clockwise positive, and stops. `maxSpeed`
+    # overrides the controller's for this turn.
+    def turnBy(self, angle, maxSpeed=None):
+        maxSpeed = self.maxSpeed if maxSpeed is None else maxSpeed
+        start = time.monotonic()
+        self.source.reset()
+        heading = 0.0
+        integral = 0.0
+        last = (start, 0.0) # Time and heading of the previous tick
+        ticks = 0
+        missed = 0
+        timedOut = False
+        nextTick = start
+        while True:
+            heading = self.source.heading()
+            now = time.monotonic()
+            ticks += 1
+            if self.onProgress is not None:
+                self.onProgress(heading, angle)
+            error = angle - heading
+            if abs(error) <= self.tolerance:
+                break
+            if self.timeout is not None and now - start > self.timeout:
+                timedOut = True
+                break
+
+            dt = now - last[0]
+            rate = (heading - last[1]) / dt if dt > 0 else 0.0
+            last = (now, heading)
+            integral += error * dt
+            # Don't let the integral alone ask for more than full speed.
+            if self.ki > 0:
+                limit = maxSpeed / self.ki
+                integral = max(-limit, min(limit, integral))
+            speed = self.kp * error + self.ki * integral - self.kd * rate
+            speed = max(-maxSpeed, min(maxSpeed, speed))
+            if abs(speed) < self.minSpeed:
+                speed = math.copysign(self.minSpeed, error)
+            self._setSpeed(speed)
+
+            nextTick += self.period
+            now = time.monotonic()
+            if now > nextTick + self.period:
+                # Too late for one or more ticks: skip them instead of bunching up.
+                late = int((now - nextTick) / self.period)
+                missed += late
+                nextTick += late * self.period
+            time.sleep(max(0.0, nextTick - time.monotonic()))
+        self.stop()
+        self.source.command(0.0)
+
+        result = TurnResult(angle, heading, time.monotonic() - start, ticks, missed, timedOut)
+        self.turns += 1
+        self.turnTime += result.seconds
+        self.totalError += abs(angle - heading)
+        self.ticks += ticks
+        self.missed += missed
+        self.timeouts += timedOut
+        return result
+
+    def stats(self):
+        return {
+            'turns': self.turns,
+            'mean_turn_seconds': self.turnTime / self.turns if self.turns else None,
+            'mean_abs_error_degrees': self.totalError / self.turns if self.turns else None,
+            'ticks': self.ticks,
+            'missed_deadlines': self.missed,
+            'timeouts': self.timeouts,
+        }